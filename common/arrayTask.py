@@ -0,0 +1,93 @@
+
+"""
+
+This script contains the array task runner of the python stages (PNG, synthseg PNG, GIF and nibabel crop generation).
+
+When a job script runs as a task of a chunked job array (see slurmArray.py), it calls its python script once with
+`--array-manifest <manifest>` instead of once per scan. The rows of the manifest assigned to the task are then processed
+one after the other in the same (warm) interpreter, so conda activation and the nilearn/matplotlib imports are paid once
+per chunk. A scan that fails is logged with its traceback and written to `<manifest>_failures/task_<task>.tsv`, and the
+task moves on to the next scan.
+
+"""
+import os
+import sys
+import csv
+import time
+import traceback
+
+##
+# Index of the current array task in the whole manifest (the array offset is added when an array was split)
+# @return The task index
+def getTaskIndex():
+    return int(os.environ["SLURM_ARRAY_TASK_ID"]) + int(os.environ.get("ARRAY_OFFSET", 0))
+
+
+##
+# Read the rows of the manifest processed by the current array task
+# @parameter manifestPath Full path to the array manifest TSV
+# @return A list of dictionaries {column : value}
+def readTaskRows(manifestPath):
+    chunkSize = int(os.environ.get("CHUNK_SIZE", 1))
+    first = getTaskIndex() * chunkSize
+
+    with open(manifestPath, "r", newline="") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        rows = [row for rowIdx, row in enumerate(reader) if first <= rowIdx < first + chunkSize]
+
+    return rows
+
+
+##
+# Convert a boolean written to the manifest
+# @parameter value "True" or "False"
+# @return The boolean
+def parseBool(value):
+    return str(value) == "True"
+
+
+##
+# Convert an optional path written to the manifest
+# @parameter value A path, or an empty string / "None"
+# @return The path or None
+def parsePath(value):
+    if value is None or value in ("", "None"):
+        return None
+
+    return value
+
+
+##
+# Process the rows of the manifest assigned to the current array task, isolating the failures of single scans
+# @parameter manifestPath Full path to the array manifest TSV
+# @parameter processRow A function called with each row (a dictionary {column : value})
+# @return A list of (row, error message) tuples for the rows that failed
+def runTaskRows(manifestPath, processRow):
+    rows = readTaskRows(manifestPath)
+    failures = []
+
+    for row in rows:
+        start = time.time()
+        try:
+            processRow(row)
+        except Exception:
+            error = traceback.format_exc()
+            failures.append((row, error))
+            print("!! Failed : ", "\t".join(row.values()))
+            print(error)
+        print("Processed in", round(time.time() - start, 1), "s :", next(iter(row.values())))
+        sys.stdout.flush()
+
+    # Keep a list of the failed rows, in the manifest format, so that they can be resubmitted
+    if failures:
+        failureDir = os.path.splitext(manifestPath)[0] + "_failures"
+        os.makedirs(failureDir, exist_ok=True)
+        with open(os.path.join(failureDir, "task_" + str(getTaskIndex()) + ".tsv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()), delimiter="\t", lineterminator="\n")
+            writer.writeheader()
+            for row, _ in failures:
+                writer.writerow(row)
+
+    print(len(rows) - len(failures), "of", len(rows), "scans processed by this task")
+
+    return failures
@@ -0,0 +1,234 @@
+
+"""
+
+This script contains the BIDS scan index shared by the driver scripts (runPngGenerator.py, runGIFGenerator.py, runCrop.py,
+runBrainCrop.py, runAlignmentWithCrop.py and runOrientationValidator.py).
+
+Instead of walking sub-*/ses-*/anat with `os.listdir` and `os.path.exists` in every driver, the directory listings are cached
+in a SQLite index (by default `.<BIDS directory name>_scan_index.sqlite` next to the BIDS directory) :
+	- every level of the tree (subjects, sessions, anat folders, synthseg derivatives) is listed with `os.scandir`,
+	  the directories of a level being listed in parallel by a pool of threads,
+	- a directory is only listed again when its modification time changed (files were added, removed or renamed in it),
+	  so refreshing the index of an unchanged tree only costs one `stat` per directory. As in git's "racy" check, a listing
+	  made less than a few seconds after the last modification of its directory is not trusted (on filesystems with a coarse
+	  modification time, NFS or Lustre, a file added in the same tick would otherwise never be seen) : the directory is listed
+	  again until a listing is made long enough after its modification. `refresh=True` (`--refresh-index` in the drivers)
+	  lists every directory again.
+The scans, with their JSON sidecar and matching synthseg segmentation, are then matched in memory from the listings.
+When the index cannot be written next to the BIDS directory (read-only or shared parent directory, unusable SQLite locking),
+it is kept in the user cache (`~/.cache/manual_smri_qc`), and as a last resort in memory for the current run only.
+
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of threads listing directories in parallel (listing is I/O bound on network filesystems)
+NUM_THREADS = 16
+
+# A cached listing is only trusted if it was made at least this long after the last modification of its directory
+RACY_SECONDS = 5
+
+# A scan found in the BIDS directory
+# segPath is the synthseg segmentation of the scan (None if there is no derivatives directory or no segmentation)
+ScanRecord = namedtuple("ScanRecord", ["subID", "sesID", "anatPath", "scan", "scanPath", "scanID", "jsonPath", "segPath"])
+
+##
+# Check whether a file of an anat folder is a scan handled by the QC pipeline
+# TODO: generalize for more than MPR labeled scans
+# @parameter fileName The name of the file
+# @return True for MPR labeled .nii(.gz) scans
+def isAnatScan(fileName):
+    return (".nii" in fileName) and ("MPR" in fileName)
+
+
+##
+# Default location of the index of a BIDS directory : next to it, so that the BIDS directory itself is not modified
+# @parameter inDir Full path to the BIDS directory
+# @return Full path to the SQLite index
+def defaultIndexPath(inDir):
+    inDir = os.path.abspath(inDir)
+
+    return os.path.join(os.path.dirname(inDir), "." + os.path.basename(inDir) + "_scan_index.sqlite")
+
+
+##
+# Fallback location of the index of a BIDS directory, in the user cache
+# @parameter inDir Full path to the BIDS directory
+# @return Full path to the SQLite index
+def userIndexPath(inDir):
+    inDir = os.path.abspath(inDir)
+    cacheDir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "manual_smri_qc")
+    digest = hashlib.sha1(inDir.encode("utf-8")).hexdigest()[:12]
+
+    return os.path.join(cacheDir, os.path.basename(inDir) + "_" + digest + "_scan_index.sqlite")
+
+
+##
+# Open (and create if needed) a scan index and check that it can be written
+# @parameter indexPath Full path to the SQLite index, or ":memory:"
+# @return A sqlite3 connection
+def _connect(indexPath):
+    if indexPath != ":memory:":
+        os.makedirs(os.path.dirname(indexPath), exist_ok=True)
+    conn = sqlite3.connect(indexPath, timeout=60)
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, entries TEXT, listed_ns INTEGER)")
+        # Indexes written by earlier versions have no listing time : their listings are all listed again once
+        if "listed_ns" not in [row[1] for row in conn.execute("PRAGMA table_info(dirs)")]:
+            conn.execute("ALTER TABLE dirs ADD COLUMN listed_ns INTEGER")
+        # Indexes written by earlier versions also cached the scans found, which nothing read
+        conn.execute("DROP TABLE IF EXISTS scans")
+        conn.commit()
+        # Read-only index files are opened without error, only a write tells
+        conn.execute("INSERT OR REPLACE INTO dirs (path, mtime_ns, entries, listed_ns) VALUES ('', 0, '{}', 0)")
+        conn.rollback()
+    except sqlite3.Error:
+        conn.close()
+        raise
+
+    return conn
+
+
+##
+# Open (and create if needed) a scan index, falling back to other locations when it cannot be written
+# @parameter indexPath Full path to the SQLite index
+# @parameter fallbackPaths Full paths to the indexes to use instead, in order (an in-memory index is used if none can be written)
+# @return A sqlite3 connection
+def openIndex(indexPath, fallbackPaths=()):
+    for path in [indexPath] + list(fallbackPaths):
+        try:
+            return _connect(path)
+        except (sqlite3.Error, OSError) as e:
+            print("Cannot use the scan index " + path + " (" + str(e) + ")", file=sys.stderr)
+
+    print("Using an in-memory scan index : every directory is listed again on each run", file=sys.stderr)
+    return _connect(":memory:")
+
+
+##
+# List a directory, unless its modification time shows that the cached listing is still valid
+# @parameter path Full path to the directory
+# @parameter cached The cached (mtime_ns, entries, listed_ns) of the directory, or None
+# @return A tuple (path, mtime_ns or None if the directory does not exist, {entry name: is directory}, listed_ns,
+#	True if the directory was listed)
+def _listDir(path, cached):
+    # Taken before the listing, so that the listing is at least as recent as this time
+    listed_ns = time.time_ns()
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return path, None, {}, None, False
+
+    # The cached listing is stale if the directory changed since, or racy if it was made too close to the last change
+    if cached is not None and cached[0] == mtime_ns and cached[2] is not None and cached[2] - mtime_ns >= RACY_SECONDS * 10 ** 9:
+        return path, mtime_ns, cached[1], cached[2], False
+
+    entries = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            entries[entry.name] = entry.is_dir()
+
+    return path, mtime_ns, entries, listed_ns, True
+
+
+##
+# List a level of directories in parallel, reusing and updating the cached listings of the index
+# @parameter conn The sqlite3 connection of the index
+# @parameter paths A list of full paths to directories
+# @parameter numThreads Number of threads listing directories
+# @parameter refresh True to list every directory again, ignoring the cached listings
+# @return A dictionary {path : {entry name: is directory}} (directories that do not exist are left out)
+def listDirs(conn, paths, numThreads=NUM_THREADS, refresh=False):
+    cache = {}
+    # With refresh, the cached listings are not read : every directory is listed again and its listing replaced
+    if not refresh:
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            rows = conn.execute("SELECT path, mtime_ns, entries, listed_ns FROM dirs WHERE path IN (" + ",".join("?" * len(chunk)) + ")", chunk)
+            for path, mtime_ns, entries, listed_ns in rows:
+                cache[path] = (mtime_ns, json.loads(entries), listed_ns)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(numThreads, len(paths)))) as executor:
+        results = list(executor.map(lambda path: _listDir(path, cache.get(path)), paths))
+
+    listings = {}
+    updates = []
+    for path, mtime_ns, entries, listed_ns, listed in results:
+        if mtime_ns is None:
+            continue
+        listings[path] = entries
+        if listed:
+            updates.append((path, mtime_ns, json.dumps(entries), listed_ns))
+    if updates:
+        try:
+            conn.executemany("INSERT OR REPLACE INTO dirs (path, mtime_ns, entries, listed_ns) VALUES (?, ?, ?, ?)", updates)
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            # The listings are still valid for this run, they are only not cached (e.g. index locked by another driver)
+            conn.rollback()
+            print("Scan index not updated (" + str(e) + ")", file=sys.stderr)
+
+    return listings
+
+
+##
+# Find the scans of a BIDS directory (sub-*/ses-*/anat), refreshing the index incrementally
+# @parameter inDir Full path to the BIDS directory
+# @parameter derivatives Full path to the synthseg derivatives directory (<derivatives>/<scanID>/<scanID>_synthseg.nii.gz), or None
+# @parameter indexPath Full path to the SQLite index, defaultIndexPath(inDir) if None
+# @parameter numThreads Number of threads listing directories
+# @parameter refresh True to list every directory again, ignoring the cached listings
+# @return A list of ScanRecord, sorted by scan path
+def findScans(inDir, derivatives=None, indexPath=None, numThreads=NUM_THREADS, refresh=False):
+    inDir = os.path.abspath(inDir)
+    if indexPath is None:
+        indexPath = defaultIndexPath(inDir)
+    conn = openIndex(indexPath, [userIndexPath(inDir)])
+
+    # --- Subjects, sessions and anat folders, one level at a time ---
+    rootEntries = listDirs(conn, [inDir], numThreads, refresh).get(inDir, {})
+    subPaths = [os.path.join(inDir, name) for name, isDir in sorted(rootEntries.items()) if isDir and ("sub-" in name)]
+    subListings = listDirs(conn, subPaths, numThreads, refresh)
+
+    sesPaths = [os.path.join(subPath, name) for subPath in subPaths for name, isDir in sorted(subListings.get(subPath, {}).items())
+                if isDir and ("ses-" in name)]
+    sesListings = listDirs(conn, sesPaths, numThreads, refresh)
+
+    anatPaths = [os.path.join(sesPath, "anat") for sesPath in sesPaths if sesListings.get(sesPath, {}).get("anat")]
+    anatListings = listDirs(conn, anatPaths, numThreads, refresh)
+
+    # --- Synthseg outputs ---
+    segListings = {}
+    if derivatives is not None:
+        derivatives = os.path.abspath(derivatives)
+        derEntries = listDirs(conn, [derivatives], numThreads, refresh).get(derivatives, {})
+        scanIDs = [name.split(".nii")[0] for anatPath in anatPaths for name in anatListings.get(anatPath, {}) if isAnatScan(name)]
+        segListings = listDirs(conn, [os.path.join(derivatives, scanID) for scanID in scanIDs if derEntries.get(scanID)], numThreads, refresh)
+
+    # --- Scans with their sidecar and segmentation ---
+    records = []
+    for anatPath in anatPaths:
+        entries = anatListings.get(anatPath, {})
+        sesPath = os.path.dirname(anatPath)
+        for scan in sorted(entries):
+            if entries[scan] or not isAnatScan(scan):
+                continue
+            scanID = scan.split(".nii")[0]
+            jsonPath = os.path.join(anatPath, scanID + ".json") if (scanID + ".json") in entries else None
+            segPath = None
+            if derivatives is not None:
+                segDir = os.path.join(derivatives, scanID)
+                if (scanID + "_synthseg.nii.gz") in segListings.get(segDir, {}):
+                    segPath = os.path.join(segDir, scanID + "_synthseg.nii.gz")
+            records.append(ScanRecord(os.path.basename(os.path.dirname(sesPath)), os.path.basename(sesPath), anatPath, scan,
+                                      os.path.join(anatPath, scan), scanID, jsonPath, segPath))
+
+    conn.close()
+
+    return sorted(records, key=lambda rec: rec.scanPath)
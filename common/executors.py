@@ -0,0 +1,307 @@
+
+"""
+
+This script contains the executors the driver scripts (runPngGenerator.py, runGIFGenerator.py, runCrop.py, runBrainCrop.py,
+runAlignmentWithCrop.py and runOrientationValidator.py) submit their per-scan jobs through (`--executor`).
+
+A driver describes every scan to process as a `Job` : the Slurm job script and its positional arguments, and, for the python
+stages, the per-scan function the job script ends up calling. The executor decides how the jobs run :
+	- `slurm` : one `sbatch` call per job (the original behaviour),
+	- `slurm-array` : a single Slurm job array over a manifest of the jobs (see slurmArray.py, `--array` in the drivers),
+	- `slurm-queue` : the jobs are written to a work queue on the shared filesystem (see workQueue.py) and a fixed number of
+	  long-running worker jobs pull them until the queue is empty,
+	- `local` : the jobs run on this machine with a pool of worker processes (one per available CPU by default). The python
+	  stages call their per-scan function in the worker, the shell stages (FSL) run their job script with bash,
+	- `dry-run` : the `sbatch` command of every job is printed and nothing runs.
+
+"""
+import os
+import sys
+import time
+import traceback
+import subprocess
+import multiprocessing
+from collections import namedtuple
+
+import slurmArray
+import workQueue
+
+# Backends available to the drivers
+EXECUTORS = ["slurm", "slurm-array", "slurm-queue", "local", "dry-run"]
+
+# Time limit of the worker jobs of a queue
+DEFAULT_WORKER_HOURS = 12
+
+# A job of a driver
+# name : name of the job in the logs (the scan ID)
+# jobScript : the Slurm job script
+# args : the positional arguments of the job script (also the row of the array manifest)
+# func : the per-scan python function run by the local executor (None to run the job script with bash)
+# funcArgs : the arguments of func
+# sbatchArgs : extra sbatch options of this job (e.g. "--cpus-per-task=16")
+Job = namedtuple("Job", ["name", "jobScript", "args", "func", "funcArgs", "sbatchArgs"], defaults=(None, (), ""))
+
+##
+# Number of CPUs this process is allowed to run on (respects the Slurm allocation)
+# @return The number of usable CPUs
+def getAvailableCpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+##
+# sbatch command of a job
+# @parameter job A Job
+# @return The command as a string
+def getSbatchCommand(job):
+    cmd = 'sbatch '
+    if job.sbatchArgs:
+        cmd += job.sbatchArgs + ' '
+    cmd += job.jobScript + ' ' + ' '.join(str(arg) for arg in job.args)
+
+    return cmd
+
+
+##
+# Worker function of the local executor : run a single job and report failures instead of raising them
+# @parameter job A Job
+# @return A tuple (job name, error message or None, duration in seconds)
+def _runLocalJob(job):
+    start = time.time()
+    try:
+        if job.func is not None:
+            job.func(*job.funcArgs)
+        else:
+            subprocess.run(["bash", job.jobScript] + [str(arg) for arg in job.args], check=True)
+    except Exception:
+        return job.name, traceback.format_exc(), time.time() - start
+    finally:
+        sys.stdout.flush()
+
+    return job.name, None, time.time() - start
+
+
+class SlurmExecutor:
+    ##
+    # Submit every job with its own sbatch call
+    def __init__(self):
+        self.numJobs = 0
+
+    ##
+    # Submit a job
+    # @parameter job A Job
+    # @return None
+    def submit(self, job):
+        os.system(getSbatchCommand(job))
+        self.numJobs += 1
+        print("Submitted job for : ", job.name)
+        print()
+
+    ##
+    # Nothing is left to submit once every job was submitted
+    # @return An empty list (failures are reported by the jobs)
+    def finish(self):
+        return []
+
+
+class SlurmArrayExecutor:
+    ##
+    # Collect the jobs and submit them as a single job array
+    # @parameter columns A list with the names of the job script arguments (header of the manifest)
+    # @parameter manifestPath Full path to the manifest TSV to write
+    # @parameter throttle Maximum number of tasks running at the same time
+    # @parameter chunkSize Number of jobs processed by each array task
+    # @parameter secondsPerScan The expected duration of a job (None to keep the time limit of the job script)
+    def __init__(self, columns, manifestPath, throttle=slurmArray.DEFAULT_THROTTLE, chunkSize=1, secondsPerScan=None):
+        self.columns = columns
+        self.manifestPath = manifestPath
+        self.throttle = throttle
+        self.chunkSize = chunkSize
+        self.secondsPerScan = secondsPerScan
+        self.jobScript = None
+        self.rows = []
+
+    ##
+    # Add a job to the array
+    # @parameter job A Job (all of the jobs of an array share the same job script)
+    # @return None
+    def submit(self, job):
+        if self.jobScript is not None and job.jobScript != self.jobScript:
+            raise ValueError("The jobs of an array must share their job script : " + self.jobScript + " != " + job.jobScript)
+        self.jobScript = job.jobScript
+        self.rows.append(tuple(job.args))
+
+    ##
+    # Submit the job array
+    # @return An empty list (failures are reported by the array tasks)
+    def finish(self):
+        if self.rows:
+            slurmArray.submitArray(self.jobScript, self.rows, self.columns, self.manifestPath, self.throttle,
+                                   chunkSize=self.chunkSize, secondsPerScan=self.secondsPerScan)
+
+        return []
+
+
+class SlurmQueueExecutor:
+    ##
+    # Collect the jobs, write them to a work queue and submit worker jobs pulling from it
+    # @parameter columns A list with the names of the job script arguments
+    # @parameter queueDir Full path to the queue directory
+    # @parameter numWorkers Number of worker jobs (default : workQueue.DEFAULT_WORKERS)
+    # @parameter secondsPerScan The expected duration of a job (workers stop claiming scans when they could not finish them in time)
+    # @parameter workerHours Time limit of the worker jobs
+    def __init__(self, columns, queueDir, numWorkers=None, secondsPerScan=None, workerHours=DEFAULT_WORKER_HOURS):
+        self.columns = columns
+        self.queueDir = os.path.abspath(queueDir)
+        self.numWorkers = numWorkers
+        self.secondsPerScan = secondsPerScan
+        self.workerHours = workerHours
+        self.jobScript = None
+        self.names = []
+        self.rows = []
+
+    ##
+    # Add a job to the queue
+    # @parameter job A Job (all of the jobs of a queue share the same job script)
+    # @return None
+    def submit(self, job):
+        if self.jobScript is not None and job.jobScript != self.jobScript:
+            raise ValueError("The jobs of a queue must share their job script : " + self.jobScript + " != " + job.jobScript)
+        self.jobScript = job.jobScript
+        self.names.append(job.name)
+        self.rows.append(tuple(job.args))
+
+    ##
+    # Write the queue and submit its workers as a job array
+    # @return An empty list (failures are recorded in the failed/ directory of the queue)
+    def finish(self):
+        if not self.rows:
+            return []
+
+        workQueue.createQueue(self.queueDir, self.names, self.rows, self.columns, self.jobScript)
+        numWorkers = self.numWorkers
+        if numWorkers is None or numWorkers < 1:
+            numWorkers = workQueue.DEFAULT_WORKERS
+        numWorkers = min(numWorkers, len(self.rows))
+
+        # Stop claiming scans early enough to finish the last one (twice its expected duration) before the time limit
+        maxMinutes = self.workerHours * 60
+        if self.secondsPerScan is not None:
+            maxMinutes -= 2 * self.secondsPerScan / 60.0
+
+        cmd = 'sbatch --array=0-' + str(numWorkers - 1) + ' --time=' + str(self.workerHours) + ':00:00'
+        cmd += ' --export=ALL,QUEUE_DIR=' + self.queueDir + ',QUEUE_WORKER=' + os.path.abspath(workQueue.__file__)
+        cmd += ',QUEUE_MAX_MINUTES=' + str(int(maxMinutes))
+        cmd += ' --output=%x_%A_%a.out ' + self.jobScript + ' ' + self.queueDir
+        os.system(cmd)
+        print("Queued", len(self.rows), "scans in", self.queueDir, "for", numWorkers, "worker job(s)")
+
+        return []
+
+
+class LocalExecutor:
+    ##
+    # Collect the jobs and run them on this machine with a pool of worker processes
+    # @parameter numWorkers Number of worker processes, all available CPUs if None
+    def __init__(self, numWorkers=None):
+        self.numWorkers = numWorkers
+        self.jobs = []
+
+    ##
+    # Add a job to run
+    # @parameter job A Job
+    # @return None
+    def submit(self, job):
+        self.jobs.append(job)
+
+    ##
+    # Run the jobs and wait for them
+    # @return A list of (job name, error message) tuples for the jobs that failed
+    def finish(self):
+        if not self.jobs:
+            return []
+
+        numWorkers = self.numWorkers
+        if numWorkers is None or numWorkers < 1:
+            numWorkers = getAvailableCpus()
+        numWorkers = min(numWorkers, len(self.jobs))
+
+        print("Running", len(self.jobs), "jobs locally with", numWorkers, "worker(s)")
+        failures = []
+        pool = None
+        try:
+            if numWorkers == 1:
+                results = map(_runLocalJob, self.jobs)
+            else:
+                # The workers are forked so that they start with the modules of the driver already imported
+                # maxtasksperchild keeps matplotlib/nilearn memory from piling up in long-lived workers
+                pool = multiprocessing.get_context("fork").Pool(processes=numWorkers, maxtasksperchild=50)
+                results = pool.imap_unordered(_runLocalJob, self.jobs)
+
+            for name, error, duration in results:
+                if error is not None:
+                    failures.append((name, error))
+                    print("!! Job failed for : ", name)
+                    print(error)
+                else:
+                    print("Finished job for : ", name, "(" + str(round(duration, 1)), "s)")
+        finally:
+            # Stop the workers even if the driver is interrupted (Ctrl-C) or a result cannot be collected, so that none is orphaned
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        print(len(self.jobs) - len(failures), "of", len(self.jobs), "jobs finished successfully")
+
+        return failures
+
+
+class DryRunExecutor:
+    ##
+    # Print the sbatch command of every job without running anything
+    def __init__(self):
+        self.numJobs = 0
+
+    ##
+    # Print the sbatch command of a job
+    # @parameter job A Job
+    # @return None
+    def submit(self, job):
+        print("[dry-run]", getSbatchCommand(job))
+        self.numJobs += 1
+
+    ##
+    # Report the number of jobs that would have been submitted
+    # @return An empty list
+    def finish(self):
+        print("[dry-run]", self.numJobs, "jobs would have been submitted")
+
+        return []
+
+
+##
+# Create the executor selected on the command line of a driver
+# @parameter name One of EXECUTORS
+# @parameter columns The names of the job script arguments (slurm-array)
+# @parameter manifestPath Full path to the array manifest TSV (slurm-array)
+# @parameter throttle Maximum number of array tasks running at the same time (slurm-array)
+# @parameter chunkSize Number of jobs processed by each array task (slurm-array)
+# @parameter secondsPerScan The expected duration of a job (slurm-array, slurm-queue)
+# @parameter numWorkers Number of worker processes, all available CPUs if None (local), or of worker jobs (slurm-queue)
+# @parameter queueDir Full path to the work queue directory (slurm-queue)
+# @return The executor
+def createExecutor(name, columns=None, manifestPath=None, throttle=slurmArray.DEFAULT_THROTTLE, chunkSize=1, secondsPerScan=None, numWorkers=None,
+                   queueDir=None):
+    if name == "slurm":
+        return SlurmExecutor()
+    if name == "slurm-array":
+        return SlurmArrayExecutor(columns, manifestPath, throttle, chunkSize, secondsPerScan)
+    if name == "slurm-queue":
+        return SlurmQueueExecutor(columns, queueDir, numWorkers, secondsPerScan)
+    if name == "local":
+        return LocalExecutor(numWorkers)
+    if name == "dry-run":
+        return DryRunExecutor()
+
+    raise ValueError("Unknown executor : " + str(name) + " (expected one of " + ", ".join(EXECUTORS) + ")")
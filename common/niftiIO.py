@@ -0,0 +1,242 @@
+
+"""
+
+This script contains the NIfTI reading layer shared by the python stages (PNG, synthseg PNG, GIF and nibabel crop generation).
+
+Reading a `.nii.gz` scan is dominated by the single-threaded inflation of the gzip stream, and every stage of the pipeline
+decompresses the same scans again. Two things are done about it :
+	- faster inflation : when one of the optional packages `isal` (Intel ISA-L) or `zlib-ng` is installed, `.nii.gz` files
+	  are inflated with it in one streaming pass to an unlinked temporary file, which the image reads (so the compressed and
+	  inflated data are never both held in memory). Otherwise nibabel reads them with zlib (and uses `indexed_gzip` by itself
+	  when it is installed),
+	- a scratch-local cache of uncompressed copies : when the `QC_SCAN_CACHE` environment variable points to a directory
+	  (set by the drivers from their `-s` scratch directory, `<scratchDir>/scan_cache`), each `.nii.gz` is decompressed once to
+	  an uncompressed `.nii` in that directory, which every later read (and every later stage) memory maps instead. The cache
+	  is bounded by `QC_SCAN_CACHE_GB` (default : 50) and the least recently used copies are deleted beyond it, except the
+	  copies used in the last 2 hours, which jobs may still be reading lazily (the limit can then be exceeded for a while).
+A copy is keyed on the path, size and modification time of its source, so a rewritten scan is never read from a stale copy.
+
+"""
+import os
+import sys
+import glob
+import gzip
+import shutil
+import struct
+import hashlib
+import uuid
+import time
+import tempfile
+
+import nibabel
+from nibabel.fileholders import FileHolder
+
+# Faster gzip inflation, when available (the fastest first)
+try:
+    from isal import igzip as fastGzip
+    GZIP_BACKEND = "isal"
+except ImportError:
+    try:
+        from zlib_ng import gzip_ng as fastGzip
+        GZIP_BACKEND = "zlib-ng"
+    except ImportError:
+        fastGzip = None
+        GZIP_BACKEND = "zlib"
+
+# Environment variables configuring the cache of uncompressed copies (inherited by the Slurm jobs and local workers)
+CACHE_ENV = "QC_SCAN_CACHE"
+CACHE_GB_ENV = "QC_SCAN_CACHE_GB"
+
+# Default size limit of the cache, in GB
+DEFAULT_CACHE_GB = 50
+
+# Size of the blocks copied while decompressing
+COPY_BLOCK_BYTES = 16 * 1024 * 1024
+
+# Copies used more recently than this are never evicted : a job reading a scan lazily (memory map, array proxy) opens its copy
+# again after the lookup, so the copy must outlive the rendering of the scan
+EVICTION_GRACE_SECONDS = 2 * 3600
+
+##
+# Enable the cache of uncompressed copies for this process and the jobs it starts
+# @parameter scratchDir Full path to the scratch directory (the cache is `<scratchDir>/scan_cache`)
+# @parameter maxGb Size limit of the cache, in GB
+# @return The cache directory
+def enableCache(scratchDir, maxGb=DEFAULT_CACHE_GB):
+    cacheDir = os.path.join(os.path.abspath(scratchDir), "scan_cache")
+    os.makedirs(cacheDir, exist_ok=True)
+    os.environ[CACHE_ENV] = cacheDir
+    os.environ[CACHE_GB_ENV] = str(maxGb)
+
+    return cacheDir
+
+
+##
+# Open a gzip file for reading with the fastest inflater available
+# @parameter path Full path to the .gz file
+# @return A binary file object
+def openGzip(path):
+    if fastGzip is not None:
+        return fastGzip.open(path, "rb")
+
+    return gzip.open(path, "rb")
+
+
+##
+# Path of the uncompressed copy of a scan in the cache
+# @parameter cacheDir Full path to the cache directory
+# @parameter scanPath Full path to the .nii.gz scan
+# @return The path of the copy (which may not exist yet)
+def getCachedPath(cacheDir, scanPath):
+    stat = os.stat(scanPath)
+    key = os.path.abspath(scanPath) + ":" + str(stat.st_size) + ":" + str(stat.st_mtime_ns)
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    baseName = os.path.basename(scanPath)[:-len(".gz")]
+
+    return os.path.join(cacheDir, digest + "_" + baseName)
+
+
+##
+# Delete the least recently used copies until the cache fits in its size limit
+# @parameter cacheDir Full path to the cache directory
+# @parameter maxBytes Size limit of the cache, in bytes
+# @return The number of copies deleted
+def evictCache(cacheDir, maxBytes):
+    entries = []
+    for path in glob.glob(os.path.join(cacheDir, "*.nii")):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    totalBytes = sum(size for _, size, _ in entries)
+    numDeleted = 0
+    graceStart = time.time() - EVICTION_GRACE_SECONDS
+    # Copies are touched when they are used, so the oldest modification time is the least recently used copy
+    for mtime, size, path in sorted(entries):
+        if totalBytes <= maxBytes or mtime > graceStart:
+            break
+        try:
+            # Readers that already mapped the copy keep their data until they close it
+            os.remove(path)
+            numDeleted += 1
+        except FileNotFoundError:
+            pass
+        totalBytes -= size
+
+    return numDeleted
+
+
+##
+# Get the uncompressed copy of a scan from the cache, decompressing it on a miss
+# @parameter cacheDir Full path to the cache directory
+# @parameter scanPath Full path to the .nii.gz scan
+# @parameter maxBytes Size limit of the cache, in bytes
+# @return The path of the uncompressed copy
+def getUncompressed(cacheDir, scanPath, maxBytes):
+    cachedPath = getCachedPath(cacheDir, scanPath)
+    try:
+        # Mark the copy as recently used
+        os.utime(cachedPath)
+        return cachedPath
+    except FileNotFoundError:
+        pass
+
+    # Decompress to a temporary name and rename, so that concurrent jobs never read a partial copy
+    # (unique across nodes : jobs on different nodes sharing the scratch directory can have the same pid)
+    os.makedirs(cacheDir, exist_ok=True)
+    tmpPath = cachedPath + ".tmp" + uuid.uuid4().hex
+    try:
+        with openGzip(scanPath) as src, open(tmpPath, "wb") as dst:
+            shutil.copyfileobj(src, dst, COPY_BLOCK_BYTES)
+        os.replace(tmpPath, cachedPath)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+    evictCache(cacheDir, maxBytes)
+
+    return cachedPath
+
+
+##
+# Path to read a scan from : its uncompressed copy when the cache is enabled, the scan itself otherwise
+# @parameter scanPath Full path to the .nii(.gz) scan
+# @return The path to read
+def resolvePath(scanPath):
+    cacheDir = os.environ.get(CACHE_ENV)
+    if not cacheDir or not scanPath.endswith(".gz"):
+        return scanPath
+
+    maxBytes = float(os.environ.get(CACHE_GB_ENV, DEFAULT_CACHE_GB)) * 1024 ** 3
+    try:
+        return getUncompressed(cacheDir, scanPath, maxBytes)
+    except OSError as e:
+        # A full or missing scratch directory only costs the cache
+        print("Scan cache unavailable (" + str(e) + "), reading", scanPath, file=sys.stderr)
+        return scanPath
+
+
+##
+# Inflate a .nii.gz scan with the fast inflater to an unlinked temporary file, and build the image from it
+# The inflated data is streamed to the file, so it is never held in memory next to a copy of it. The file is deleted at once :
+# it stays readable through the open file object of the image (and its memory maps) until they are closed
+# @parameter scanPath Full path to the .nii.gz scan
+# @parameter mmap The mmap argument of nibabel.load
+# @return A nibabel image, whose file name is the scan (it is not an uncompressed file that can be opened again)
+def loadInflated(scanPath, mmap=True):
+    fd, tmpPath = tempfile.mkstemp(suffix=".nii")
+    os.remove(tmpPath)
+    fileObj = os.fdopen(fd, "w+b")
+    try:
+        with openGzip(scanPath) as src:
+            shutil.copyfileobj(src, fileObj, COPY_BLOCK_BYTES)
+        fileObj.seek(0)
+
+        # The size of the header (first field, either byte order) tells NIfTI-1 and NIfTI-2 apart
+        sizeBytes = fileObj.read(4)
+        fileObj.seek(0)
+    except BaseException:
+        fileObj.close()
+        raise
+    isNifti2 = 540 in (struct.unpack("<i", sizeBytes)[0], struct.unpack(">i", sizeBytes)[0])
+    imgClass = nibabel.Nifti2Image if isNifti2 else nibabel.Nifti1Image
+
+    fileMap = imgClass.make_file_map()
+    fileMap["image"] = FileHolder(filename=scanPath, fileobj=fileObj)
+
+    return imgClass.from_file_map(fileMap, mmap=mmap)
+
+
+##
+# Load a NIfTI image, through the cache and the fast inflater when available
+# @parameter scanPath Full path to the .nii(.gz) scan
+# @parameter mmap The mmap argument of nibabel.load for uncompressed files
+# @return A nibabel image
+def loadNifti(scanPath, mmap=True):
+    readPath = resolvePath(scanPath)
+    if readPath != scanPath:
+        try:
+            return nibabel.load(readPath, mmap=mmap)
+        except FileNotFoundError:
+            # The copy was evicted by another job between its lookup and its opening
+            pass
+
+    if not (scanPath.endswith(".gz") and fastGzip is not None):
+        return nibabel.load(scanPath, mmap=mmap)
+    try:
+        return loadInflated(scanPath, mmap)
+    except OSError as e:
+        # A full temporary directory only costs the fast inflater
+        print("Temporary file unavailable (" + str(e) + "), reading", scanPath, "with nibabel", file=sys.stderr)
+        return nibabel.load(scanPath, mmap=mmap)
+
+
+##
+# Check whether a loaded image is backed by an uncompressed file that can be memory mapped
+# @parameter nibImg A nibabel image returned by loadNifti
+# @return True if the image data is read from an uncompressed file
+def isMappable(nibImg):
+    fileName = nibImg.get_filename()
+
+    return fileName is not None and not fileName.endswith(".gz")
@@ -0,0 +1,162 @@
+
+"""
+
+This script contains the render manifest shared by the PNG and GIF generators and their drivers (runPngGenerator.py, runGIFGenerator.py).
+
+After a scan is rendered, a small JSON manifest is written to its output directory (`<outDir>/<scanID>/.qc_manifest.json`).
+It records :
+	- the signature of every input (scan, segmentation) : size + modification time, and optionally a sha256 content hash,
+	- the renderer settings,
+	- the output files.
+A scan is up to date when its inputs and settings did not change and all of its outputs still exist, so the drivers only
+submit jobs for new or stale scans. One manifest per scan keeps concurrent jobs from writing to the same file.
+
+"""
+import os
+import json
+import hashlib
+from datetime import datetime
+
+# Name of the manifest file in each scan output directory
+MANIFEST_NAME = ".qc_manifest.json"
+MANIFEST_VERSION = 1
+
+##
+# Compute the sha256 hash of a file
+# @parameter path Full path to the file
+# @return The hex digest of the file contents
+def hashFile(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+##
+# Compute the signature of an input file
+# @parameter path Full path to the file
+# @parameter useHash True to also hash the file contents
+# @return A dictionary with the path, size, modification time and (optionally) the sha256 of the file
+def fileSignature(path, useHash=False):
+    stat = os.stat(path)
+    signature = {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if useHash:
+        signature["sha256"] = hashFile(path)
+
+    return signature
+
+
+##
+# Check whether an input file still matches its recorded signature
+# @parameter path Full path to the file
+# @parameter signature The signature recorded in the manifest
+# @parameter useHash True to compare contents when the size or modification time changed
+# @return True if the file did not change
+def signatureMatches(path, signature, useHash=False):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+
+    if stat.st_size != signature.get("size"):
+        return False
+    if stat.st_mtime_ns == signature.get("mtime_ns"):
+        return True
+    # Same size but touched or copied : only the content hash can tell
+    return useHash and ("sha256" in signature) and (hashFile(path) == signature["sha256"])
+
+
+##
+# Read the manifest of a scan output directory
+# @parameter outDir The output directory of the scan
+# @return The manifest dictionary, or None if there is no (readable) manifest
+def readManifest(outDir):
+    manifestPath = os.path.join(outDir, MANIFEST_NAME)
+    try:
+        with open(manifestPath, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+
+    return manifest
+
+
+##
+# Check whether the outputs of a scan are up to date
+# @parameter outDir The output directory of the scan
+# @parameter inputs A dictionary {input name : path or None} (e.g. {"scan": scanPath, "seg": segPath})
+# @parameter settings A JSON serializable dictionary of the renderer settings
+# @parameter useHash True to compare input contents when their size or modification time changed
+# @return True if the scan does not need to be rendered again
+def isUpToDate(outDir, inputs, settings, useHash=False):
+    manifest = readManifest(outDir)
+    if manifest is None:
+        return False
+
+    if manifest.get("settings") != json.loads(json.dumps(settings)):
+        return False
+
+    inputs = {name: path for name, path in inputs.items() if path is not None}
+    recordedInputs = manifest.get("inputs", {})
+    if set(inputs) != set(recordedInputs):
+        return False
+    for name, path in inputs.items():
+        if not signatureMatches(path, recordedInputs[name], useHash):
+            return False
+
+    outputs = manifest.get("outputs", [])
+    return len(outputs) > 0 and all(os.path.exists(os.path.join(outDir, output)) for output in outputs)
+
+
+##
+# Write the manifest of a scan output directory
+# @parameter outDir The output directory of the scan
+# @parameter inputs A dictionary {input name : path or None}
+# @parameter settings A JSON serializable dictionary of the renderer settings
+# @parameter outputs A list of full paths to the files written for the scan
+# @parameter useHash True to also record the sha256 of the inputs
+# @return None
+def writeManifest(outDir, inputs, settings, outputs, useHash=False):
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "inputs": {name: fileSignature(path, useHash) for name, path in inputs.items() if path is not None},
+        "settings": settings,
+        # Relative paths, so that moving the whole QC tree keeps the manifest valid
+        "outputs": sorted(os.path.relpath(output, outDir) for output in set(outputs)),
+    }
+
+    # Write to a temporary file and rename it, so that a killed job never leaves a truncated manifest
+    manifestPath = os.path.join(outDir, MANIFEST_NAME)
+    tmpPath = manifestPath + ".tmp"
+    with open(tmpPath, "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmpPath, manifestPath)
+
+
+##
+# Remove the manifest of a scan output directory, so that the scan is rendered again
+# @parameter outDir The output directory of the scan
+# @return None
+def removeManifest(outDir):
+    manifestPath = os.path.join(outDir, MANIFEST_NAME)
+    if os.path.exists(manifestPath):
+        os.remove(manifestPath)
+
+
+##
+# Remove the outputs recorded in the manifest of a scan output directory (before the scan is rendered again)
+# @parameter outDir The output directory of the scan
+# @return None
+def removeOutputs(outDir):
+    manifest = readManifest(outDir)
+    if manifest is None:
+        return
+    for output in manifest.get("outputs", []):
+        outputPath = os.path.join(outDir, output)
+        if os.path.exists(outputPath):
+            os.remove(outputPath)
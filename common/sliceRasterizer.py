@@ -0,0 +1,218 @@
+"""
+
+This script contains functions that render a single anatomical slice straight from the voxel array with NumPy and PIL.
+It is used by singleScanPngGenerator.py as a faster alternative to `nilearn.plotting.plot_anat` (`-r numpy`), and by
+singleScanGIFGenerator.py to alpha-composite the synthseg labels onto the GIF frames instead of calling `plot_roi` (`-r numpy`).
+
+The slice is picked with the same world coordinate as `plot_anat` (`display_mode` + `cut_coords`), oriented with the affine so that
+it is displayed in the same (neurological) convention, and windowed with the same intensity range as nilearn's `load_anat`.
+
+"""
+import numbers
+import numpy as np
+from nibabel.orientations import io_orientation
+from PIL import Image
+
+# World axis that is cut by each nilearn display mode
+DISPLAY_AXES = {"x": 0, "y": 1, "z": 2}
+
+##
+# Get the voxels at the border of a volume (same as nilearn's get_border_data)
+# @parameter data A numpy array of a 3D brain image
+# @parameter borderSize The thickness of the border in voxels
+# @return A 1D numpy array with the border voxels
+def getBorderData(data, borderSize):
+    return np.concatenate([
+        data[:borderSize, :, :].ravel(),
+        data[-borderSize:, :, :].ravel(),
+        data[:, :borderSize, :].ravel(),
+        data[:, -borderSize:, :].ravel(),
+        data[:, :, :borderSize].ravel(),
+        data[:, :, -borderSize:].ravel(),
+    ])
+
+
+##
+# Compute the display intensity range nilearn uses for an anatomical image (see nilearn's load_anat)
+# @parameter data A numpy array of a 3D brain image
+# @parameter dim The dimming factor, "auto" or a number (plot_anat uses "auto", plot_roi is called with -0.7)
+# @return A tuple (vmin, vmax)
+def getAnatWindow(data, dim="auto"):
+    vmin = float(np.nanmin(data))
+    vmax = float(np.nanmax(data))
+    background = np.nanmedian(getBorderData(data, 2))
+
+    return getAnatWindowFromStats(vmin, vmax, background, dim)
+
+
+##
+# Compute the nilearn display intensity range from precomputed volume statistics (see volumeIO.scanVolumeStats)
+# @parameter vmin The minimum intensity of the volume
+# @parameter vmax The maximum intensity of the volume
+# @parameter background The median intensity of the voxels at the border of the volume
+# @parameter dim The dimming factor, "auto" or a number
+# @return A tuple (vmin, vmax)
+def getAnatWindowFromStats(vmin, vmax, background, dim="auto"):
+    # Guess if the background is black or light based on the voxels near the border
+    blackBg = not (background > 0.5 * (vmin + vmax))
+
+    vmean = 0.5 * (vmin + vmax)
+    ptp = 0.5 * (vmax - vmin)
+    if blackBg:
+        if not isinstance(dim, numbers.Number):
+            dim = 0.8
+        vmax = vmean + (1 + dim) * ptp
+    else:
+        if not isinstance(dim, numbers.Number):
+            dim = 0.6
+        vmin = 0.5 * (2 - dim) * vmean - (1 + dim) * ptp
+
+    return vmin, vmax
+
+
+##
+# Take the slice of a volume that nilearn would display for a display mode and a world cut coordinate
+# Only that slice is read, so the volume can be a memory map or a nibabel array proxy (see volumeIO.loadVolume)
+# @parameter data An array-like 3D brain image supporting numpy slicing
+# @parameter affine The 4x4 voxel to world affine of the image
+# @parameter display_mode "x" (sagittal), "y" (coronal) or "z" (axial)
+# @parameter cutCoord The world coordinate (mm) of the cut
+# @return A tuple (2D array with rows from top to bottom and columns from left to right, (row spacing, column spacing) in mm)
+def extractOrientedSlice(data, affine, display_mode, cutCoord):
+    # For each voxel axis : the closest RAS+ world axis and whether it is flipped (axis swaps and flips only, no resampling)
+    ornt = io_orientation(affine)
+    worldAxis = DISPLAY_AXES[display_mode]
+    axis = int(np.flatnonzero(ornt[:, 0] == worldAxis)[0])
+
+    # Voxel index of the cut : world coordinate of the volume centre with the cut axis replaced by the cut coordinate
+    centre = affine.dot(np.append((np.array(data.shape[:3]) - 1) / 2.0, 1))
+    centre[worldAxis] = cutCoord
+    voxel = np.linalg.inv(affine).dot(centre)
+    index = int(np.clip(np.round(voxel[axis]), 0, data.shape[axis] - 1))
+
+    sliceIdx = [slice(None)] * 3
+    sliceIdx[axis] = index
+    brainSlice = np.asanyarray(data[tuple(sliceIdx)])
+
+    # Put the remaining axes in increasing RAS+ order : the first is displayed left to right, the second bottom to top
+    inPlane = [a for a in range(3) if a != axis]
+    if ornt[inPlane[0], 0] > ornt[inPlane[1], 0]:
+        inPlane = inPlane[::-1]
+        brainSlice = brainSlice.T
+    for sliceAxis, voxelAxis in enumerate(inPlane):
+        if ornt[voxelAxis, 1] < 0:
+            brainSlice = np.flip(brainSlice, axis=sliceAxis)
+    brainSlice = brainSlice.T[::-1, :]
+
+    zooms = np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+
+    return brainSlice, (zooms[inPlane[1]], zooms[inPlane[0]])
+
+
+##
+# Render one anatomical slice to a grayscale PNG
+# @parameter data An array-like 3D brain image supporting numpy slicing
+# @parameter affine The 4x4 voxel to world affine of the image
+# @parameter display_mode "x" (sagittal), "y" (coronal) or "z" (axial)
+# @parameter cutCoord The world coordinate (mm) of the cut
+# @parameter outFn Full path to the PNG file to write
+# @parameter anatWindow A tuple (vmin, vmax) as returned by getAnatWindow
+# @parameter pixelsPerMm Output resolution in pixels per mm
+# @return None
+def renderAnatSlice(data, affine, display_mode, cutCoord, outFn, anatWindow, pixelsPerMm=1.0):
+    brainSlice, spacing = extractOrientedSlice(data, affine, display_mode, cutCoord)
+
+    # Window the intensities the same way as plot_anat
+    pixels = windowSlice(brainSlice, anatWindow)
+
+    # Resample to square pixels at the requested resolution
+    pngImg = Image.fromarray(pixels).resize(getOutputSize(pixels.shape, spacing, pixelsPerMm), Image.BILINEAR)
+    pngImg.save(outFn)
+
+
+##
+# Map the intensities of a slice to 8 bit gray levels with a display intensity range
+# @parameter brainSlice A 2D numpy array
+# @parameter anatWindow A tuple (vmin, vmax) as returned by getAnatWindow
+# @return A 2D uint8 numpy array
+def windowSlice(brainSlice, anatWindow):
+    vmin, vmax = anatWindow
+    scaled = (np.asarray(brainSlice, dtype=np.float32) - vmin) / max(vmax - vmin, np.finfo(np.float32).eps)
+
+    return np.clip(np.round(scaled * 255), 0, 255).astype(np.uint8)
+
+
+##
+# Size of the rendered image once resampled to square pixels
+# @parameter shape The (rows, columns) shape of the slice
+# @parameter spacing The (row spacing, column spacing) of the slice in mm
+# @parameter pixelsPerMm Output resolution in pixels per mm
+# @return A PIL size tuple (width, height)
+def getOutputSize(shape, spacing, pixelsPerMm):
+    height = max(int(round(shape[0] * spacing[0] * pixelsPerMm)), 1)
+    width = max(int(round(shape[1] * spacing[1] * pixelsPerMm)), 1)
+
+    return width, height
+
+
+##
+# Build the RGBA lookup table of the label values of one slice, colored the way plot_roi colors them
+# plot_roi masks the values below its threshold and normalizes the remaining ones to the range of the displayed slice
+# before looking them up in the colormap
+# @parameter labelSlice A 2D integer numpy array of label values (0-255)
+# @parameter cmap The matplotlib colormap of the labels
+# @parameter threshold Label values at or below the threshold are transparent
+# @return A (256, 4) float32 lookup table with the RGB color (0-255) and the opacity of every label value, or None if no label is shown
+def getLabelLut(labelSlice, cmap, threshold=0.5):
+    shown = labelSlice[labelSlice > threshold]
+    if shown.size == 0:
+        return None
+
+    vmin = float(shown.min())
+    vmax = float(shown.max())
+    values = np.arange(256, dtype=np.float64)
+    if vmax > vmin:
+        normalized = (values - vmin) / (vmax - vmin)
+    else:
+        normalized = np.zeros_like(values)
+
+    lut = cmap(normalized, bytes=True).astype(np.float32)
+    lut[:, 3] = (values > threshold).astype(np.float32)
+
+    return lut
+
+
+##
+# Alpha-composite the labels of a segmentation onto an anatomical slice
+# The segmentation must be on the voxel grid of the anatomical image
+# @parameter data An array-like 3D brain image supporting numpy slicing
+# @parameter labelData An integer array-like 3D label image on the same voxel grid (0-255, 0 is background)
+# @parameter affine The 4x4 voxel to world affine of both images
+# @parameter display_mode "x" (sagittal), "y" (coronal) or "z" (axial)
+# @parameter cutCoord The world coordinate (mm) of the cut
+# @parameter anatWindow A tuple (vmin, vmax) for the anatomical slice (plot_roi is called with dim -0.7)
+# @parameter cmap The matplotlib colormap of the labels
+# @parameter alpha The opacity of the labels
+# @parameter pixelsPerMm Output resolution in pixels per mm
+# @return A (height, width, 3) uint8 numpy array
+def compositeOverlaySlice(data, labelData, affine, display_mode, cutCoord, anatWindow, cmap, alpha=0.4, pixelsPerMm=1.0):
+    brainSlice, spacing = extractOrientedSlice(data, affine, display_mode, cutCoord)
+    labelSlice, _ = extractOrientedSlice(labelData, affine, display_mode, cutCoord)
+    labelSlice = np.asarray(labelSlice).astype(np.uint8)
+
+    gray = windowSlice(brainSlice, anatWindow).astype(np.float32)
+    rgb = np.repeat(gray[:, :, np.newaxis], 3, axis=2)
+
+    lut = getLabelLut(labelSlice, cmap)
+    if lut is not None:
+        # Per pixel label color and opacity from the lookup table
+        colors = np.take(lut, labelSlice, axis=0)
+        opacity = alpha * colors[:, :, 3:]
+        rgb = (1 - opacity) * rgb + opacity * colors[:, :, :3]
+
+    pixels = np.clip(np.round(rgb), 0, 255).astype(np.uint8)
+
+    # Nearest neighbour, like the imshow interpolation nilearn uses for its overlays
+    frameImg = Image.fromarray(pixels).resize(getOutputSize(pixels.shape, spacing, pixelsPerMm), Image.NEAREST)
+
+    return np.asarray(frameImg)
@@ -0,0 +1,104 @@
+
+"""
+
+This script contains the slice selection shared by the PNG and GIF generators.
+
+Slices are picked directly from the per-slice tissue-fraction profiles computed by `volumeIO.scanVolumeStats` in a single pass 
+over the volume, so no full-volume reduction or random retry loop over full slices is needed :
+	- PNGs : 3 jittered slices around the 35th, 50th and 65th centiles of the brain in each dimension (seedable RNG),
+	- GIFs : every 3rd slice between the 25th and 75th centiles of the brain in each dimension.
+A slice is valid when at least 10% of it is tissue (nonzero voxels).
+
+"""
+import zlib
+import numpy as np
+from nilearn.image import coord_transform
+
+# Minimum fraction of nonzero voxels for a slice to be displayed
+MIN_TISSUE_FRACTION = 0.1
+
+##
+# Default seed of the slice selection of a scan, so that rerunning a scan picks the same slices
+# @parameter scanID A string of the scan's identifier
+# @return An integer seed
+def scanSeed(scanID):
+    return zlib.crc32(scanID.encode("utf-8"))
+
+
+##
+# Snap target slice indices to the closest distinct slices that contain enough tissue
+# @parameter targets A numpy array of target slice indices
+# @parameter tissueFraction The tissue fraction of every slice along the dimension
+# @return A list of distinct slice indices (fewer than the targets only if the dimension has fewer slices)
+def snapToValidSlices(targets, tissueFraction):
+    valid = np.flatnonzero(tissueFraction >= MIN_TISSUE_FRACTION)
+    # Too few valid slices (sparse or cropped volumes) : fall back to any slice of the dimension
+    if len(valid) < len(targets):
+        valid = np.arange(len(tissueFraction))
+
+    snapped = []
+    for target in targets:
+        # Closest unused slice (the lower one on ties), so that two targets never snap to the same slice and file name
+        candidates = valid[~np.isin(valid, snapped)]
+        if len(candidates) == 0:
+            break
+        snapped.append(int(candidates[np.argmin(np.abs(candidates - target))]))
+
+    return snapped
+
+
+##
+# Select 3 pseudorandom slices around the 35th, 50th and 65th centiles of the brain in each dimension
+# @parameter volumeStats The statistics returned by volumeIO.scanVolumeStats
+# @parameter rng A numpy random Generator (np.random.default_rng(seed))
+# @return A list of 3 lists containing the selected slice indices for each of the 3 dimensions of the image
+def selectPngSlices(volumeStats, rng):
+    brainSlices = []
+    for (brainMin, brainMax), tissueFraction in zip(volumeStats["lims"], volumeStats["tissueFractions"]):
+        randRange = int(round((brainMax - brainMin)*0.05))
+        jitter = rng.integers(-randRange, randRange, size=3, endpoint=True)
+        targets = ((brainMax - brainMin)*np.array([0.35, 0.5, 0.65]) + brainMin + jitter).astype(int)
+        slices = snapToValidSlices(targets, tissueFraction)
+        # Every axis needs 3 distinct slices (9 PNGs per scan)
+        if len(set(slices)) != len(targets):
+            raise ValueError("Cannot select " + str(len(targets)) + " distinct slices from a dimension of " + str(len(tissueFraction)) + " slices")
+        brainSlices.append(slices)
+
+    return brainSlices
+
+
+##
+# Select every 3rd slice from the 25th to the 75th centile of the brain in each dimension. If some of those slices do not
+# contain enough tissue, the brain bounds are narrowed one slice at a time until they all do.
+# @parameter volumeStats The statistics returned by volumeIO.scanVolumeStats
+# @parameter stepSize The spacing between selected slices
+# @return A list of 3 lists containing the selected slice indices for each of the 3 dimensions of the image
+def selectGifSlices(volumeStats, stepSize=3):
+    brainSlices = []
+    for (brainMin, brainMax), tissueFraction in zip(volumeStats["lims"], volumeStats["tissueFractions"]):
+        while True:
+            sliceBeg = int(brainMin + (brainMax - brainMin) * 0.25)
+            sliceEnd = int(brainMin + (brainMax - brainMin) * 0.75)
+            slices = np.arange(sliceBeg, sliceEnd + stepSize, stepSize)
+            slices = slices[slices < len(tissueFraction)]
+            if np.all(tissueFraction[slices] >= MIN_TISSUE_FRACTION) or brainMax - brainMin <= 2:
+                break
+            brainMin += 1
+            brainMax -= 1
+        brainSlices.append([int(s) for s in slices])
+
+    return brainSlices
+
+
+##
+# World (mm) coordinates of a set of slices along one voxel dimension, in a single coord_transform call
+# @parameter slices A list of slice indices
+# @parameter axis The voxel dimension of the slices (0, 1 or 2)
+# @parameter affine The 4x4 voxel to world affine of the image
+# @return A numpy array of shape (len(slices), 3) with the world coordinates of voxel (slice, 0, 0), (0, slice, 0) or (0, 0, slice)
+def sliceWorldCoords(slices, axis, affine):
+    voxels = np.zeros((3, len(slices)))
+    voxels[axis] = slices
+    x, y, z = coord_transform(voxels[0], voxels[1], voxels[2], affine)
+
+    return np.column_stack([x, y, z])
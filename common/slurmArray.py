@@ -0,0 +1,125 @@
+
+"""
+
+This script contains the Slurm job array submission shared by the driver scripts (`--array`).
+
+Instead of one `sbatch` call per scan, the driver writes the arguments of every job to a manifest TSV (one row per scan,
+one column per positional argument of the job script) and submits the job script once as a job array :
+	sbatch --array=0-<N-1>%<throttle> --export=ALL,ARRAY_OFFSET=<offset>,CHUNK_SIZE=<chunk> <job script> <manifest>
+Each array task processes CHUNK_SIZE consecutive scans of the manifest, starting at row (SLURM_ARRAY_TASK_ID + ARRAY_OFFSET) * CHUNK_SIZE :
+the python stages process them in one interpreter (see arrayTask.py), the shell stages loop over them.
+The chunk size is set from the command line, or picked from the expected duration of a scan and a target task duration (`auto`).
+Arrays larger than the MaxArraySize of the cluster are split into several arrays over the same manifest.
+
+"""
+import os
+import csv
+import math
+import subprocess
+
+# Default number of array tasks running at the same time
+DEFAULT_THROTTLE = 50
+
+# MaxArraySize of the Slurm default configuration, used when it cannot be queried
+DEFAULT_MAX_ARRAY_SIZE = 1001
+
+# Target duration of a chunked array task (the job scripts request 1 hour)
+DEFAULT_TARGET_MINUTES = 40
+
+##
+# Number of scans processed by each array task
+# @parameter chunkSize An integer (as a string or int), or "auto"
+# @parameter secondsPerScan The expected processing time of one scan (used by "auto")
+# @parameter targetMinutes The target duration of a task (used by "auto")
+# @return The chunk size
+def resolveChunkSize(chunkSize, secondsPerScan, targetMinutes=DEFAULT_TARGET_MINUTES):
+    if str(chunkSize) == "auto":
+        return max(1, int(targetMinutes * 60 // secondsPerScan))
+
+    return max(1, int(chunkSize))
+
+
+##
+# Time limit of a chunked array task, with a 50% margin over the expected duration and at least the 1 hour of the job scripts
+# @parameter chunkSize The number of scans processed by each task
+# @parameter secondsPerScan The expected processing time of one scan
+# @return The time limit in minutes
+def getTimeLimit(chunkSize, secondsPerScan):
+    return max(60, int(math.ceil(chunkSize * secondsPerScan * 1.5 / 60)))
+
+
+##
+# Query the largest job array the cluster accepts
+# @return The number of tasks a single array can have
+def getMaxArraySize():
+    try:
+        config = subprocess.run(["scontrol", "show", "config"], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return DEFAULT_MAX_ARRAY_SIZE
+
+    for line in config.splitlines():
+        if line.strip().startswith("MaxArraySize"):
+            try:
+                return int(line.split("=")[1])
+            except (IndexError, ValueError):
+                break
+
+    return DEFAULT_MAX_ARRAY_SIZE
+
+
+##
+# Write the manifest of a job array
+# @parameter rows A list of tuples, the positional arguments of each job
+# @parameter columns A list with the names of the arguments (header of the manifest)
+# @parameter manifestPath Full path to the TSV file to write
+# @return None
+def writeArrayManifest(rows, columns, manifestPath):
+    with open(manifestPath, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([str(value) for value in row])
+
+
+##
+# Submit a job script as one (or several, if it exceeds MaxArraySize) Slurm job array over a manifest
+# @parameter jobScript The job script to submit (it must read its arguments from the manifest row of its task)
+# @parameter rows A list of tuples, the positional arguments of each job
+# @parameter columns A list with the names of the arguments
+# @parameter manifestPath Full path to the manifest TSV to write
+# @parameter throttle Maximum number of tasks running at the same time (None for no limit)
+# @parameter sbatchArgs Extra sbatch options (e.g. "--cpus-per-task=4")
+# @parameter chunkSize Number of scans processed by each array task
+# @parameter secondsPerScan The expected processing time of one scan, used to raise the time limit of long chunks (None to keep it)
+# @return The number of arrays submitted
+def submitArray(jobScript, rows, columns, manifestPath, throttle=DEFAULT_THROTTLE, sbatchArgs="", chunkSize=1, secondsPerScan=None):
+    if not rows:
+        return 0
+
+    writeArrayManifest(rows, columns, manifestPath)
+
+    chunkSize = max(1, int(chunkSize))
+    numTasks = int(math.ceil(len(rows) / float(chunkSize)))
+    if secondsPerScan is not None and chunkSize > 1:
+        sbatchArgs = ('--time=' + str(getTimeLimit(chunkSize, secondsPerScan)) + ' ' + sbatchArgs).strip()
+
+    maxArraySize = getMaxArraySize()
+    numArrays = 0
+    # The offset is counted in tasks : task t of the array processes the rows of chunk (t + offset)
+    for offset in range(0, numTasks, maxArraySize):
+        arrayTasks = min(maxArraySize, numTasks - offset)
+        arraySpec = "0-" + str(arrayTasks - 1)
+        if throttle is not None and throttle > 0:
+            arraySpec += "%" + str(throttle)
+
+        cmd = 'sbatch --array=' + arraySpec + ' --export=ALL,ARRAY_OFFSET=' + str(offset) + ',CHUNK_SIZE=' + str(chunkSize)
+        cmd += ' --output=%x_%A_%a.out '
+        if sbatchArgs:
+            cmd += sbatchArgs + ' '
+        cmd += jobScript + ' ' + manifestPath
+        os.system(cmd)
+        numArrays += 1
+
+    print("Submitted", numArrays, "job array(s) of", numTasks, "task(s) for", len(rows), "scans (" + str(chunkSize), "per task), manifest :", manifestPath)
+
+    return numArrays
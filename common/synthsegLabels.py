@@ -0,0 +1,77 @@
+
+"""
+
+This script contains the SynthSeg label grouping shared by the PNG (png-generation/synthsegOverlay.py) and GIF 
+(gif-generation/singleScanGIFGenerator.py) overlay generators.
+
+The grouping is applied with an integer lookup table and `np.take`, so remapping a whole segmentation is a single 
+vectorized gather instead of one Python dictionary lookup per voxel.
+
+"""
+import nibabel
+import numpy as np
+
+# Grouping Synthseg output labels to ensure uniform colors for display
+SYNTHSEG_LABEL_GROUPS = {
+	0 : 0,
+	2 : 2, 41 : 2,
+	3 : 3, 42 : 3,
+	4 : 4, 5 : 4, 14 : 4, 15 : 4, 24 : 4, 43 : 4, 44 : 4, 
+	7 : 7, 46 : 7,
+	8 : 8, 47 : 8,
+	10 : 10, 11 : 10, 12 : 10, 13 : 10, 17 : 10, 18 : 10,
+	49 : 10, 50 : 10, 51 : 10, 52 : 10, 53 : 10, 54 : 10,
+	26 : 10, 28 : 10, 58 : 10, 60 : 10,
+	16 : 16,    
+}
+
+##
+# Build the lookup table mapping every SynthSeg label to its display group
+# @parameter maxLabel The largest label present in the segmentation
+# @parameter default_value The group of the labels that are not in SYNTHSEG_LABEL_GROUPS
+# @return A uint8 numpy array of size maxLabel+1 indexed by label
+def build_label_lut(maxLabel, default_value):
+	
+	lut = np.full(maxLabel + 1, default_value, dtype=np.uint8)
+	for label, group in SYNTHSEG_LABEL_GROUPS.items():
+		if label <= maxLabel:
+			lut[label] = group
+	
+	return lut
+
+##
+# Group the SynthSeg labels of a segmentation
+# @parameter seg_img The nibabel image of the segmentation
+# @parameter synthseg_data A numpy array with the segmentation labels
+# @return A tuple (uint8 numpy array of grouped labels, nibabel image of the grouped labels)
+def map_ss_labels(seg_img, synthseg_data):
+	
+	# Define a default value if a key is not found in the mapping
+	maxLabel = int(np.max(synthseg_data))
+	default_value = min(round(maxLabel/100), 255)
+	
+	# Labels are stored as integers, even when they were read as floats
+	if np.issubdtype(synthseg_data.dtype, np.integer):
+		labels = synthseg_data
+	else:
+		labels = np.rint(synthseg_data).astype(np.int32)
+	
+	# Apply mapping and default value with a single lookup table gather
+	lut = build_label_lut(max(maxLabel, 0), default_value)
+	mapped_data = np.take(lut, labels, mode='clip')
+	# Labels outside of the lookup table (negative, or rounded above maxLabel) get the default value, like labels missing from
+	# the mapping, instead of the entry at the edge of the table
+	mapped_data[(labels < 0) | (labels > len(lut) - 1)] = default_value
+	
+	# Save the modified image
+	modified_seg_img = nibabel.Nifti1Image(mapped_data, seg_img.affine)
+	
+	return mapped_data, modified_seg_img
+
+##
+# Count the distinct groups in a grouped segmentation (faster than np.unique for uint8 data)
+# @parameter mapped_data A uint8 numpy array as returned by map_ss_labels
+# @return The number of distinct groups
+def count_labels(mapped_data):
+	
+	return int(np.count_nonzero(np.bincount(mapped_data.ravel(), minlength=256)))
@@ -0,0 +1,143 @@
+
+"""
+
+This script contains the volume reading helpers shared by the PNG and GIF generators (used in full by their lazy `--lazy` rendering mode).
+
+Instead of `nibImg.get_fdata()`, which loads the whole scan as float64, the volume is kept in its native data type :
+	- uncompressed `.nii` scans are memory mapped, so only the planes that are actually touched are read from disk,
+	- `.nii.gz` scans cannot be memory mapped and are decompressed once into a native data type array (float32 for
+	  scans with a scaling in their header).
+Scans loaded in full (default mode) are read as float32 rather than float64, and segmentations in their native (integer) data
+type. The image handed to nilearn wraps the array that was read, so plotting does not read the file again for every slice.
+Slice selection then only needs one streaming pass over the planes of the volume (`scanVolumeStats`), which is also used 
+for in-memory volumes so that the tissue profiles of the three axes are computed together.
+
+The files are opened through niftiIO.py, so `.nii.gz` scans are read from their uncompressed (memory mapped) copy when the 
+scratch cache is enabled, and inflated with the fastest gzip backend available otherwise.
+
+"""
+import numpy as np
+
+import niftiIO
+
+##
+# Check whether a NIfTI file is gzip compressed
+# @parameter scanPath Full path to the .nii(.gz) scan
+# @return True for .nii.gz files
+def isCompressed(scanPath):
+    return scanPath.endswith(".gz")
+
+
+##
+# Load a scan without converting it to float64
+# @parameter scanPath Full path to the .nii(.gz) scan
+# @return A tuple (nibabel image, array-like volume supporting numpy slicing)
+def loadVolume(scanPath):
+    nibImg = niftiIO.loadNifti(scanPath, mmap="r")
+    dataobj = nibImg.dataobj
+
+    isUnscaled = (getattr(dataobj, "slope", 1.0) == 1.0) and (getattr(dataobj, "inter", 0.0) == 0.0)
+    if isUnscaled:
+        # Memory map for uncompressed scans, a single decompression in the native data type for .nii.gz
+        data = np.asanyarray(dataobj)
+    elif niftiIO.isMappable(nibImg):
+        # Scaled uncompressed scans : read and scale the slices on demand from the array proxy
+        data = dataobj
+    else:
+        # Scaled .nii.gz scans : the scaled values are not in the native data type, float32 (not float64) is enough
+        data = nibImg.get_fdata(dtype=np.float32)
+
+    return nibImg, data
+
+
+##
+# Wrap a volume that was read into an in-memory image with the geometry of its file
+# @parameter nibImg The nibabel image of the file
+# @parameter data The array read from it (array proxies of scaled scans are returned unchanged)
+# @return A nibabel image whose data is `data`
+def wrapLoaded(nibImg, data):
+    if not isinstance(data, np.ndarray):
+        return nibImg
+
+    # The header keeps the data type and scaling of the file, for the outputs written from this image
+    return nibImg.__class__(data, nibImg.affine, nibImg.header)
+
+
+##
+# Load a scan the way the generators render it
+# @parameter scanPath Full path to the .nii(.gz) scan
+# @parameter lazy True to keep the volume in its native data type (loadVolume), False to load it as float32
+# @return A tuple (nibabel image, volume)
+def loadScan(scanPath, lazy=False):
+    if lazy:
+        nibImg, data = loadVolume(scanPath)
+    else:
+        nibImg = niftiIO.loadNifti(scanPath)
+        data = nibImg.get_fdata(dtype=np.float32)
+
+    return wrapLoaded(nibImg, data), data
+
+
+##
+# Load a synthseg segmentation
+# @parameter segPath Full path to the segmentation nifti
+# @return A tuple (nibabel image, label volume in its native data type)
+def loadSegmentation(segPath):
+    segImg = niftiIO.loadNifti(segPath)
+    segData = np.asanyarray(segImg.dataobj)
+
+    return wrapLoaded(segImg, segData), segData
+
+
+##
+# Read a 2D slice of a volume
+# @parameter data An array-like volume as returned by loadVolume
+# @parameter axis The voxel axis that is cut
+# @parameter index The index of the slice along that axis
+# @return A 2D numpy array
+def readSlice(data, axis, index):
+    sliceIdx = [slice(None)] * 3
+    sliceIdx[axis] = int(index)
+
+    return np.asanyarray(data[tuple(sliceIdx)])
+
+
+##
+# Compute, in one pass over the planes of the last axis, the statistics needed to select and window slices
+# @parameter data An array-like volume as returned by loadVolume, or an in-memory numpy array
+# @return A dictionary with
+#	"lims" : a list of 3 (min, max) voxel bounds of the nonzero voxels for each axis (None if the volume is empty)
+#	"tissueFractions" : a list of 3 arrays with the fraction of nonzero voxels of every slice along each axis
+#	"vmin", "vmax" : the intensity range of the volume
+#	"background" : the median of the voxels at the border of the volume (2 voxels thick, same as nilearn's get_border_data)
+def scanVolumeStats(data):
+    n0, n1, n2 = data.shape[:3]
+    counts0 = np.zeros(n0, dtype=np.int64)
+    counts1 = np.zeros(n1, dtype=np.int64)
+    counts2 = np.zeros(n2, dtype=np.int64)
+    vmin = np.inf
+    vmax = -np.inf
+    border = []
+
+    for k in range(n2):
+        plane = readSlice(data, 2, k)
+        nonzero = plane != 0
+        counts0 += np.count_nonzero(nonzero, axis=1)
+        counts1 += np.count_nonzero(nonzero, axis=0)
+        counts2[k] = np.count_nonzero(nonzero)
+        vmin = min(vmin, float(np.nanmin(plane)))
+        vmax = max(vmax, float(np.nanmax(plane)))
+
+        # Border voxels of the two first and last axes, and the two first and last planes
+        border.extend([plane[:2, :].ravel(), plane[-2:, :].ravel(), plane[:, :2].ravel(), plane[:, -2:].ravel()])
+        if k < 2 or k >= n2 - 2:
+            border.append(plane.ravel())
+
+    lims = []
+    for counts in [counts0, counts1, counts2]:
+        nonzeroIdx = np.flatnonzero(counts)
+        lims.append((int(nonzeroIdx[0]), int(nonzeroIdx[-1])) if len(nonzeroIdx) else None)
+    tissueFractions = [counts0 / float(n1 * n2), counts1 / float(n0 * n2), counts2 / float(n0 * n1)]
+
+    return {"lims": lims, "tissueFractions": tissueFractions, "vmin": vmin, "vmax": vmax,
+            "background": float(np.nanmedian(np.concatenate(border)))}
@@ -0,0 +1,179 @@
+
+"""
+
+This script contains the read-ahead prefetcher of the chunked PNG and GIF rendering (array tasks processing several scans, see arrayTask.py).
+
+Reading a `.nii.gz` scan from the network filesystem and decompressing it leaves the CPU idle, and rendering leaves the
+filesystem idle. While the current scan renders, a background thread reads and decodes the next scans of the task (scan and
+segmentation), in order :
+	- at most `maxAhead` scans are kept ready,
+	- the volumes read ahead fit in a memory budget : the size of a scan is estimated from its header before it is read, and
+	  the thread waits for the renderer to consume the scans ahead when the next one would exceed the budget (a scan larger
+	  than the whole budget is still read once nothing else is ahead, so the task never stalls).
+Decompression (zlib) and file reads release the GIL, so the thread overlaps with rendering.
+
+"""
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+import nibabel
+
+import niftiIO
+import volumeIO
+
+# Default number of scans read ahead
+DEFAULT_PREFETCH = 2
+
+# Default memory budget of the scans read ahead, in MB
+DEFAULT_MEMORY_MB = 4096
+
+# A scan read ahead (segImg and segData are None for scans without a segmentation)
+PreloadedScan = namedtuple("PreloadedScan", ["nibImg", "img", "segImg", "segData"])
+
+##
+# Estimate the memory used by a scan and its segmentation once loaded, from their headers
+# @parameter scanPath Full path to the .nii(.gz) scan
+# @parameter segPath Full path to the segmentation nifti, or None
+# @parameter lazy True if the scan is kept in its native data type
+# @return The estimated size in bytes
+def estimateBytes(scanPath, segPath, lazy):
+    numBytes = 0
+    try:
+        header = nibabel.load(scanPath).header
+        itemSize = header.get_data_dtype().itemsize if lazy else 4
+        # Uncompressed scans (and the cached copies of compressed scans) are memory mapped in lazy mode
+        isMapped = not volumeIO.isCompressed(scanPath) or bool(os.environ.get(niftiIO.CACHE_ENV))
+        if not (lazy and isMapped):
+            numBytes += int(np.prod(header.get_data_shape())) * itemSize
+        if segPath is not None:
+            segHeader = nibabel.load(segPath).header
+            numBytes += int(np.prod(segHeader.get_data_shape())) * segHeader.get_data_dtype().itemsize
+    except Exception:
+        # Unreadable headers are reported when the scan itself is read
+        pass
+
+    return numBytes
+
+
+class VolumePrefetcher:
+    ##
+    # Start reading the scans ahead in a background thread
+    # @parameter scans A list of (scanPath, segPath or None, lazy) tuples, in the order they are rendered
+    # @parameter maxAhead Maximum number of scans kept ready
+    # @parameter memoryMb Memory budget of the scans kept ready, in MB
+    def __init__(self, scans, maxAhead=DEFAULT_PREFETCH, memoryMb=DEFAULT_MEMORY_MB):
+        self.scans = list(scans)
+        self.maxAhead = max(1, maxAhead)
+        self.memoryBudget = memoryMb * 1024 * 1024
+        self.planned = set(scanPath for scanPath, _, _ in self.scans)
+        # scanPath : (PreloadedScan or None, exception or None, size in bytes)
+        self.ready = {}
+        self.discarded = set()
+        self.usedBytes = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    ##
+    # Background thread : read the scans in order, within the limits
+    # @return None
+    def _run(self):
+        for scanPath, segPath, lazy in self.scans:
+            numBytes = estimateBytes(scanPath, segPath, lazy)
+            with self.cond:
+                while not self.closed and scanPath not in self.discarded and self.ready and \
+                        (len(self.ready) >= self.maxAhead or self.usedBytes + numBytes > self.memoryBudget):
+                    self.cond.wait()
+                if self.closed:
+                    return
+                if scanPath in self.discarded:
+                    continue
+                self.usedBytes += numBytes
+
+            preloaded, error = None, None
+            try:
+                nibImg, img = volumeIO.loadScan(scanPath, lazy)
+                segImg, segData = volumeIO.loadSegmentation(segPath) if segPath is not None else (None, None)
+                preloaded = PreloadedScan(nibImg, img, segImg, segData)
+            except Exception as e:
+                error = e
+
+            with self.cond:
+                self.ready[scanPath] = (preloaded, error, numBytes)
+                # A scan discarded while it was read is dropped right away
+                if scanPath in self.discarded:
+                    self._release(scanPath)
+                self.cond.notify_all()
+
+    ##
+    # Forget a scan read ahead and free its share of the budget (the condition must be held)
+    # @parameter scanPath Full path to the scan
+    # @return The (PreloadedScan or None, exception or None, size) entry of the scan
+    def _release(self, scanPath):
+        entry = self.ready.pop(scanPath)
+        self.usedBytes -= entry[2]
+
+        return entry
+
+    ##
+    # Wait for a scan to be read and take it
+    # @parameter scanPath Full path to the scan
+    # @return A PreloadedScan, or None if the scan is not one of the prefetched scans
+    def get(self, scanPath):
+        if scanPath not in self.planned:
+            return None
+
+        with self.cond:
+            while scanPath not in self.ready:
+                self.cond.wait()
+            preloaded, error, _ = self._release(scanPath)
+            self.planned.discard(scanPath)
+            self.cond.notify_all()
+
+        if error is not None:
+            raise error
+
+        return preloaded
+
+    ##
+    # Tell the prefetcher that a scan will not be rendered (e.g. it is up to date), so that it is not kept or read
+    # @parameter scanPath Full path to the scan
+    # @return None
+    def discard(self, scanPath):
+        with self.cond:
+            self.discarded.add(scanPath)
+            self.planned.discard(scanPath)
+            if scanPath in self.ready:
+                self._release(scanPath)
+            self.cond.notify_all()
+
+    ##
+    # Stop reading ahead
+    # @return None
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.ready.clear()
+
+
+##
+# Start reading ahead the scans of the rows of an array task (columns scan_path, seg_path if any, lazy)
+# @parameter rows A list of dictionaries {column : value}, in the order they are processed
+# @parameter maxAhead Maximum number of scans kept ready (0 to disable the prefetching)
+# @parameter memoryMb Memory budget of the scans kept ready, in MB
+# @return A VolumePrefetcher, or None if there is nothing to read ahead
+def prefetchTaskRows(rows, maxAhead=DEFAULT_PREFETCH, memoryMb=DEFAULT_MEMORY_MB):
+    if maxAhead < 1 or len(rows) < 2:
+        return None
+
+    scans = []
+    for row in rows:
+        segPath = row.get("seg_path")
+        scans.append((row["scan_path"], None if segPath in (None, "", "None") else segPath, row.get("lazy") == "True"))
+
+    return VolumePrefetcher(scans, maxAhead, memoryMb)
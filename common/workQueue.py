@@ -0,0 +1,337 @@
+
+"""
+
+This script contains the work queue on the shared filesystem used by the `slurm-queue` executor (see executors.py).
+
+Instead of one job (or array task) per scan, the driver writes one small JSON file per scan to the queue and submits a fixed
+number of long-running worker jobs. Each worker claims the next pending scan until the queue is empty, so workers that get
+small scans simply process more of them. The queue is a directory :
+	- `queue.json` : the columns of the items and the job script of the stage,
+	- `pending/` : scans waiting for a worker,
+	- `claimed/` : scans being processed. A worker claims a scan by renaming its file from `pending/` to `claimed/` under a
+	  name unique to the claim (the rename is atomic on a shared filesystem : only one worker can win it), and keeps its lease
+	  alive by touching the file,
+	- `done/` and `failed/` : processed scans (failed items record the error).
+A claimed scan whose file was not touched for longer than the lease (its worker crashed or was killed) is moved back to
+`pending/` by the next worker looking for work, or to `failed/` after MAX_ATTEMPTS attempts.
+
+The python stages (PNG, GIF and nibabel crop) run the worker loop in their own interpreter (`--queue`). For the shell stages,
+this script is the worker : it runs the job script of the stage with the arguments of every claimed scan.
+
+	Input arguments :
+	`queueDir` (required): Full path to the queue directory
+	`--status` (optional): Print the number of scans in each state of the queue and exit
+
+"""
+import os
+import sys
+import json
+import time
+import socket
+import uuid
+import argparse
+import threading
+import traceback
+import subprocess
+
+# States of a queue item (one sub-directory each)
+QUEUE_STATES = ["pending", "claimed", "done", "failed"]
+
+# A claimed scan whose file was not touched for this long is given back to the queue
+DEFAULT_LEASE_SECONDS = 600
+
+# Number of times a scan is claimed before it is considered failed (a scan that kills its worker must not kill them all)
+MAX_ATTEMPTS = 3
+
+# Time a worker waits for the leases of other workers when no scan is pending
+POLL_SECONDS = 30
+
+# Default number of worker jobs
+DEFAULT_WORKERS = 20
+
+##
+# Write a JSON file atomically, so that a worker never reads a truncated item
+# @parameter path Full path to the file
+# @parameter data A JSON serializable object
+# @return None
+def _writeJson(path, data):
+    # Temporary files start with a dot and are ignored by the workers
+    tmpPath = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+    with open(tmpPath, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmpPath, path)
+
+
+##
+# List the items of a state of the queue, oldest first
+# @parameter queueDir Full path to the queue directory
+# @parameter state One of QUEUE_STATES
+# @return A sorted list of item file names
+def listItems(queueDir, state):
+    try:
+        names = os.listdir(os.path.join(queueDir, state))
+    except FileNotFoundError:
+        return []
+
+    return sorted(name for name in names if name.endswith(".json") and not name.startswith("."))
+
+
+##
+# Add scans to a queue (created if needed)
+# @parameter queueDir Full path to the queue directory
+# @parameter names A list with the name of every scan (the scan IDs)
+# @parameter rows A list of tuples, the arguments of the job script for every scan
+# @parameter columns A list with the names of the arguments
+# @parameter jobScript The job script of the stage
+# @return The number of scans added
+def createQueue(queueDir, names, rows, columns, jobScript):
+    for state in QUEUE_STATES:
+        os.makedirs(os.path.join(queueDir, state), exist_ok=True)
+    _writeJson(os.path.join(queueDir, "queue.json"), {"columns": columns, "job_script": os.path.abspath(jobScript)})
+
+    # The enqueue time keeps the items of successive submissions in order and their names unique
+    prefix = str(int(time.time() * 1000))
+    for itemIdx, (name, row) in enumerate(zip(names, rows)):
+        item = {"name": name, "row": dict(zip(columns, [str(value) for value in row])), "attempts": 0}
+        _writeJson(os.path.join(queueDir, "pending", prefix + "_" + str(itemIdx).zfill(6) + "_" + name + ".json"), item)
+
+    return len(rows)
+
+
+##
+# Count the scans in each state of a queue
+# @parameter queueDir Full path to the queue directory
+# @return A dictionary {state : number of scans}
+def queueStatus(queueDir):
+    return {state: len(listItems(queueDir, state)) for state in QUEUE_STATES}
+
+
+##
+# Move an item between two states of the queue
+# @parameter queueDir Full path to the queue directory
+# @parameter src The state the item is in
+# @parameter srcName The item file name in src
+# @parameter dst The state to move it to
+# @parameter dstName The item file name in dst
+# @return True if this process moved the item (False if another worker moved it first)
+def _moveItem(queueDir, src, srcName, dst, dstName):
+    try:
+        os.rename(os.path.join(queueDir, src, srcName), os.path.join(queueDir, dst, dstName))
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+##
+# Name of an item in claimed/ : a claim token is added so that a worker can only reclaim the exact claim it found expired,
+# never a newer claim of the same scan
+# @parameter name The item file name in pending/
+# @return The file name of a new claim
+def _claimName(name):
+    return name[:-len(".json")] + "@" + uuid.uuid4().hex[:12] + ".json"
+
+
+##
+# Name of a claimed item once it leaves claimed/
+# @parameter claimName The item file name in claimed/
+# @return The item file name in pending/, done/ or failed/
+def _itemName(claimName):
+    return claimName[:-len(".json")].rsplit("@", 1)[0] + ".json"
+
+
+##
+# Give the expired leases back to the queue
+# @parameter queueDir Full path to the queue directory
+# @parameter leaseSeconds Time after which a claimed scan that was not touched is considered abandoned
+# @return The number of scans reclaimed
+def reclaimExpired(queueDir, leaseSeconds=DEFAULT_LEASE_SECONDS):
+    numReclaimed = 0
+    now = time.time()
+
+    for claimName in listItems(queueDir, "claimed"):
+        path = os.path.join(queueDir, "claimed", claimName)
+        try:
+            if now - os.stat(path).st_mtime < leaseSeconds:
+                continue
+            with open(path, "r") as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        if item.get("attempts", 0) >= MAX_ATTEMPTS:
+            if _moveItem(queueDir, "claimed", claimName, "failed", _itemName(claimName)):
+                print("!! Giving up on", item.get("name"), "after", item.get("attempts"), "attempts")
+        elif _moveItem(queueDir, "claimed", claimName, "pending", _itemName(claimName)):
+            print("Reclaimed the expired lease of", item.get("name"), "(worker :", str(item.get("worker")) + ")")
+            numReclaimed += 1
+
+    return numReclaimed
+
+
+##
+# Claim the next pending scan of a queue
+# @parameter queueDir Full path to the queue directory
+# @parameter workerID The name of the worker, recorded in the item
+# @parameter leaseSeconds The lease duration (expired leases are reclaimed first)
+# @return A tuple (item file name in claimed/, item) or None if no scan is pending
+def claimNext(queueDir, workerID, leaseSeconds=DEFAULT_LEASE_SECONDS):
+    reclaimExpired(queueDir, leaseSeconds)
+
+    for name in listItems(queueDir, "pending"):
+        pendingPath = os.path.join(queueDir, "pending", name)
+        # Touch the item before renaming it, so that it enters claimed/ with a fresh lease
+        try:
+            os.utime(pendingPath)
+        except FileNotFoundError:
+            continue
+        claimName = _claimName(name)
+        if not _moveItem(queueDir, "pending", name, "claimed", claimName):
+            continue
+
+        claimedPath = os.path.join(queueDir, "claimed", claimName)
+        with open(claimedPath, "r") as f:
+            item = json.load(f)
+        item["attempts"] = item.get("attempts", 0) + 1
+        item["worker"] = workerID
+        _writeJson(claimedPath, item)
+
+        return claimName, item
+
+    return None
+
+
+##
+# Keep the lease of a claimed scan alive until the scan is processed
+# @parameter path Full path to the claimed item
+# @parameter stopEvent A threading.Event set when the scan is processed
+# @parameter interval Time between two touches of the item
+# @return None
+def _heartbeat(path, stopEvent, interval):
+    while not stopEvent.wait(interval):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # The lease expired and the scan was given to another worker
+            print("!! Lost the lease of", path)
+            return
+
+
+##
+# Name of the current worker in the items it claims
+# @return A string host:pid (with the Slurm job and task IDs when run by Slurm)
+def getWorkerID():
+    workerID = socket.gethostname() + ":" + str(os.getpid())
+    if "SLURM_ARRAY_JOB_ID" in os.environ:
+        workerID += ":" + os.environ["SLURM_ARRAY_JOB_ID"] + "_" + os.environ.get("SLURM_ARRAY_TASK_ID", "")
+
+    return workerID
+
+
+##
+# Process scans from a queue until it is empty
+# @parameter queueDir Full path to the queue directory
+# @parameter processRow A function called with the row of each scan (a dictionary {column : value})
+# @parameter leaseSeconds The lease duration (default : QUEUE_LEASE_SECONDS from the environment, or DEFAULT_LEASE_SECONDS)
+# @parameter maxMinutes Stop claiming new scans after this many minutes (default : QUEUE_MAX_MINUTES from the environment, or no limit)
+# @return A list of (item name, error message) tuples for the scans that failed
+def runWorker(queueDir, processRow, leaseSeconds=None, maxMinutes=None):
+    if leaseSeconds is None:
+        leaseSeconds = float(os.environ.get("QUEUE_LEASE_SECONDS", DEFAULT_LEASE_SECONDS))
+    if maxMinutes is None and "QUEUE_MAX_MINUTES" in os.environ:
+        maxMinutes = float(os.environ["QUEUE_MAX_MINUTES"])
+    workerID = getWorkerID()
+    start = time.time()
+    numProcessed = 0
+    failures = []
+
+    while True:
+        if maxMinutes is not None and time.time() - start > maxMinutes * 60:
+            print("Stopping : the worker reached its time limit of", maxMinutes, "minutes")
+            break
+
+        claimed = claimNext(queueDir, workerID, leaseSeconds)
+        if claimed is None:
+            # Other workers may still crash and leave their scans to reclaim : wait for them before leaving
+            if not listItems(queueDir, "claimed"):
+                break
+            time.sleep(min(POLL_SECONDS, leaseSeconds))
+            continue
+
+        claimName, item = claimed
+        claimedPath = os.path.join(queueDir, "claimed", claimName)
+        stopEvent = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(claimedPath, stopEvent, leaseSeconds / 4.0), daemon=True)
+        heartbeat.start()
+
+        scanStart = time.time()
+        error = None
+        try:
+            processRow(item["row"])
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            stopEvent.set()
+            heartbeat.join()
+
+        if error is None:
+            item["duration"] = round(time.time() - scanStart, 1)
+            state = "done"
+        else:
+            item["error"] = error
+            failures.append((item["name"], error))
+            print("!! Failed : ", item["name"])
+            print(error)
+            state = "failed"
+        _writeJson(claimedPath, item)
+        if not _moveItem(queueDir, "claimed", claimName, state, _itemName(claimName)):
+            print("!! The lease of", item["name"], "expired while it was processed")
+
+        numProcessed += 1
+        print("Processed in", round(time.time() - scanStart, 1), "s :", item["name"])
+        sys.stdout.flush()
+
+    print(numProcessed - len(failures), "of", numProcessed, "scans processed by this worker")
+
+    return failures
+
+
+##
+# Process a scan of a shell stage by running the job script of the stage with the arguments of the scan
+# @parameter jobScript Full path to the job script
+# @parameter columns The names of the job script arguments
+# @parameter row The row of the scan (a dictionary {column : value})
+# @return None
+def runJobScript(jobScript, columns, row):
+    # Without the queue and array variables, the job script processes the single scan of its arguments
+    env = {name: value for name, value in os.environ.items() if name not in ("QUEUE_DIR", "SLURM_ARRAY_TASK_ID")}
+    subprocess.run(["bash", jobScript] + [row[column] for column in columns], env=env, check=True)
+
+
+##
+# Main function
+def main():
+    # --- Set up the argument parser ---
+    parser = argparse.ArgumentParser()
+    # Add an argument to get the queue directory --> Required!
+    parser.add_argument('queue_dir', help='Full path to the queue directory')
+    # Add an optional argument to only print the state of the queue
+    parser.add_argument('--status', help="Print the number of scans in each state of the queue and exit", action='store_true')
+
+    args = parser.parse_args()
+    queueDir = args.queue_dir
+
+    if args.status:
+        for state, count in queueStatus(queueDir).items():
+            print(state, ":", count)
+        return
+
+    with open(os.path.join(queueDir, "queue.json"), "r") as f:
+        config = json.load(f)
+    failures = runWorker(queueDir, lambda row: runJobScript(config["job_script"], config["columns"], row))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
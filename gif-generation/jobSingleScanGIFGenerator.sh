@@ -9,12 +9,31 @@
 INFN=$1      # file name
 OUTDIR=$2    # output directory for PNGs
 INDER=$3     # path to segmentation nifti
+LAZY=${4:-False}  # True to read the scan lazily in its native data type
+RENDERER=${5:-nilearn}  # renderer of the frames (nilearn or numpy)
+USE_HASH=${6:-False}  # True to record the sha256 of the scan in its render manifest
 
 # Set up conda
 source ${HOME}/miniconda3/etc/profile.d/conda.sh
 conda activate nilearn
 
-time python singleScanGIFGenerator.py -f $INFN -o $OUTDIR -d $INDER
+if [ "$LAZY" == "True" ]; then
+    LAZY_FLAG="--lazy"
+fi
+if [ "$USE_HASH" == "True" ]; then
+    HASH_FLAG="--hash"
+fi
+
+# A worker of a work queue (`--executor slurm-queue` in the driver) processes scans pulled from QUEUE_DIR until the queue is empty
+# In a job array (`--array` in the driver), the only argument is the array manifest : the CHUNK_SIZE scans of this task
+# (from row (SLURM_ARRAY_TASK_ID + ARRAY_OFFSET) * CHUNK_SIZE) are processed one after the other by the same python process
+if [ -n "$QUEUE_DIR" ]; then
+    time python singleScanGIFGenerator.py --queue $QUEUE_DIR
+elif [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+    time python singleScanGIFGenerator.py --array-manifest $1
+else
+    time python singleScanGIFGenerator.py -f $INFN -o $OUTDIR -d $INDER -r $RENDERER $LAZY_FLAG $HASH_FLAG
+fi
 
 # Done!
 echo "Job finished running!"
@@ -4,6 +4,18 @@ import sys
 import os
 import argparse
 import json
+import singleScanGIFGenerator
+
+# Shared modules live in the top-level `common` directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import renderManifest
+import bidsIndex
+import slurmArray
+import executors
+import niftiIO
+
+# Expected processing time (in seconds) of the GIFs of a scan, by renderer, used to size chunked array tasks
+SECONDS_PER_SCAN = {"nilearn": 300, "numpy": 30}
 
 ##
 # Main function
@@ -16,12 +28,56 @@ def main():
     parser.add_argument('-o', '--output-dir', help='Path to output directory for QC GIF storage', required = True)
     # Add an optional argument to get the derivatives directory for synthseg overlay PNGs --> Optional!
     parser.add_argument('-d', '--der-dir', help='Full path to the synthseg derivatives directory ')
+    # Add an optional argument to read the scans lazily in their native data type
+    parser.add_argument('-l', '--lazy', help="Read the scans lazily in their native data type (memory mapped for uncompressed .nii) instead of loading them as float32", action='store_true')
+    # Add an optional argument to select the renderer of the frames
+    parser.add_argument('-r', '--renderer', help="Renderer of the frames : nilearn (plot_roi, default) or numpy (alpha compositing, much faster)", choices=singleScanGIFGenerator.RENDERERS, default="nilearn")
+    # Add an optional argument to submit the scans that are up to date as well
+    parser.add_argument('--force', help="Submit every scan, even those that are up to date according to their render manifest", action='store_true')
+    # Add an optional argument to get the location of the cached BIDS scan index
+    parser.add_argument('--scan-index', help="Full path to the cached BIDS scan index (default : .<BIDS directory name>_scan_index.sqlite next to the BIDS directory)")
+    # Add an optional argument to list the BIDS tree again instead of trusting the scan index
+    parser.add_argument('--refresh-index', help="List every directory of the BIDS tree again instead of trusting the cached listings of the scan index", action='store_true')
+    # Add an optional argument to compare the contents of scans whose size or modification time changed
+    parser.add_argument('--hash', help="Record the contents (sha256) of the scans in their render manifests, and compare them for scans whose size or modification time changed before re-rendering them", action='store_true')
+    # Add an optional argument to submit a single Slurm job array instead of one job per scan
+    parser.add_argument('--array', help="Submit a single Slurm job array over a manifest of the scans instead of one job per scan", action='store_true')
+    # Add an optional argument to limit the number of array tasks running at the same time
+    parser.add_argument('--throttle', help="Maximum number of array tasks running at the same time (default : 50)", type=int, default=slurmArray.DEFAULT_THROTTLE)
+    # Add an optional argument to set the number of scans processed by each array task
+    parser.add_argument('--chunk-size', help="Number of scans processed by each array task, or auto to fit them in --target-minutes (default : 1)", default="1")
+    # Add an optional argument to set the target duration of an array task
+    parser.add_argument('--target-minutes', help="Target duration of an array task for --chunk-size auto (default : 40)", type=float, default=slurmArray.DEFAULT_TARGET_MINUTES)
+    # Add an optional argument to select how the jobs are run
+    parser.add_argument('--executor', help="How the jobs are run : slurm (one job per scan, default), slurm-array (same as --array), slurm-queue (worker jobs pulling the scans from a queue on the shared filesystem), local (pool of worker processes on this machine) or dry-run (print the sbatch commands)", choices=executors.EXECUTORS)
+    # Add an optional argument to set the number of worker processes of the local executor
+    parser.add_argument('-w', '--workers', help="Number of worker processes of the local executor (default : number of CPUs available) or of worker jobs of the slurm-queue executor (default : 20)", type=int)
+    # Add an optional argument to get the scratch directory where the uncompressed copies of the scans are cached. On Respublica, this could be : /scr1/users/<user>
+    parser.add_argument('-s', '--scratch-dir', help="Path to the scratch directory (same as runCrop.py / runAlignmentWithCrop.py) where uncompressed copies of the .nii.gz scans are cached and reused by the later stages")
+    # Add an optional argument to set the size limit of the cache
+    parser.add_argument('--cache-gb', help="Size limit of the cache of uncompressed scans in the scratch directory, in GB (default : 50)", type=float, default=niftiIO.DEFAULT_CACHE_GB)
  
     # Parse the arguments
     args = parser.parse_args()
     inDir = args.input_dir
     outBase = args.output_dir
     derivatives = args.der_dir
+    lazy = args.lazy
+    renderer = args.renderer
+    force = args.force
+    useHash = args.hash
+    scanIndex = args.scan_index
+    refreshIndex = args.refresh_index
+    arrayMode = args.array
+    throttle = args.throttle
+    chunkSize = args.chunk_size
+    targetMinutes = args.target_minutes
+    numWorkers = args.workers
+    # `--array` is kept as a shorthand for `--executor slurm-array`
+    executorName = args.executor or ("slurm-array" if arrayMode else "slurm")
+    scrDir = args.scratch_dir
+    cacheGb = args.cache_gb
+    numUpToDate = 0
 
     # If the output directory doesn't exist, create it
     if not os.path.exists(outBase):
@@ -36,43 +92,39 @@ def main():
         sys.exit(1)
 
     
-    # --- For all of the subjects in the input directory ---
-    # Get a list of subject IDs 
-    subIDs = [sub for sub in os.listdir(inDir) if "sub-" in sub]
-    
-    for subID in subIDs:
-        # Full path to subject directory
-        subPath = os.path.join(inDir, subID)
-        # List of sessions
-        sesIDs = [ses for ses in os.listdir(subPath) if "ses-" in ses]
+    # Cache the uncompressed copies of the scans in the scratch directory (the jobs inherit the setting through their environment)
+    if scrDir is not None:
+        print("Caching uncompressed scans in", niftiIO.enableCache(scrDir, cacheGb))
+    executor = executors.createExecutor(executorName, ["scan_path", "out_dir", "seg_path", "lazy", "renderer", "hash"],
+                                        os.path.join(outBase, "gif_array_manifest.tsv"), throttle,
+                                        slurmArray.resolveChunkSize(chunkSize, SECONDS_PER_SCAN[renderer], targetMinutes),
+                                        SECONDS_PER_SCAN[renderer], numWorkers, os.path.join(outBase, "gif_queue"))
+
+    # --- For every anat scan in the input directory (sub-*/ses-*/anat) ---
+    for scanRec in bidsIndex.findScans(inDir, derivatives, scanIndex, refresh=refreshIndex):
+        scanPath = scanRec.scanPath
+        scanID = scanRec.scanID
+        scanDer = scanRec.segPath
         
-        # --- For every session belonging to a single subject ---
-        for sesID in sesIDs:
-           sesPath = os.path.join(subPath, sesID)
-           anatPath = os.path.join(sesPath, "anat")
-           
-           # Check if session has anat folder
-           if not os.path.exists(anatPath):
-               continue
-           # Get the list of niftis in the anat folder
-           # TODO: generalize for more than MPR labeled scans
-           scans = [scan for scan in os.listdir(anatPath) if (".nii" in scan) and ("MPR" in scan)]
-          
-           # --- For every anat scan in that session for the subject ---
-           for scan in scans:
-               scanPath = os.path.join(anatPath, scan)
-               
-               scanID = scan.split(".nii")[0]
-               scanDer = os.path.join(derivatives, scanID, scanID+"_synthseg.nii.gz")
-               
-               if os.path.exists(scanDer):
-                   # Submit the job here
-                   cmd = 'sbatch jobSingleScanGIFGenerator.sh '
-                   cmd += scanPath + ' ' + outBase + ' ' + scanDer
-                   os.system(cmd)
-               else:
-                   print("Segmentation output does not exist for scan : ", scanID)
-               
+        if scanDer is not None:
+            # Only submit new or stale scans
+            if force:
+                renderManifest.removeManifest(os.path.join(outBase, scanID))
+            elif singleScanGIFGenerator.isScanUpToDate(scanPath, scanDer, outBase, useHash, renderer):
+                numUpToDate += 1
+                continue
+            # Submit the job here (locally, the frames of a scan are rendered by its worker : the scans are spread over the workers instead)
+            executor.submit(executors.Job(scanID, 'jobSingleScanGIFGenerator.sh', (scanPath, outBase, scanDer, lazy, renderer, useHash),
+                                          singleScanGIFGenerator.renderScan, (scanPath, outBase, scanDer, lazy, 1, renderer, False, None, useHash)))
+        else:
+            print("Segmentation output does not exist for scan : ", scanID)
+
+    print(numUpToDate, "scans are up to date and were not submitted")
+
+    # --- Submit the job array, or run the local jobs ---
+    failures = executor.finish()
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
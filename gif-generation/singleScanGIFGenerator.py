@@ -2,157 +2,41 @@ import subprocess as sb
 import os
 import glob
 import numpy as np
-import random
 import pandas as pd
 import sys
 import argparse
 import json
 import nibabel
 from nilearn import plotting, datasets, image
-from nilearn.image import coord_transform
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
 import imageio
 import matplotlib.colors as mcolors
+import multiprocessing
+import threading
 
-##
-# Select slices with step_size of 3  from the 25th to 75th percentile indices from one dimension of the brain
-# @parameter brainMin The lower bound of the brain in that dimension
-# @parameter brainMax The upper bound of the brain in that dimension
-# @return brainSliceIndices A list of selected slice indices
-def selectSliceIndices(brainMin, brainMax):
-
-    step_size = 3
-    slices = []
-    # Calculate the range
-    range_values = brainMax - brainMin
-    
-    # Calculate the values corresponding to the 25th and 75th percentiles
-    sliceBeg = brainMin + (range_values * 0.25)
-    sliceEnd = brainMin + (range_values * 0.75)
-    
-    # Convert values to indices
-    sliceBeg = int(sliceBeg)
-    sliceEnd = int(sliceEnd)
-    
-    for s in range(sliceBeg, sliceEnd+step_size, step_size):
-        slices.append(s)
-    
-    return slices
+# Shared modules live in the top-level `common` directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from synthsegLabels import map_ss_labels, count_labels
+import volumeIO
+import sliceSelection
+import renderManifest
+import sliceRasterizer
+import arrayTask
+import workQueue
+import volumePrefetch
 
+# Renderer settings recorded in the render manifest : a change in any of them makes the GIFs stale
+GIF_SETTINGS = {"stage": "gif", "fps": 3, "stepSize": 3}
 
-##
-# Check that the contents of an image slice is at least 10% tissue
-# @parameter brainSlice The numpy array containing the image data for a single slice
-# @return True or False based on the number of nonzero pixels in the slice
-def checkSliceHasTissue(brainSlice):
-    # Make sure at least 10% of the brainSlice is actually brain
-    totalPixels = len(brainSlice)*len(brainSlice[0])
-    nonzeroPixels = np.count_nonzero(brainSlice)
-    
-    if (nonzeroPixels >= 0.1*totalPixels):
-        return True
-    else:
-        return False
+# Renderers available for the GIF frames
+RENDERERS = ["nilearn", "numpy"]
 
+# Resolution of the frames of the numpy renderer
+FRAME_PIXELS_PER_MM = 2.0
 
-##
-# Pick a set of
-# @parameter img A numpy array of a 3D brain image
-# @return A list of 3 lists containing the selected slice indices for each of the 3 dimensions of the iamge
-def selectNewSliceCoordinates(img):
-    # Goal: identify volume of brain that's non-zero
-    # Get the upper and lower bounds of brain in each dimension
-    dim0Lims = np.where(img.any(axis=(1, 2)))[0]
-    dim1Lims = np.where(img.any(axis=(0, 2)))[0]
-    dim2Lims = np.where(img.any(axis=(0, 1)))[0]
-
-    # Get the min and max of each dimension
-    dim0MinBrain = sorted(set(dim0Lims))[0]
-    dim0MaxBrain = sorted(set(dim0Lims))[-1]
-    
-    dim1MinBrain = sorted(set(dim1Lims))[0]
-    dim1MaxBrain = sorted(set(dim1Lims))[-1]
-    
-    dim2MinBrain = sorted(set(dim2Lims))[0]
-    dim2MaxBrain = sorted(set(dim2Lims))[-1]
-
-    # Dimension 0
-    dim0Slices = selectSliceIndices(dim0MinBrain, dim0MaxBrain)
-    k = 1
-    # If the image does not consist of at least 10% tissue, regenerate
-    while not all([checkSliceHasTissue(img[i, :, :]) for i in dim0Slices]):
-        print("Regenerating dim0 slices")
-        # If reselecting the slices does not produce slices with >10% 
-        #  tissue content after 5 reselections, reduce the space
-        #  available for the slices to be selected from
-        if k % 5 == 0:
-            dim0MinBrain += 1
-            dim0MaxBrain -= 1
-        k += 1
-        dim0Slices = selectSliceIndices(dim0MinBrain, dim0MaxBrain)
-    
-    # Dimension 1
-    dim1Slices = selectSliceIndices(dim1MinBrain, dim1MaxBrain)
-    k = 1
-    # If the image does not consist of at least 10% tissue, regenerate
-    while not all([checkSliceHasTissue(img[:, i, :]) for i in dim1Slices]):
-        print("Regenerating dim1 slices")
-        # If reselecting the slices does not produce slices with >10% 
-        #  tissue content after 5 reselections, reduce the space
-        #  available for the slices to be selected from
-        if k % 5 == 0:
-            dim1MinBrain += 1
-            dim1MaxBrain -= 1
-        k += 1
-        dim1Slices = selectSliceIndices(dim1MinBrain, dim1MaxBrain)
-    
-    # Dimension 2
-    dim2Slices = selectSliceIndices(dim2MinBrain, dim2MaxBrain)
-    k = 1
-    # If the image does not consist of at least 10% tissue, regenerate
-    while not all([checkSliceHasTissue(img[:, :, i]) for i in dim2Slices]):
-        print("Regenerating dim2 slices")
-        # If reselecting the slices does not produce slices with >10% 
-        #  tissue content after 5 reselections, reduce the space
-        #  available for the slices to be selected from
-        if k % 5 == 0:
-            dim2MinBrain += 1
-            dim2MaxBrain -= 1
-        k += 1
-        dim2Slices = selectSliceIndices(dim2MinBrain, dim2MaxBrain)
-    
-    return [dim0Slices, dim1Slices, dim2Slices]
-    
-def map_ss_labels(segImg, segData):
-	
-    value_mapping = {
-    0.0 : 0.0,
-    2.0 : 2.0, 41.0 : 2.0,
-    3.0 : 3.0, 42.0 : 3.0,
-    4.0 : 4.0, 5.0 : 4.0, 14.0 : 4.0, 15.0 : 4.0, 24.0 : 4.0, 43.0 : 4.0, 44.0 : 4.0, 
-    7.0 : 7.0, 46.0 : 7.0,
-    8.0 : 8.0, 47.0 : 8.0,
-    10.0 : 10.0, 11.0 : 10.0, 12.0 : 10.0, 13.0 : 10.0, 17.0 : 10.0, 18.0 : 10.0,
-    49.0 : 10.0, 50.0 : 10.0, 51.0 : 10.0, 52.0 : 10.0, 53.0 : 10.0, 54.0 : 10.0,
-    26.0 : 10.0, 28.0 : 10.0, 58.0 : 10.0, 60.0 : 10.0,
-    16.0 : 16.0,    
-    }
-	
-    # Custom function to handle mapping and default value
-    def map_and_default(value):
-        return value_mapping.get(value, default_value)
-	
-    # Define a default value if a key is not found in the mapping
-    default_value = round(np.max(segData)/100,0)
-	
-    # Apply mapping and default value using NumPy vectorized operation
-    mappedData = np.vectorize(map_and_default)(segData)
-	
-    # Save the modified image
-    modified_segImg = nibabel.Nifti1Image(mappedData, segImg.affine)
-	
-    return mappedData, modified_segImg
+# FrameContext of the scan being rendered, inherited by the forked frame workers instead of being pickled for every frame
+_frameContext = None
 
 def get_cmap(mappedData):
 
@@ -168,30 +52,194 @@ def get_cmap(mappedData):
      ]
      
     # Define a custom colormap with unique colors for each label
-    num_labels = len(np.unique(mappedData))
+    num_labels = count_labels(mappedData)
     colors = all_colors[:num_labels]
     cmap = mcolors.ListedColormap(colors)
     
     return cmap
     
+##
+# Render one GIF frame (anatomical slice + synthseg overlay) with plot_roi into an in-memory RGB array
+# The figure is cropped to its tight bounding box, the same as `savefig(..., bbox_inches='tight')`, without writing it to disk
+# @parameter modified_segImg The nibabel image of the remapped segmentation
+# @parameter nibImg The nibabel image of the scan
+# @parameter cmap The overlay color map
+# @parameter display_mode The nilearn display mode ("x", "y" or "z")
+# @parameter cutCoord The world coordinate of the cut
+# @return A (height, width, 3) uint8 numpy array
+def renderRoiFrame(modified_segImg, nibImg, cmap, display_mode, cutCoord):
+    fig = plt.figure(figsize=(6, 6))
+    plotting.plot_roi(roi_img=modified_segImg, bg_img=nibImg, display_mode=display_mode, cut_coords=[cutCoord], draw_cross=False,\
+                 dim = -0.7, alpha = 0.4, cmap=cmap, figure = fig, annotate=False)
+    plt.axis('off')
+
+    # Draw the figure and read its pixels from the canvas
+    fig.canvas.draw()
+    frame = np.asarray(fig.canvas.buffer_rgba())
+
+    # Tight bounding box (in inches, with the default 0.1 inch padding of savefig), converted to pixels from the top left corner
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(0.1)
+    dpi = fig.dpi
+    height, width = frame.shape[:2]
+    x0 = int(round(bbox.x0 * dpi))
+    x1 = int(round(bbox.x1 * dpi))
+    y0 = height - int(round(bbox.y1 * dpi))
+    y1 = height - int(round(bbox.y0 * dpi))
+
+    # The padding can reach outside of the canvas : savefig fills it with the figure background color
+    facecolor = np.round(np.array(mcolors.to_rgb(fig.get_facecolor())) * 255).astype(np.uint8)
+    cropped = np.empty((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+    cropped[:] = facecolor
+    cropped[max(-y0, 0):min(height, y1) - y0, max(-x0, 0):min(width, x1) - x0] = \
+        frame[max(y0, 0):min(height, y1), max(x0, 0):min(width, x1), :3]
+
+    plt.close(fig)
+    return cropped
+
+##
+# Everything the frames of a scan are rendered from, prepared once per scan
+class FrameContext:
+
+    ##
+    # @parameter nibImg The nibabel image of the scan
+    # @parameter img The image data of the scan (numpy array or lazily read volume)
+    # @parameter modified_segImg The nibabel image of the remapped segmentation
+    # @parameter mappedData The remapped segmentation labels
+    # @parameter cmap The overlay color map
+    # @parameter renderer "nilearn" (plot_roi) or "numpy" (alpha compositing)
+    # @parameter volumeStats The statistics of the scan as returned by volumeIO.scanVolumeStats
+    def __init__(self, nibImg, img, modified_segImg, mappedData, cmap, renderer, volumeStats):
+        self.nibImg = nibImg
+        self.modified_segImg = modified_segImg
+        self.cmap = cmap
+        self.renderer = renderer
+
+        if renderer == "numpy":
+            self.img = img
+            # Same dimming of the background as plot_roi(dim=-0.7)
+            self.anatWindow = sliceRasterizer.getAnatWindowFromStats(volumeStats["vmin"], volumeStats["vmax"], volumeStats["background"], dim=-0.7)
+
+            # Labels on the voxel grid of the scan, resampled once if the segmentation has its own grid
+            if modified_segImg.shape[:3] == nibImg.shape[:3] and np.allclose(modified_segImg.affine, nibImg.affine):
+                self.labelData = mappedData
+            else:
+                resampledSeg = image.resample_to_img(modified_segImg, nibImg, interpolation="nearest")
+                self.labelData = np.rint(np.asanyarray(resampledSeg.dataobj)).astype(np.uint8)
+
+##
+# Render one GIF frame with the renderer of the frame context
+# @parameter frameCtx The FrameContext of the scan
+# @parameter display_mode The nilearn display mode ("x", "y" or "z")
+# @parameter cutCoord The world coordinate of the cut
+# @return A (height, width, 3) uint8 numpy array
+def renderFrame(frameCtx, display_mode, cutCoord):
+    if frameCtx.renderer == "numpy":
+        return sliceRasterizer.compositeOverlaySlice(frameCtx.img, frameCtx.labelData, frameCtx.nibImg.affine, display_mode, cutCoord,
+                                                     frameCtx.anatWindow, frameCtx.cmap, alpha=0.4, pixelsPerMm=FRAME_PIXELS_PER_MM)
+
+    return renderRoiFrame(frameCtx.modified_segImg, frameCtx.nibImg, frameCtx.cmap, display_mode, cutCoord)
+
+##
+# Render the frames of one axis and write them to a GIF
+# @parameter frameCtx The FrameContext of the scan
+# @parameter display_mode The nilearn display mode ("x", "y" or "z")
+# @parameter cutCoords The world coordinates of the frames, in order
+# @parameter outGIF Full path to the GIF file to write
+# @return None
+def generateAxisGif(frameCtx, display_mode, cutCoords, outGIF):
+    frames = [renderFrame(frameCtx, display_mode, cutCoord) for cutCoord in cutCoords]
+    imageio.mimsave(outGIF, frames, fps=GIF_SETTINGS["fps"])
+
+##
+# Worker function : render one frame of the scan shared through _frameContext
+# @parameter job A tuple (display_mode, cutCoord)
+# @return A (height, width, 3) uint8 numpy array
+def _renderFrameJob(job):
+    display_mode, cutCoord = job
+
+    return renderFrame(_frameContext, display_mode, cutCoord)
+
+##
+# Worker initializer : receive the frame context when the workers are not forked from the process that loaded the scan
+# @parameter frameCtx The FrameContext of the scan
+# @return None
+def _initFrameWorker(frameCtx):
+    global _frameContext
+
+    _frameContext = frameCtx
+
+##
+# Number of CPUs this process is allowed to run on (respects the Slurm allocation)
+# @return The number of usable CPUs
+def getAvailableCpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+##
+# Render the frames of all axes and write one GIF per axis
+# With more than one worker, the frames of the three axes are spread over a pool of forked processes that share the loaded
+# scan and segmentation; the frames are collected back in slice order before each GIF is written.
+# Forking is unsafe while other threads run (the prefetcher of an array task, the lease heartbeat of a queue worker) : the
+# workers are then started from a fork server instead, and receive a copy of the frame context
+# @parameter frameCtx The FrameContext of the scan
+# @parameter axisGifs A list of (display_mode, cutCoords, outGIF) tuples, one per GIF
+# @parameter numWorkers Number of worker processes, all available CPUs if None
+# @return None
+def generateGifs(frameCtx, axisGifs, numWorkers=None):
+    global _frameContext
+
+    if numWorkers is None or numWorkers < 1:
+        numWorkers = getAvailableCpus()
+    jobs = [(display_mode, cutCoord) for display_mode, cutCoords, _ in axisGifs for cutCoord in cutCoords]
+    numWorkers = min(numWorkers, max(len(jobs), 1))
+
+    if numWorkers == 1:
+        for display_mode, cutCoords, outGIF in axisGifs:
+            generateAxisGif(frameCtx, display_mode, cutCoords, outGIF)
+        return
+
+    print("Rendering", len(jobs), "frames with", numWorkers, "worker(s)")
+    if threading.active_count() > 1:
+        pool = multiprocessing.get_context("forkserver").Pool(processes=numWorkers, initializer=_initFrameWorker, initargs=(frameCtx,))
+    else:
+        _frameContext = frameCtx
+        pool = multiprocessing.get_context("fork").Pool(processes=numWorkers)
+    try:
+        with pool:
+            # map keeps the order of the jobs, so the frames come back in slice order
+            frames = pool.map(_renderFrameJob, jobs, chunksize=1)
+    finally:
+        _frameContext = None
+
+    start = 0
+    for display_mode, cutCoords, outGIF in axisGifs:
+        imageio.mimsave(outGIF, frames[start:start + len(cutCoords)], fps=GIF_SETTINGS["fps"])
+        start += len(cutCoords)
+
 ## 
 # Use the nibabel library to generate a set of PNGs from a brain scan
 # @parameter scanFn A string representing the full path to a scan
 # @parameter subject A string of the subject's identifier
 # @parameter outputDir A string specifying the directory to save the PNGs to
-# @return None
-def generateGIFsSingleScanNibabel(scanPath, segPath, scanID, outBase):
+# @parameter numWorkers Number of processes rendering the frames, all available CPUs if None
+# @parameter renderer "nilearn" (plot_roi) or "numpy" (alpha compositing)
+# @parameter preloaded The scan and segmentation already read by a volumePrefetch.VolumePrefetcher, or None to read them here
+# @return A list with the full paths of the 3 GIFs
+def generateGIFsSingleScanNibabel(scanPath, segPath, scanID, outBase, lazy=False, numWorkers=None, renderer="nilearn", preloaded=None):
 
 
-    # Load the masked brain image
-    nibImg = nibabel.load(scanPath)
-    img = nibImg.get_fdata()
+    # Load the masked brain image and the segmentation
+    if preloaded is not None:
+        nibImg, img = preloaded.nibImg, preloaded.img
+        segImg, segData = preloaded.segImg, preloaded.segData
+    else:
+        # With lazy, the native data type volume : slice selection only streams over its planes
+        nibImg, img = volumeIO.loadScan(scanPath, lazy)
+        segImg, segData = volumeIO.loadSegmentation(segPath)
     aff = nibImg.affine
     
-    # Load the segmentation
-    segImg = nibabel.load(segPath)
-    segData = segImg.get_fdata()
-    
     # Map labels to make it easier for custom color map
     mappedData, modified_segImg = map_ss_labels(segImg, segData)
     
@@ -199,154 +247,149 @@ def generateGIFsSingleScanNibabel(scanPath, segPath, scanID, outBase):
     cmap = get_cmap(mappedData)
     
     # Select slices to make GIFs
-    brainSlices = selectNewSliceCoordinates(img)
-    
-    # ---------- Dim0 ----------
-    # Create a directory to temporarily store PNGs that will be used to create the GIF
-    outImages_y = os.path.join(outBase, "images_y")
-    if not os.path.exists(outImages_y):
-    	os.makedirs(outImages_y)
-    	
-    # List of image files for each slice along Dim0
-    images_y = []
+    # One pass over the volume gives the tissue profiles of the three dimensions
+    volumeStats = volumeIO.scanVolumeStats(img)
+    brainSlices = sliceSelection.selectGifSlices(volumeStats, GIF_SETTINGS["stepSize"])
+
+    # World coordinates of the selected slices
+    worldCoords = [sliceSelection.sliceWorldCoords(brainSlices[axis], axis, aff) for axis in range(3)]
     
     # Dim0 in pixel space corresponds to coronal view (dim1) in MNI space
-    for dim0Slice in brainSlices[0]:
-        newSlice = coord_transform(dim0Slice, 0, 0, aff)
-        newFn = os.path.join(outImages_y, f'slice_{newSlice[1]}_y.png')
-        fig = plt.figure(figsize=(6, 6))
-        plotting.plot_roi(roi_img=modified_segImg, bg_img=nibImg,display_mode="y", cut_coords=[newSlice[1]], draw_cross=False,\
-                     dim = -0.7, alpha = 0.4, cmap=cmap, figure = fig, annotate=False)
-        
-        plt.axis('off')
-    
-        # Save current frame as image
-        plt.savefig(newFn, bbox_inches='tight')
-
-        # Append image to list of frames
-        images_y.append(newFn)
-        plt.close('all')  # Close all figures after saving
-        
-    # Create GIF
     outGIF_y = os.path.join(outBase, scanID+"_dim0.gif")
-    imageio.mimsave(outGIF_y, [imageio.imread(img) for img in images_y], fps=3)
-    
-    # Check if the GIF file was created successfully
-    if os.path.exists(outGIF_y):
-        # Remove the PNG files if the GIF was created successfully
-        rm_cmd = "rm -rf " + outImages_y
-        os.system(rm_cmd)
-    else:
-        print("Failed to create Dim0 GIF file for ", scanID, ". PNG files are not removed.")
-    
-    # ---------- ---- ----------
-    
-    # ---------- Dim1 ----------
-    # Create a directory to temporarily store PNGs that will be used to create the GIF
-    outImages_z = os.path.join(outBase, "images_z")
-    if not os.path.exists(outImages_z):
-    	os.makedirs(outImages_z)
-    	
-    # List of image files for each slice along Dim0
-    images_z = []
- 
     # Dim1 in pixel space corresponds to dim2 in MNI space
-    for dim1Slice in brainSlices[1]:
-        newSlice = coord_transform(0, dim1Slice, 0, aff)
-        newFn = os.path.join(outImages_z, f'slice_{newSlice[2]}_z.png')
-        fig = plt.figure(figsize=(6, 6))
-        plotting.plot_roi(roi_img=modified_segImg, bg_img=nibImg,display_mode="z", cut_coords=[newSlice[2]], draw_cross=False,\
-                     dim = -0.7, alpha = 0.4, cmap=cmap, figure = fig, annotate=False)
-        
-        plt.axis('off')
-    
-        # Save current frame as image
-        plt.savefig(newFn, bbox_inches='tight')
-
-        # Append image to list of frames
-        images_z.append(newFn)
-        plt.close('all')  # Close all figures after saving
-        
-    # Create GIF
     outGIF_z = os.path.join(outBase, scanID+"_dim1.gif")
-    imageio.mimsave(outGIF_z, [imageio.imread(img) for img in images_z], fps=3)
-    
-    # Check if the GIF file was created successfully
-    if os.path.exists(outGIF_z):
-        # Remove the PNG files if the GIF was created successfully
-        rm_cmd = "rm -rf " + outImages_z
-        os.system(rm_cmd)
-    else:
-        print("Failed to create Dim1 GIF file for ", scanID, ". PNG files are not removed.")
-    
-    # ---------- ---- ----------
-    
-    # ---------- Dim2 ----------
-    # Create a directory to temporarily store PNGs that will be used to create the GIF
-    outImages_x = os.path.join(outBase, "images_x")
-    if not os.path.exists(outImages_x):
-    	os.makedirs(outImages_x)
-    	
-    # List of image files for each slice along Dim0
-    images_x = []
-
     # Dim2 in pixel space corresponds to dim0 in MNI space
-    for dim2Slice in brainSlices[2]:
-        newSlice = coord_transform(0, 0, dim2Slice, aff)
-        newFn = os.path.join(outImages_x, f'slice_{newSlice[0]}_x.png')
-        fig = plt.figure(figsize=(6, 6))
-        plotting.plot_roi(roi_img=modified_segImg, bg_img=nibImg,display_mode="x", cut_coords=[newSlice[0]], draw_cross=False,\
-                     dim = -0.7, alpha = 0.4, cmap=cmap, figure = fig, annotate=False)
-                     
-        plt.axis('off')
-        
-        # Save current frame as image
-        plt.savefig(newFn, bbox_inches='tight')
-
-        # Append image to list of frames
-        images_x.append(newFn)
-        plt.close('all')  # Close all figures after saving
-        
-    # Create GIF
     outGIF_x = os.path.join(outBase, scanID+"_dim2.gif")
-    imageio.mimsave(outGIF_x, [imageio.imread(img) for img in images_x], fps=3)
-    
-    # Check if the GIF file was created successfully
-    if os.path.exists(outGIF_x):
-        # Remove the PNG files if the GIF was created successfully
-        rm_cmd = "rm -rf " + outImages_x
-        os.system(rm_cmd)
-    else:
-        print("Failed to create Dim2 GIF file for ", scanID, ". PNG files are not removed.")
-    
-    # ---------- ---- ----------
+
+    axisGifs = [("y", worldCoords[0][:, 1], outGIF_y), ("z", worldCoords[1][:, 2], outGIF_z), ("x", worldCoords[2][:, 0], outGIF_x)]
+    frameCtx = FrameContext(nibImg, img, modified_segImg, mappedData, cmap, renderer, volumeStats)
+    generateGifs(frameCtx, axisGifs, numWorkers)
 
     print("GIFs generated for", scanID)
 
+    return [outGIF_y, outGIF_z, outGIF_x]
+
+##
+# Renderer settings recorded in the render manifest
+# @parameter renderer "nilearn" or "numpy"
+# @return A dictionary of settings
+def gifSettings(renderer="nilearn"):
+    return dict(GIF_SETTINGS, renderer=renderer)
+
+##
+# Check whether the GIFs of a scan are up to date according to its render manifest
+# @parameter scanPath A string representing the full path to a scan
+# @parameter segPath A string representing the full path to the synthseg segmentation
+# @parameter outBase A string specifying the base directory of the GIFs
+# @parameter useHash True to compare the scan contents when its size or modification time changed
+# @parameter renderer "nilearn" or "numpy"
+# @return True if the scan does not need to be rendered again
+def isScanUpToDate(scanPath, segPath, outBase, useHash=False, renderer="nilearn"):
+    scanID = scanPath.split("/")[-1].split(".nii")[0]
+    inputs = {"scan": scanPath, "seg": segPath}
+
+    return renderManifest.isUpToDate(os.path.join(outBase, scanID), inputs, gifSettings(renderer), useHash)
+
+##
+# Render the GIFs of a scan unless they are up to date, and record them in its render manifest
+# @parameter scanPath A string representing the full path to a scan
+# @parameter outBase A string specifying the base directory of the GIFs
+# @parameter segPath A string representing the full path to the synthseg segmentation
+# @parameter lazy True to read the scan lazily in its native data type
+# @parameter numWorkers The number of processes rendering the frames (None for the CPUs available to the job)
+# @parameter renderer "nilearn" or "numpy"
+# @parameter force True to render the scan even if its GIFs are up to date
+# @parameter prefetcher A volumePrefetch.VolumePrefetcher reading this scan ahead, or None
+# @parameter useHash True to record the sha256 of the inputs (and compare it when their size or modification time changed)
+# @return None
+def renderScan(scanPath, outBase, segPath, lazy=False, numWorkers=None, renderer="nilearn", force=False, prefetcher=None, useHash=False):
+    scanID = scanPath.split("/")[-1].split(".nii")[0]
+    # Make the output directory if it doesn't exist
+    outDir = os.path.join(outBase, scanID)
+    if not os.path.exists(outDir):
+        os.makedirs(outDir)
+
+    if not force and isScanUpToDate(scanPath, segPath, outBase, useHash, renderer):
+        print("GIFs are up to date for", scanID)
+        if prefetcher is not None:
+            prefetcher.discard(scanPath)
+        return
+
+    renderManifest.removeManifest(outDir)
+    preloaded = prefetcher.get(scanPath) if prefetcher is not None else None
+    outputs = generateGIFsSingleScanNibabel(scanPath, segPath, scanID, outDir, lazy, numWorkers, renderer, preloaded)
+    renderManifest.writeManifest(outDir, {"scan": scanPath, "seg": segPath}, gifSettings(renderer), outputs, useHash)
+
+##
+# Render the scan of one row of an array manifest (columns : scan_path, out_dir, seg_path, lazy, renderer, hash)
+# @parameter row A dictionary {column : value}
+# @parameter prefetcher A volumePrefetch.VolumePrefetcher reading the scans of the rows ahead, or None
+# @return None
+def renderArrayRow(row, prefetcher=None):
+    try:
+        renderScan(row["scan_path"], row["out_dir"], arrayTask.parsePath(row["seg_path"]), arrayTask.parseBool(row["lazy"]),
+                   renderer=row["renderer"], prefetcher=prefetcher, useHash=arrayTask.parseBool(row.get("hash")))
+    finally:
+        # A scan that failed before it was taken must not hold the budget of the scans read ahead
+        if prefetcher is not None:
+            prefetcher.discard(row["scan_path"])
+
 ##
 # Main function
 def main():
     # --- Set up the argument parser ---
     parser = argparse.ArgumentParser()
-    # Add an argument to get the scan to generate PNGs from --> Required!
-    parser.add_argument('-f', '--scan-fn', help='Full path to the .nii(.gz) scan', required = True)
-    # Add an argument to get the directory where the QC PNGs will be written --> Required!
-    parser.add_argument('-o', '--out-dir', help='Full path to the directory where the PNG files should be written to', required = True)
+    # Add an argument to get the scan to generate PNGs from --> Required (unless --array-manifest or --queue is given)!
+    parser.add_argument('-f', '--scan-fn', help='Full path to the .nii(.gz) scan')
+    # Add an argument to get the directory where the QC PNGs will be written --> Required (unless --array-manifest or --queue is given)!
+    parser.add_argument('-o', '--out-dir', help='Full path to the directory where the PNG files should be written to')
     # Add an optional argument to get the derivatives directory for synthseg overlay PNGs --> Optional!
     parser.add_argument('-d', '--der-fn', help='Full path to the synthseg segmentation nifti ')
+    # Add an optional argument to read the scan lazily in its native data type
+    parser.add_argument('-l', '--lazy', help="Read the scan lazily in its native data type (memory mapped for uncompressed .nii) instead of loading it as float32", action='store_true')
+    # Add an optional argument to render the scan even if its GIFs are up to date
+    parser.add_argument('--force', help="Render the scan even if its render manifest says the GIFs are up to date", action='store_true')
+    # Add an optional argument to record the content hash of the scan in its render manifest
+    parser.add_argument('--hash', help="Record the sha256 of the scan in its render manifest, and compare it when the size or modification time changed", action='store_true')
+    # Add an optional argument to set the number of processes rendering the frames
+    parser.add_argument('-j', '--jobs', help="Number of processes rendering the frames (default : number of CPUs available to the job)", type=int)
+    # Add an optional argument to select the renderer of the frames
+    parser.add_argument('-r', '--renderer', help="Renderer of the frames : nilearn (plot_roi, default) or numpy (alpha compositing, much faster)", choices=RENDERERS, default="nilearn")
+    # Add an optional argument to render the scans of a Slurm array task
+    parser.add_argument('--array-manifest', help="Render the scans of the current Slurm array task from this manifest instead of -f/-o")
+    # Add an optional argument to render scans pulled from a work queue
+    parser.add_argument('--queue', help="Render the scans of this work queue (written by the slurm-queue executor) until it is empty, instead of -f/-o")
+    # Add an optional argument to set the number of scans of an array task read ahead
+    parser.add_argument('--prefetch', help="Number of scans of an array task read ahead while the current scan renders (default : 2, 0 to disable)", type=int, default=volumePrefetch.DEFAULT_PREFETCH)
+    # Add an optional argument to set the memory budget of the scans read ahead
+    parser.add_argument('--prefetch-memory', help="Memory budget of the scans read ahead, in MB (default : 4096)", type=int, default=volumePrefetch.DEFAULT_MEMORY_MB)
 
     args = parser.parse_args()
-    scanPath = args.scan_fn
-    outBase = args.out_dir
-    segPath = args.der_fn
 
-    scanID = scanPath.split("/")[-1].split(".nii")[0]
-    # Make the output directory if it doesn't exist
-    outDir = os.path.join(outBase, scanID)
-    if not os.path.exists(outDir):
-        os.makedirs(outDir)
-                   
-    generateGIFsSingleScanNibabel(scanPath, segPath, scanID, outDir)
+    # --- Array task : render every scan of the task in this interpreter ---
+    if args.array_manifest is not None:
+        # The next scans of the task are read while the current one renders
+        prefetcher = volumePrefetch.prefetchTaskRows(arrayTask.readTaskRows(args.array_manifest), args.prefetch, args.prefetch_memory)
+        try:
+            failures = arrayTask.runTaskRows(args.array_manifest, lambda row: renderArrayRow(row, prefetcher))
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+        if failures:
+            sys.exit(1)
+        return
+
+    # --- Queue worker : render scans pulled from the queue until it is empty ---
+    if args.queue is not None:
+        failures = workQueue.runWorker(args.queue, renderArrayRow)
+        if failures:
+            sys.exit(1)
+        return
+
+    if args.scan_fn is None or args.out_dir is None:
+        parser.error("the following arguments are required: -f/--scan-fn, -o/--out-dir")
+
+    renderScan(args.scan_fn, args.out_dir, args.der_fn, args.lazy, args.jobs, args.renderer, args.force, useHash=args.hash)
 
 
 if __name__ == "__main__":
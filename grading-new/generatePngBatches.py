@@ -9,6 +9,7 @@ This script divides the input PNGs into ~15 minute batches that will be used by
 	`-p` : Path to the participants.tsv file
 	`-u` : Units of age (accepted values : m, d, y)
 	`-o` : Path to the output base directory where the 'qc_files' or 'qc_files_synthseg' directory, containing grading-related files, will be output
+	`-a` : Append mode : keep the batches of the scans already listed in scan_batch_info.tsv and only batch the new scans
 	
 	
 	Outputs
@@ -16,11 +17,19 @@ This script divides the input PNGs into ~15 minute batches that will be used by
 	1. scan_batch_info.tsv : TSV file containing columns ["scan_name", "age_bin_num", "batch_num", "full_path"] 
 	2. batch_{batch_num}.tsv : TSV files for each batch containing ["scan_name", "png_name", "age_bin_num", "batch_num", "full_path"]. (Lists the PNGs for every scan in each batch)
 	3. registered_graders.csv : Empty CSV file to register and store graders' names.
+	
+	In append mode, the new scans are packed into new batches (per age bin) numbered after the existing ones, their rows are appended to
+	scan_batch_info.tsv, and the new batch files are copied to the directory of every registered grader, so that graded batches are never
+	renumbered or rewritten.
+	
+	Scans whose session is missing from participants.tsv, has no numeric age or is listed with conflicting ages are reported
+	together and left out of the batches.
 
 """
 
 
 import os
+import csv
 import shutil
 import random
 import numpy as np
@@ -39,21 +48,43 @@ def check_col_names(partDf):
 	else :
 		return
 	
-# Get age in months from participants.tsv for a particular scan
-def get_age(scanName, partDf, ageUnits):
+# Get age in months from participants.tsv for every scan, with a single merge on (subject_id, session_id)
+# Returns a dataframe with columns ["scan_name", "age"] (age is NaN when it could not be found) and a dataframe of the
+# scans whose age is missing or ambiguous, with a "reason" column
+def get_ages(scanNames, partDf, ageUnits):
 	
-	nameSplit = scanName.split("_")
-	subject_id = nameSplit[0]
-	session_id = nameSplit[1]
+	# Subject and session IDs are the first two entities of the scan names
+	scanDf = pd.DataFrame({"scan_name": scanNames})
+	nameSplit = scanDf["scan_name"].str.split("_", n=2, expand=True).reindex(columns=[0, 1])
+	scanDf["subject_id"] = nameSplit[0]
+	scanDf["session_id"] = nameSplit[1]
 	
-	partAge = partDf[(partDf["subject_id"] == subject_id) & (partDf["session_id"] == session_id)]["age_at_scan"].to_string(index=False)
-	partAge = float(partAge)
+	ageDf = partDf[["subject_id", "session_id", "age_at_scan"]].copy()
+	ageDf["subject_id"] = ageDf["subject_id"].astype(str)
+	ageDf["session_id"] = ageDf["session_id"].astype(str)
+	ageDf["age"] = pd.to_numeric(ageDf["age_at_scan"], errors="coerce")
 	
-	if ageUnits == "m":
-		return partAge
-		
-	else:
-		return convert_age_to_months(partAge, ageUnits)
+	# Sessions listed more than once are only ambiguous if their ages disagree
+	ageDf = ageDf.drop_duplicates(subset=["subject_id", "session_id", "age"])
+	isDuplicate = ageDf.duplicated(subset=["subject_id", "session_id"], keep=False)
+	duplicateDf = ageDf[isDuplicate].groupby(["subject_id", "session_id"])["age_at_scan"]\
+	.agg(lambda ages: ", ".join(str(age) for age in ages)).reset_index(name="conflicting_ages")
+	ageDf = ageDf[~isDuplicate]
+	
+	scanDf = scanDf.merge(ageDf[["subject_id", "session_id", "age"]], on=["subject_id", "session_id"], how="left")
+	scanDf = scanDf.merge(duplicateDf, on=["subject_id", "session_id"], how="left")
+	
+	if ageUnits != "m":
+		scanDf["age"] = convert_age_to_months(scanDf["age"], ageUnits)
+	
+	# Report every scan without a usable age at once
+	scanDf["reason"] = None
+	scanDf.loc[scanDf["age"].isna(), "reason"] = "no numeric age_at_scan in participants.tsv"
+	isConflict = scanDf["conflicting_ages"].notna()
+	scanDf.loc[isConflict, "reason"] = "conflicting ages in participants.tsv : " + scanDf.loc[isConflict, "conflicting_ages"].astype(str)
+	missingDf = scanDf.loc[scanDf["reason"].notna(), ["scan_name", "subject_id", "session_id", "reason"]]
+	
+	return scanDf[["scan_name", "age"]], missingDf
 
 # Convert age from days/years to months	
 def convert_age_to_months(age, ageUnits):
@@ -64,36 +95,79 @@ def convert_age_to_months(age, ageUnits):
 	elif ageUnits == "y":
 		return age * 12
 
-# Get bin number for a given age
-def get_age_bin_num(age):
-	
-	# 0-1 month : bin number 1
-	# 1-6 months: bin number 2
-	# 6-12 months: bin number 3
-	# 1-2 years: bin number 4
-	# 2-5 years: bin number 5
-	# 5-12 years: bin number 6
-	# 12-50: bin number 7
-	# 50+ : bin number 8
-	
-	if age<=1 :
-		ageBinNum = 1
-	elif age>1 and age<=6 :
-		ageBinNum = 2
-	elif age>6 and age<=12 :
-		ageBinNum = 3
-	elif age>12 and age<=24 :
-		ageBinNum = 4
-	elif age>24 and age<=60:
-		ageBinNum = 5
-	elif age>60 and age<=144:
-		ageBinNum = 6
-	elif age>144 and age<=600:
-		ageBinNum = 7
-	elif age>600:
-		ageBinNum = 8
-		
-	return ageBinNum 
+# Upper bounds (in months, included) of the age bins
+# 0-1 month : bin number 1
+# 1-6 months: bin number 2
+# 6-12 months: bin number 3
+# 1-2 years: bin number 4
+# 2-5 years: bin number 5
+# 5-12 years: bin number 6
+# 12-50: bin number 7
+# 50+ : bin number 8
+AGE_BIN_EDGES = [1, 6, 12, 24, 60, 144, 600]
+
+# Get bin numbers for a series of ages in months (NaN for missing ages)
+def get_age_bin_nums(ages):
+	
+	bins = [-np.inf] + AGE_BIN_EDGES + [np.inf]
+	
+	return pd.cut(ages, bins=bins, labels=range(1, len(bins)), right=True).astype(float)
+	
+	
+# Columns of the batch_{batch_num}.tsv files
+BATCH_COLUMNS = ["scan_name", "png_name", "age_bin_num", "batch_num", "full_path"]
+
+# Number the batches : every age bin is split into consecutive batches of batch_size scans, numbered from first_batch
+# batchesDf must be sorted by age bin. Returns the batch numbers as a numpy array aligned with batchesDf
+def get_batch_nums(batchesDf, batch_size, first_batch=1):
+	
+	# Position of each scan in its age bin, and number of batches used by the bins before it
+	posInBin = batchesDf.groupby('age_bin_num', sort=False).cumcount().values
+	binBatches = np.ceil(batchesDf.groupby('age_bin_num', sort=False).size() / batch_size).astype(int)
+	binOffsets = binBatches.cumsum() - binBatches
+	
+	return first_batch + batchesDf['age_bin_num'].map(binOffsets).values + posInBin // batch_size
+
+# Write the batch_{batch_num}.tsv files, one row per PNG of every scan in the batch
+# Each scan directory is listed once (os.scandir) while its rows are written, so memory does not grow with the dataset
+def write_batch_tsvs(batchesDf, outDir):
+	
+	for batch_number, batch_data in batchesDf.groupby('batch_num', sort=False):
+		batch_outFn = os.path.join(outDir, "batch_" + str(batch_number).zfill(3)+".tsv")
+		with open(batch_outFn, "w", newline="") as f:
+			writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+			writer.writerow(BATCH_COLUMNS)
+			for scan_name, age_bin_num, scanPath in zip(batch_data["scan_name"], batch_data["age_bin_num"], batch_data["full_path"]):
+				with os.scandir(scanPath) as entries:
+					pngs = [entry.name for entry in entries if entry.name.endswith(".png")]
+				writer.writerows([scan_name, png, age_bin_num, batch_number, os.path.join(scanPath, png)] for png in pngs)
+
+# Copy new batch files to the directory of every registered grader, with an empty grade column (same as imageRatingLib.add_grader)
+# Batch files a grader already has are never overwritten. Returns the names of the graders the batches were copied to
+def push_batches_to_graders(batch_numbers, outDir):
+	
+	gradersCSV = os.path.join(outDir, "registered_graders.csv")
+	if not os.path.exists(gradersCSV):
+		return []
+	with open(gradersCSV, 'r', newline='') as csvfile:
+		graders = [line.strip().lower().replace(' ', '_') for line in csvfile if line.strip()]
+	
+	pushed = []
+	for grader_name in graders:
+		grader_dir = os.path.join(outDir, grader_name)
+		# Graders get every batch file when their directory is created
+		if not os.path.isdir(grader_dir):
+			continue
+		for batch_number in batch_numbers:
+			file_name = "batch_" + str(batch_number).zfill(3)+".tsv"
+			if os.path.exists(os.path.join(grader_dir, file_name)):
+				continue
+			batch_df = pd.read_csv(os.path.join(outDir, file_name), sep='\t')
+			batch_df[f'grade_{grader_name}'] = pd.NA
+			batch_df.to_csv(os.path.join(grader_dir, file_name), sep='\t', index=False)
+		pushed.append(grader_name)
+	
+	return pushed
 	
 	
 def main():
@@ -104,6 +178,7 @@ def main():
 	parser.add_argument('-p', '--participants', help='Path to the participants.tsv file', required=True)
 	parser.add_argument('-u', '--age-units', help='Units of age (accepted values : m, d, y)', choices = ['m', 'd', 'y'],required=True)
 	parser.add_argument('-o', '--output-dir', help='Path to the output base directory where the \'qc_files\' or \'qc_files_synthseg\' directory, containing grading-related files, will be output', required=True)
+	parser.add_argument('-a', '--append', help='Keep the existing batches and only batch the scans that are not in scan_batch_info.tsv yet', action='store_true')
 	
 	# Parse arguments
 	args = parser.parse_args()
@@ -112,6 +187,7 @@ def main():
 	ageUnits = args.age_units
 	outBase = args.output_dir
 	synthseg = args.synthseg
+	append = args.append
 	
 	# Read participants file
 	partDf = pd.read_csv(partPath, sep="\t")
@@ -124,65 +200,75 @@ def main():
 	numPngsPerBatch = 15 * 9  # units = pngs
 	batch_size = int(numPngsPerBatch / 9) # Which is 15. This is the number of scans (each scan has 9 PNGs) per batch 
 	
+	if synthseg:
+		outDir = os.path.join(outBase, "qc_files_synthseg")
+	else:
+		outDir = os.path.join(outBase, "qc_files")
+	outFn = os.path.join(outDir, "scan_batch_info.tsv")
+	
 	# Get the path to the scans(sub directories) in the input directory
-	inScans = os.listdir(inDir) # Each sub-directory in inScans has  9 PNGs
+	# Only the scan sub-directories : scan lists and other files written next to them by the PNG generators are skipped
+	with os.scandir(inDir) as entries:
+		inScans = [entry.name for entry in entries if entry.is_dir()] # Each sub-directory in inScans has  9 PNGs
 	
 	print()
 	
 	#Number of batches required 
 	numBatches = int(np.ceil(float(len(inScans)*9)/numPngsPerBatch))
+	
+	# In append mode, only the scans without a batch are batched, after the existing batches
+	first_batch = 1
+	appending = append and os.path.exists(outFn)
+	if appending:
+		existingDf = pd.read_csv(outFn, sep="\t")
+		existingScans = set(existingDf["scan_name"])
+		inScans = [scan for scan in inScans if scan not in existingScans]
+		if len(existingDf) > 0:
+			first_batch = int(existingDf["batch_num"].max()) + 1
+		print(len(existingScans), "scans already have a batch,", len(inScans), "new scans")
+		if not inScans:
+			print("No new scans to batch.")
+			return
 
-	# Create a dataframe to store batch numbers for each scan
-	batchesDf = pd.DataFrame(columns = ["scan_name", "age_bin_num", "batch_num", "full_path"], index = range(len(inScans)))
-	batchesDf["scan_name"] = inScans
-	
-	# Populate age_bin_num and full_path columns
-	for index,row in batchesDf.iterrows():
-		batchesDf.at[index, "full_path"] = os.path.join(inDir, row["scan_name"])
-		age = get_age(row["scan_name"], partDf, ageUnits)
-		ageBinNum = get_age_bin_num(age)
-		batchesDf.at[index, "age_bin_num"] = ageBinNum
-		
-	# Sort the df
-	batchesDf.sort_values(by='age_bin_num', inplace=True)
+	# Look up the ages of all scans at once
+	ageDf, missingDf = get_ages(inScans, partDf, ageUnits)
 	
+	# Report the scans without a usable age together, they are left out of the batches
+	if len(missingDf) > 0:
+		print(len(missingDf), "scan(s) have no usable age in", partPath, "and are left out of the batches :")
+		print(missingDf.to_string(index=False))
+		print()
+		ageDf = ageDf[ageDf["age"].notna()]
+	
+	# Create a dataframe to store batch numbers for each scan
+	batchesDf = pd.DataFrame({"scan_name": ageDf["scan_name"].values})
+	batchesDf["age_bin_num"] = get_age_bin_nums(ageDf["age"]).astype(int).values
 	batchesDf["batch_num"] = 0
-	current_batch = 1
+	batchesDf["full_path"] = [os.path.join(inDir, scan) for scan in batchesDf["scan_name"]]
+	
+	# Sort the df (stable, so that scans keep their directory order within an age bin)
+	batchesDf.sort_values(by='age_bin_num', inplace=True, kind='stable')
 	
 	# Populate batch_number
-	for age_bin, group in batchesDf.groupby('age_bin_num'):
-        	for i in range(0, len(group), batch_size):
-            		batchesDf.loc[group.index[i:i+batch_size], 'batch_num'] = current_batch
-            		current_batch += 1
+	batchesDf["batch_num"] = get_batch_nums(batchesDf, batch_size, first_batch)
 
-	if synthseg:
-		outDir = os.path.join(outBase, "qc_files_synthseg")
-	else:
-		outDir = os.path.join(outBase, "qc_files")
-	
-	# Save the dataframe to batch_info.tsv
+	# Save the dataframe to batch_info.tsv (append the new scans to it in append mode)
 	if not os.path.exists(outDir):
 		os.makedirs(outDir)
-	outFn = os.path.join(outDir, "scan_batch_info.tsv")
-	batchesDf.to_csv(outFn, index=False, sep="\t")
-	
-	# Divide main dataframe into batch dataframes
-	batch_dfs = {}
+	if appending:
+		batchesDf.to_csv(outFn, index=False, sep="\t", mode="a", header=False)
+	else:
+		batchesDf.to_csv(outFn, index=False, sep="\t")
 	
-	for batch_number, batch_data in batchesDf.groupby('batch_num'):
+	# Save the PNGs of every batch to batch_{batch_num}.tsv files
+	write_batch_tsvs(batchesDf, outDir)
 	
-		batch_df_sub = pd.concat([pd.DataFrame({"scan_name": row["scan_name"],\
-		"png_name": png, "age_bin_num": row["age_bin_num"], "batch_num": row["batch_num"],\
-		"full_path": os.path.join(row["full_path"], png)}, \
-		index=[0]) for _, row in batch_data.iterrows() for png in os.listdir(row["full_path"])], ignore_index=True)
-		
-		batch_dfs[batch_number] = batch_df_sub.reset_index(drop=True)
-
-		
-	# Save these to batch_{batch_num}.tsv files
-	for batch_number, batch_df in batch_dfs.items():
-		batch_outFn = os.path.join(outDir, "batch_" + str(batch_number).zfill(3)+".tsv")
-		batch_df.to_csv(batch_outFn, index = False, sep="\t")
+	# Give the new batches to the graders who already started
+	if appending:
+		new_batches = sorted(batchesDf["batch_num"].unique())
+		graders = push_batches_to_graders(new_batches, outDir)
+		if new_batches:
+			print("Added batches", new_batches[0], "to", new_batches[-1], "for", len(graders), "registered grader(s)")
 	
 	# Add empty file to register graders
 	gradersCSV = os.path.join(outDir, "registered_graders.csv")
@@ -1,6 +1,21 @@
 
 """
 Custom library used by the Grading notebook to display PNGs per batch.
+
+Ratings are appended to a per-grader journal (`<qc_files>/<grader>/grades_journal.jsonl`) as they are entered, instead of
+rewriting the batch TSV after every image. The journal is compacted into the batch TSVs at the end of each batch and when
+grading starts, so a session that was interrupted resumes from the ratings already in the journal.
+
+While an image is being rated, a background thread opens and scales the next images of the batch, so the next image is shown
+as soon as the rating is entered.
+
+The pending batches of a grader are found from a small progress index (`<qc_files>/<grader>/progress_index.json`, number of
+images and of rated images per batch) kept up to date when ratings are written to the batch TSVs. Batch files missing from the
+index are read once and added to it, and the whole index is rebuilt from the TSVs when it is missing or unreadable.
+
+Graders working over a slow link can pass a local directory to `start_grading(local_cache_dir=...)` : the PNGs of a batch are
+then copied there together when the batch starts, and displayed from the local copies. The local cache is shared by the
+batches and its least recently used images are deleted beyond `cache_gb`.
 """
 
 from IPython.display import display, HTML
@@ -12,6 +27,37 @@ import numpy as np
 import random
 from IPython.display import clear_output
 import csv
+import json
+import time
+import shutil
+import hashlib
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Name of the journal of the ratings of a grader, in the grader's directory
+JOURNAL_FILE = 'grades_journal.jsonl'
+
+# Number of ratings appended to the journal between two fsync calls
+SYNC_EVERY = 10
+
+# Name of the progress index of a grader, in the grader's directory
+PROGRESS_INDEX_FILE = 'progress_index.json'
+
+# Number of images of a batch opened and scaled ahead of the image being rated
+PREFETCH_IMAGES = 4
+
+# Scale of the images displayed for grading
+DISPLAY_SCALE = 2.5
+
+# Default size limit of the local cache of batch images, in GB
+DEFAULT_CACHE_GB = 2
+
+# Number of images copied at the same time to the local cache
+MIRROR_THREADS = 8
+
+# Age (in seconds) after which a partial copy of the local cache is left over from an interrupted session and deleted
+STALE_TMP_SECONDS = 3600
 
 # Function to get user input
 def get_user_input(prompt):
@@ -71,18 +117,296 @@ def add_grader(gradersCSV, grader_name, qc_files):
                     batch_df.to_csv(os.path.join(grader_dir, file_name), sep='\t', index=False)
         
 
+# Function to count the images and the rated images of a batch DataFrame
+def get_batch_progress(batch_df, grader_name):
+
+    grade_column = f'grade_{grader_name}'
+    graded = int(batch_df[grade_column].notna().sum()) if grade_column in batch_df.columns else 0
+    return {"total": len(batch_df), "graded": graded}
+
+# Function to read the progress index of a grader : {batch_number : {"total", "graded"}}, or None if it is missing or unreadable
+def read_progress_index(grader_dir):
+
+    try:
+        with open(os.path.join(grader_dir, PROGRESS_INDEX_FILE), 'r') as index_file:
+            return {int(batch_number): progress for batch_number, progress in json.load(index_file).items()}
+    except (OSError, ValueError, AttributeError):
+        return None
+
+# Function to write the progress index of a grader
+def write_progress_index(grader_dir, index):
+
+    replace_file(os.path.join(grader_dir, PROGRESS_INDEX_FILE),
+                 lambda index_file: json.dump({str(batch_number): progress for batch_number, progress in sorted(index.items())}, index_file))
+
+# Function to record the progress of some batches in the progress index of a grader
+def update_progress_index(grader_dir, batch_progress):
+
+    index = read_progress_index(grader_dir) or {}
+    index.update(batch_progress)
+    write_progress_index(grader_dir, index)
+
 # Function to get pending batches for a grader
-def get_pending_batches(grader_name, qc_files):
-
-    pending_batches = []
-    for file_name in os.listdir(os.path.join(qc_files, grader_name)):
-        if file_name.startswith('batch_') and file_name.endswith('.tsv'):
-            batch_number = int(file_name.split('_')[1].split('.')[0])
-            df = pd.read_csv(os.path.join(os.path.join(qc_files, grader_name), file_name), sep='\t')
-            if (f'grade_{grader_name}' not in df.columns) or (df[f'grade_{grader_name}'].isna().any()):
-                pending_batches.append(batch_number)
+# The progress index is used for the batches it knows, the other batch files are read and added to it
+# rescan=True reads every batch file and rebuilds the index
+def get_pending_batches(grader_name, qc_files, rescan=False):
+
+    grader_dir = os.path.join(qc_files, grader_name)
+    batch_numbers = [int(file_name.split('_')[1].split('.')[0]) for file_name in os.listdir(grader_dir)
+                     if file_name.startswith('batch_') and file_name.endswith('.tsv')]
+
+    index = None if rescan else read_progress_index(grader_dir)
+    unindexed = [batch_number for batch_number in batch_numbers if index is None or batch_number not in index]
+    if unindexed or index is None:
+        # Full rescan when there is no usable index, only the new batch files otherwise
+        batch_progress = {}
+        for batch_number in unindexed:
+            df = pd.read_csv(os.path.join(grader_dir, f'batch_{batch_number:03d}.tsv'), sep='\t')
+            batch_progress[batch_number] = get_batch_progress(df, grader_name)
+        index = dict(index or {})
+        index.update(batch_progress)
+        index = {batch_number: index[batch_number] for batch_number in batch_numbers}
+        write_progress_index(grader_dir, index)
+
+    pending_batches = [batch_number for batch_number in batch_numbers if index[batch_number]["graded"] < index[batch_number]["total"]]
     return sorted(pending_batches, reverse=True)
 
+# Append-only journal of the ratings of a grader
+# Every rating is one JSON line {"batch", "full_path", "grade", "time"}, flushed as soon as it is entered and fsync'ed every
+# SYNC_EVERY ratings and when the journal is closed
+class GradeJournal:
+
+    def __init__(self, grader_dir):
+        self.file = open(os.path.join(grader_dir, JOURNAL_FILE), 'a')
+        self.unsynced = 0
+
+    # Append a rating to the journal
+    def record(self, batch_number, full_path, grade):
+        entry = {"batch": int(batch_number), "full_path": full_path, "grade": int(grade), "time": time.time()}
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        self.unsynced += 1
+        if self.unsynced >= SYNC_EVERY:
+            self.sync()
+
+    # Make the ratings appended so far durable
+    def sync(self):
+        if self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+# Function to read the journal of a grader
+# Returns {batch_number : {full_path : grade}} (the last rating of an image wins) and the journal lines of every batch
+def read_journal(grader_dir):
+
+    grades = {}
+    lines = {}
+    journal_path = os.path.join(grader_dir, JOURNAL_FILE)
+    if not os.path.exists(journal_path):
+        return grades, lines
+
+    with open(journal_path, 'r') as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line cut by a crash
+                continue
+            grades.setdefault(entry["batch"], {})[entry["full_path"]] = entry["grade"]
+            lines.setdefault(entry["batch"], []).append(line)
+    return grades, lines
+
+# Function to apply the ratings of the journal to a batch DataFrame
+def apply_journal_grades(batch_df, grader_name, batch_grades):
+
+    grade_column = f'grade_{grader_name}'
+    if grade_column not in batch_df.columns:
+        batch_df[grade_column] = pd.NA
+    if batch_grades:
+        journal_grades = batch_df['full_path'].map(batch_grades)
+        rated = journal_grades.notna()
+        batch_df.loc[rated, grade_column] = journal_grades[rated]
+
+# Function to replace a file with new contents without ever leaving it half written
+def replace_file(file_path, write):
+
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w', newline='') as tmp_file:
+        write(tmp_file)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, file_path)
+
+# Function to compact the journal of a grader : the ratings of the batches (all of them if batch_numbers is None) are written
+# to their batch TSVs, one write per batch, then dropped from the journal
+# The journal must not be open for writing (no batch is being graded)
+def compact_journal(grader_name, qc_files, batch_numbers=None):
+
+    grader_dir = os.path.join(qc_files, grader_name)
+    journal_grades, journal_lines = read_journal(grader_dir)
+    compacted = [batch_number for batch_number in journal_grades if batch_numbers is None or batch_number in batch_numbers]
+    if not compacted:
+        return []
+
+    batch_progress = {}
+    for batch_number in compacted:
+        full_file_path = os.path.join(grader_dir, f'batch_{batch_number:03d}.tsv')
+        batch_df = pd.read_csv(full_file_path, sep='\t')
+        apply_journal_grades(batch_df, grader_name, journal_grades[batch_number])
+        replace_file(full_file_path, lambda tsv_file: batch_df.to_csv(tsv_file, sep='\t', index=False))
+        batch_progress[batch_number] = get_batch_progress(batch_df, grader_name)
+    update_progress_index(grader_dir, batch_progress)
+
+    # Keep the ratings of the other batches in the journal
+    remaining = [line for batch_number, lines in journal_lines.items() if batch_number not in compacted for line in lines]
+    replace_file(os.path.join(grader_dir, JOURNAL_FILE), lambda journal: journal.writelines(remaining))
+    return compacted
+
+# Function to get the path of the local copy of an image (keyed on its path, size and modification time)
+def get_local_copy_path(image_path, local_cache_dir):
+
+    stat = os.stat(image_path)
+    key = f'{os.path.abspath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(local_cache_dir, digest + '_' + os.path.basename(image_path))
+
+# Function to copy an image to the local cache (if it is not there yet) and mark it as recently used
+# Returns the path to display the image from : the local copy, or the image itself if it could not be copied
+def mirror_image(image_path, local_cache_dir):
+
+    image_path = os.path.expanduser(image_path)
+    try:
+        local_path = get_local_copy_path(image_path, local_cache_dir)
+        if os.path.exists(local_path):
+            os.utime(local_path)
+        else:
+            # Unique name, so that two grading sessions on the same host never write the same partial copy
+            tmp_path = local_path + '.' + uuid.uuid4().hex + '.tmp'
+            try:
+                shutil.copyfile(image_path, tmp_path)
+                os.replace(tmp_path, local_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return local_path
+    except OSError:
+        return image_path
+
+# Function to delete the least recently used images of the local cache until it fits in max_bytes
+# The images in keep (the batch being graded) are never deleted
+# Partial copies left over by interrupted sessions (older than STALE_TMP_SECONDS) are deleted, the others count in the size
+def evict_local_cache(local_cache_dir, max_bytes, keep=()):
+
+    keep = set(keep)
+    entries = []
+    tmp_bytes = 0
+    stale_time = time.time() - STALE_TMP_SECONDS
+    for entry in os.scandir(local_cache_dir):
+        if not entry.is_file():
+            continue
+        try:
+            stat = entry.stat()
+            if entry.name.endswith('.tmp'):
+                if stat.st_mtime < stale_time:
+                    os.remove(entry.path)
+                else:
+                    tmp_bytes += stat.st_size
+            elif entry.name.endswith('.png'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+
+    total_bytes = tmp_bytes + sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+# Function to copy the images of a batch to the local cache in one go
+# Returns {full_path : path to display the image from}
+def mirror_batch_images(image_paths, local_cache_dir, cache_gb=DEFAULT_CACHE_GB):
+
+    local_cache_dir = os.path.expanduser(local_cache_dir)
+    os.makedirs(local_cache_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=MIRROR_THREADS) as pool:
+        local_paths = list(pool.map(lambda image_path: mirror_image(image_path, local_cache_dir), image_paths))
+
+    evict_local_cache(local_cache_dir, cache_gb * 1024 ** 3, keep=local_paths)
+    return dict(zip(image_paths, local_paths))
+
+# Function to open an image and scale it for display
+def load_display_image(image_path, scale=DISPLAY_SCALE):
+
+    img = Image.open(os.path.expanduser(image_path))
+    return img.resize((int(img.width * scale), int(img.height * scale)))
+
+
+# Opens and scales the images of a batch, in order, in a background thread
+# At most max_ahead images past the one being rated are kept ready, so memory stays bounded
+class ImagePrefetcher:
+
+    def __init__(self, image_paths, max_ahead=PREFETCH_IMAGES):
+        self.image_paths = list(image_paths)
+        self.max_ahead = max(1, max_ahead)
+        # position : (scaled image or None, exception or None)
+        self.ready = {}
+        self.position = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        for position, image_path in enumerate(self.image_paths):
+            with self.cond:
+                while not self.closed and position >= self.position + self.max_ahead:
+                    self.cond.wait()
+                if self.closed:
+                    return
+
+            img, error = None, None
+            try:
+                img = load_display_image(image_path)
+            except Exception as e:
+                error = e
+
+            with self.cond:
+                self.ready[position] = (img, error)
+                self.cond.notify_all()
+
+    # Wait for the image at a position of the list and take it
+    def get(self, position):
+        with self.cond:
+            self.position = position
+            self.cond.notify_all()
+            while position not in self.ready:
+                self.cond.wait()
+            img, error = self.ready.pop(position)
+            self.position = position + 1
+            self.cond.notify_all()
+
+        if error is not None:
+            raise error
+        return img
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.ready.clear()
+
 # Function to get age_group to display in the notebook
 def get_age_group(age_bin_num):
     
@@ -116,42 +440,66 @@ def get_age_group(age_bin_num):
 
     
 # Function to display batch for grading
-def display_batch_for_grading(batch_number, grader_name, qc_files):
+# The images are displayed from local copies when a local_cache_dir is given
+def display_batch_for_grading(batch_number, grader_name, qc_files, local_cache_dir=None, cache_gb=DEFAULT_CACHE_GB):
 
     file_name = f'batch_{batch_number:03d}.tsv'
-    full_file_path = os.path.join(qc_files, grader_name, file_name)
+    grader_dir = os.path.join(qc_files, grader_name)
+    full_file_path = os.path.join(grader_dir, file_name)
     batch_df = pd.read_csv(full_file_path, sep='\t')
-    grades = []
-    for index, row in batch_df.iterrows():
-        age_group = get_age_group(int(row["age_bin_num"]))
-        print(f"Grading batch {batch_number} [Age group " , age_group ,"]:")
-        img = Image.open(os.path.expanduser(row["full_path"]))
-        scale = 2.5
-        display(img.resize((int(img.width * scale), int(img.height * scale))))
-        # ask for a rating
-        rating = input("Grade the image on a scale of -1/0/2 (aka flag the image/poor quality/good quality) : ")
+    grade_column = f'grade_{grader_name}'
 
-        while True:
-            try:
-                rating = int(rating)
-            except:
-                print("Invalid rating value.")
+    # Resume after the images already rated in an interrupted session
+    journal_grades, _ = read_journal(grader_dir)
+    apply_journal_grades(batch_df, grader_name, journal_grades.get(batch_number))
 
-            if rating in [0, -1, 2]:
-                break
-            else:
-                rating = input("Grade the image on a scale of -1/0/2 (aka flag the image/poor quality/good quality) : ")
-                
-        # Save the rating
-        batch_df.at[index, f'grade_{grader_name}'] = rating
-        print(list(batch_df))
-        print(full_file_path)
-        batch_df.to_csv(full_file_path, sep='\t', index=False)
+    pending_rows = [(index, row) for index, row in batch_df.iterrows() if pd.isna(row[grade_column])]
+
+    image_paths = [row["full_path"] for _, row in pending_rows]
+    if local_cache_dir is not None:
+        print(f"Copying the {len(image_paths)} images of batch {batch_number} to {local_cache_dir} ...")
+        local_paths = mirror_batch_images(image_paths, local_cache_dir, cache_gb)
+        image_paths = [local_paths[image_path] for image_path in image_paths]
         clear_output()
 
+    # Open and scale the next images while the current one is rated
+    prefetcher = ImagePrefetcher(image_paths)
+    journal = GradeJournal(grader_dir)
+    try:
+        for position, (index, row) in enumerate(pending_rows):
+            age_group = get_age_group(int(row["age_bin_num"]))
+            print(f"Grading batch {batch_number} [Age group " , age_group ,"]:")
+            display(prefetcher.get(position))
+            # ask for a rating
+            rating = input("Grade the image on a scale of -1/0/2 (aka flag the image/poor quality/good quality) : ")
+
+            while True:
+                try:
+                    rating = int(rating)
+                except:
+                    print("Invalid rating value.")
+
+                if rating in [0, -1, 2]:
+                    break
+                else:
+                    rating = input("Grade the image on a scale of -1/0/2 (aka flag the image/poor quality/good quality) : ")
+                    
+            # Save the rating
+            batch_df.at[index, grade_column] = rating
+            journal.record(batch_number, row["full_path"], rating)
+            clear_output()
+    finally:
+        journal.close()
+        prefetcher.close()
+
+    # Write the ratings of the batch to its TSV at once (and its progress to the progress index)
+    if batch_number not in compact_journal(grader_name, qc_files, [batch_number]):
+        update_progress_index(grader_dir, {batch_number: get_batch_progress(batch_df, grader_name)})
+
 
 # Start the grading process
-def start_grading():
+# local_cache_dir : optional local directory where the images of each batch are copied before it is graded (size limit : cache_gb)
+def start_grading(local_cache_dir=None, cache_gb=DEFAULT_CACHE_GB):
 
     # Enter path to qc_files directory
     qc_files = get_user_input("Enter path to the qc_files or qc_files_synthseg directory : ")
@@ -167,6 +515,9 @@ def start_grading():
             print(f"Welcome {grader_name}! You have been added as a new grader.")
     else:
         print(f"Welcome back, {grader_name}!")
+
+    # Write the ratings left in the journal by an interrupted session to the batch TSVs
+    compact_journal(grader_name, qc_files)
         
     # Get pending batches for the grader
     pending_batches = get_pending_batches(grader_name, qc_files)
@@ -174,7 +525,7 @@ def start_grading():
         print("You have graded all the batches for this dataset.")
     else:
         for batch_number in pending_batches:
-            display_batch_for_grading(batch_number, grader_name, qc_files)
+            display_batch_for_grading(batch_number, grader_name, qc_files, local_cache_dir, cache_gb)
             grade_more = input("Do you want to grade another pending batch? (y/n) : ").strip()
             
             while True:
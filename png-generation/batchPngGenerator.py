@@ -0,0 +1,145 @@
+
+"""
+This script generates PNGs for a list of scans in a single Python process. The scans are spread over a pool of worker processes,
+each of which runs `generatePngsSingleScanNibabel` from singleScanPngGenerator.py, so the conda activation and the nilearn/matplotlib
+imports are paid once per batch instead of once per scan.
+
+	Input arguments :
+	`-l` (required): Full path to the scan list TSV written by runPngGenerator.py (columns : scan_path, seg_path)
+	`-o` (required): Full path to the directory where the PNG files should be written to
+	`-w` (optional): Number of worker processes (default : number of CPUs available to the job)
+	`-p` (optional): Flag whose presence indicates the BIDS scans were preprocessed using ACPC alignment
+	`-r` (optional): Renderer for the structural PNGs, `nilearn` (default) or `numpy`
+	`--lazy` (optional): Read the scans lazily in their native data type instead of float32
+	`--hash` (optional): Record the sha256 of the scans in their render manifests
+
+	Output :
+	Same per-scan layout as singleScanPngGenerator.py :
+		1. `<outDir>/<scanID>` containing structural PNGs for every scan in the list.
+		2. `<outDir>_SS_Overlays/<scanID>` containing (structural + synthseg overlay) PNGs for the scans that have a segmentation.
+
+"""
+
+import os
+import sys
+import argparse
+import traceback
+from multiprocessing import Pool
+import pandas as pd
+import singleScanPngGenerator
+
+##
+# Write the list of scans to render to a TSV file that can be read back by readScanList
+# @parameter scans A list of (scanPath, segPath) tuples, segPath may be None
+# @parameter listPath A string representing the full path of the TSV file to write
+# @return None
+def writeScanList(scans, listPath):
+    scanDf = pd.DataFrame(scans, columns=["scan_path", "seg_path"])
+    scanDf.to_csv(listPath, sep="\t", index=False)
+
+
+##
+# Read the list of scans to render
+# @parameter listPath A string representing the full path to the scan list TSV
+# @return A list of (scanPath, segPath) tuples, segPath is None for scans without a segmentation
+def readScanList(listPath):
+    scanDf = pd.read_csv(listPath, sep="\t", dtype=str)
+    if "seg_path" not in scanDf.columns:
+        scanDf["seg_path"] = None
+    scanDf = scanDf.astype(object).where(scanDf.notna(), None)
+
+    return list(zip(scanDf["scan_path"], scanDf["seg_path"]))
+
+
+##
+# Number of CPUs this process is allowed to run on (respects the Slurm allocation)
+# @return The number of usable CPUs
+def getAvailableCpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+##
+# Worker function : render a single scan and report failures instead of raising them
+# @parameter job A tuple (scanPath, segPath, outBase, isPreprocessed, renderer, lazy, useHash)
+# @return A tuple (scanPath, error message or None)
+def _renderScanJob(job):
+    scanPath, segPath, outBase, isPreprocessed, renderer, lazy, useHash = job
+    try:
+        singleScanPngGenerator.renderScan(scanPath, outBase, segPath, isPreprocessed, renderer, lazy, useHash=useHash)
+    except Exception:
+        return scanPath, traceback.format_exc()
+    return scanPath, None
+
+
+##
+# Render the PNGs for a list of scans with a pool of worker processes
+# @parameter scans A list of (scanPath, segPath) tuples, segPath may be None
+# @parameter outBase A string specifying the base directory to save the PNGs to
+# @parameter isPreprocessed True if the scans underwent ACPC alignment
+# @parameter numWorkers Number of worker processes, all available CPUs if None
+# @parameter renderer "nilearn" or "numpy"
+# @parameter lazy True to read the scans lazily in their native data type
+# @parameter useHash True to record the sha256 of the scans in their render manifests
+# @return A list of (scanPath, error message) tuples for the scans that failed
+def renderScans(scans, outBase, isPreprocessed, numWorkers=None, renderer="nilearn", lazy=False, useHash=False):
+    if numWorkers is None or numWorkers < 1:
+        numWorkers = getAvailableCpus()
+    numWorkers = min(numWorkers, max(len(scans), 1))
+
+    jobs = [(scanPath, segPath, outBase, isPreprocessed, renderer, lazy, useHash) for scanPath, segPath in scans]
+    failures = []
+
+    print("Rendering", len(jobs), "scans with", numWorkers, "worker(s)")
+    if numWorkers == 1:
+        results = map(_renderScanJob, jobs)
+        failures = [(scanPath, error) for scanPath, error in results if error is not None]
+    else:
+        # maxtasksperchild keeps matplotlib/nilearn memory from piling up in long-lived workers
+        with Pool(processes=numWorkers, maxtasksperchild=50) as pool:
+            for scanPath, error in pool.imap_unordered(_renderScanJob, jobs):
+                if error is not None:
+                    failures.append((scanPath, error))
+
+    for scanPath, error in failures:
+        print("!! PNG generation failed for scan : ", scanPath)
+        print(error)
+    print(len(jobs) - len(failures), "of", len(jobs), "scans rendered")
+
+    return failures
+
+
+##
+# Main function
+def main():
+    # --- Set up the argument parser ---
+    parser = argparse.ArgumentParser()
+    # Add an argument to get the list of scans to generate PNGs from --> Required!
+    parser.add_argument('-l', '--scan-list', help='Full path to the scan list TSV (columns : scan_path, seg_path)', required = True)
+    # Add an argument to get the directory where the QC PNGs will be written --> Required!
+    parser.add_argument('-o', '--out-dir', help='Full path to the directory where the PNG files should be written to', required = True)
+    # Add an optional argument to set the number of worker processes
+    parser.add_argument('-w', '--workers', help='Number of worker processes (default : number of CPUs available to the job)', type=int)
+    # Add an optional argument to inidcate that the BIDS scans underwent ACPC alignment
+    parser.add_argument('-p', '--preprocessed', help="Flag whose presence indicates the BIDS scans were preprocessed using ACPC alignment", action='store_true')
+    # Add an optional argument to select the renderer of the structural PNGs
+    parser.add_argument('-r', '--renderer', help="Renderer for the structural PNGs (default : nilearn)", choices=singleScanPngGenerator.RENDERERS, default="nilearn")
+    # Add an optional argument to read the scans lazily in their native data type
+    parser.add_argument('--lazy', help="Read the scans lazily in their native data type instead of loading them as float32", action='store_true')
+    # Add an optional argument to record the content hash of the scans in their render manifests
+    parser.add_argument('--hash', help="Record the sha256 of the scans in their render manifests", action='store_true')
+
+    args = parser.parse_args()
+
+    scans = readScanList(args.scan_list)
+    failures = renderScans(scans, args.out_dir, args.preprocessed, args.workers, args.renderer, args.lazy, args.hash)
+
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+    print("The script has finished running")
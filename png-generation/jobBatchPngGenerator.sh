@@ -0,0 +1,49 @@
+#!/bin/bash
+#SBATCH --job-name=png-generation-batch
+#SBATCH --time=12:00:00
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=16
+#SBATCH --mem-per-cpu=4G
+#SBATCH --output=%x_%j.out
+
+# -------------------------------------------
+# This script submits a single job that runs batchPngGenerator.py on a list of scans, rendering them with a pool of
+# worker processes (one per allocated CPU). It is used internally by runPngGenerator.py when `-b` is given.
+
+#	Input arguments :
+#	`SCANLIST` : Path to the scan list TSV
+#	`OUTDIR` : Path to output directory
+#	`PREPROC_STATUS` : True if the scans underwent ACPC alignment
+#	`RENDERER` : Renderer for the structural PNGs (nilearn or numpy)
+#	`LAZY` : True to read the scans lazily in their native data type
+#	`USE_HASH` : True to record the sha256 of the scans in their render manifests
+
+# -------------------------------------------
+
+
+SCANLIST=$1  # scan list TSV
+OUTDIR=$2    # output directory for PNGs
+PREPROC_STATUS=$3
+RENDERER=${4:-nilearn}
+LAZY=${5:-False}
+USE_HASH=${6:-False}
+
+# Set up conda
+source ${HOME}/miniconda3/etc/profile.d/conda.sh
+conda activate nilearn
+
+if [ "$PREPROC_STATUS" == "True" ]; then
+    PREPROC_FLAG="-p"
+fi
+
+if [ "$LAZY" == "True" ]; then
+    LAZY_FLAG="--lazy"
+fi
+if [ "$USE_HASH" == "True" ]; then
+    HASH_FLAG="--hash"
+fi
+
+time python batchPngGenerator.py -l $SCANLIST -o $OUTDIR -w ${SLURM_CPUS_PER_TASK:-1} $PREPROC_FLAG -r $RENDERER $LAZY_FLAG $HASH_FLAG
+
+# Done!
+echo "Job finished running!"
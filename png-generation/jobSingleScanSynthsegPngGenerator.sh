@@ -14,19 +14,46 @@
 #	`INFN` : Path to input scan
 #	`OUTDIR` : Path to output directory
 #	`INDER` : Path to the directory containing sysnthseg outputs
+#	`PREPROC_STATUS` : True if the scan underwent ACPC alignment
+#	`RENDERER` : Renderer for the structural PNGs (nilearn or numpy)
+#	`LAZY` : True to read the scan lazily in its native data type
+#	`USE_HASH` : True to record the sha256 of the scan in its render manifest
 # -------------------------------------------
 
 
 INFN=$1      # file name
 OUTDIR=$2    # output directory for PNGs
 INDER=$3 # path to the derivatives folder with ss outputs
+PREPROC_STATUS=$4
+RENDERER=${5:-nilearn}
+LAZY=${6:-False}
+USE_HASH=${7:-False}
 
 
 # Set up conda
 source ${HOME}/miniconda3/etc/profile.d/conda.sh
 conda activate nilearn
 
-time python singleScanPngGenerator.py -f $INFN -o $OUTDIR -d $INDER
+if [ "$PREPROC_STATUS" == "True" ]; then
+    PREPROC_FLAG="-p"
+fi
+if [ "$LAZY" == "True" ]; then
+    LAZY_FLAG="--lazy"
+fi
+if [ "$USE_HASH" == "True" ]; then
+    HASH_FLAG="--hash"
+fi
+
+# A worker of a work queue (`--executor slurm-queue` in the driver) processes scans pulled from QUEUE_DIR until the queue is empty
+# In a job array (`--array` in the driver), the only argument is the array manifest : the CHUNK_SIZE scans of this task
+# (from row (SLURM_ARRAY_TASK_ID + ARRAY_OFFSET) * CHUNK_SIZE) are processed one after the other by the same python process
+if [ -n "$QUEUE_DIR" ]; then
+    time python singleScanPngGenerator.py --queue $QUEUE_DIR
+elif [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+    time python singleScanPngGenerator.py --array-manifest $1
+else
+    time python singleScanPngGenerator.py -f $INFN -o $OUTDIR -d $INDER $PREPROC_FLAG -r $RENDERER $LAZY_FLAG $HASH_FLAG
+fi
 
 # Done!
 echo "Job finished running!"
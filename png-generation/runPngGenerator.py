@@ -7,12 +7,42 @@ and runs the job submission script for each scan to generate PNGs.
 	`-i` (required): Path to the input BIDS directory
 	`-o` (required): Full path to the output directory for QC PNG storage
 	`-d` (optional): Full path to the directory containing sysnthseg outputs
+	`-p` (optional): Flag whose presence indicates the BIDS scans were preprocessed using ACPC alignment (sets the cut axes of the PNGs)
+	`-b` (optional): Render all scans in a single batch job with a pool of workers instead of one job per scan
+	`-w` (optional): Number of worker processes for the batch job (default : 16) or the local executor (default : number of CPUs available),
+	                 or of worker jobs of the `slurm-queue` executor (default : 20)
+	`-r` (optional): Renderer for the structural PNGs, `nilearn` (default) or `numpy`
+	`-l` (optional): Read the scans lazily in their native data type instead of float32
+	`--force` (optional): Submit every scan, even those that are up to date according to their render manifest
+	`--hash` (optional): Record the contents (sha256) of the scans in their render manifests, and compare them for scans whose size or
+	                     modification time changed before re-rendering them
+	`--scan-index` (optional): Full path to the cached BIDS scan index (default : `.<BIDS directory name>_scan_index.sqlite` next to the BIDS directory)
+	`--refresh-index` (optional): List every directory of the BIDS tree again instead of trusting the cached listings of the scan index
+	`--array` (optional): Submit a single Slurm job array over a manifest of the scans (`<outBase>/png_array_manifest.tsv`) instead of one job per scan
+	`--throttle` (optional): Maximum number of array tasks running at the same time (default : 50)
+	`--chunk-size` (optional): Number of scans processed by each array task, or `auto` to fit them in `--target-minutes` (default : 1)
+	`--target-minutes` (optional): Target duration of an array task for `--chunk-size auto` (default : 40)
+	`--executor` (optional): How the jobs are run : `slurm` (one job per scan, default), `slurm-array` (same as `--array`), `slurm-queue`
+	                         (worker jobs pulling the scans from a queue on the shared filesystem, `<outBase>/png_queue`), `local` (pool of
+	                         worker processes on this machine, running the per-scan renderer in-process) or `dry-run` (print the sbatch commands)
+	`--no-adopt` (optional): Re-render the scans rendered before manifests existed (9 PNGs, no manifest) instead of writing a render manifest
+	                         for their existing PNGs (default). Their existing PNGs are not deleted
+	`-s` (optional): Full path to the scratch directory (the one of runCrop.py / runAlignmentWithCrop.py) : the `.nii.gz` scans and segmentations are
+	                 decompressed once to `<scratchDir>/scan_cache` and the uncompressed copies are reused by the later stages
+	`--cache-gb` (optional): Size limit of the cache of uncompressed scans, in GB (default : 50)
+
+	Only new or stale scans are submitted : a scan is up to date when its render manifest (`<outDir>/<scanID>/.qc_manifest.json`)
+	matches the scan, its segmentation and the renderer settings, and all of its PNGs still exist.
 
 	Output :
-	if `-d` is provided :
-		sbatch jobSingleScanSynthsegPngGenerator.sh <scanPath> <outBase> <scanDer>
+	if `-b` is provided :
+		sbatch --cpus-per-task=<workers> jobBatchPngGenerator.sh <outBase>/png_scan_list.tsv <outBase> <isPreprocessed> <renderer> <lazy> <useHash>
+	elif `-d` is provided :
+		sbatch jobSingleScanSynthsegPngGenerator.sh <scanPath> <outBase> <scanDer> <isPreprocessed> <renderer> <lazy> <useHash>
 	else :
-		sbatch jobSingleScanPngGenerator.sh <scanPath> <outBase>
+		sbatch jobSingleScanPngGenerator.sh <scanPath> <outBase> <isPreprocessed> <renderer> <lazy> <useHash>
+	with `--array`, the per-scan jobs are submitted as one job array :
+		sbatch --array=0-<N-1>%<throttle> <job script> <outBase>/png_array_manifest.tsv
 
 """
 
@@ -22,6 +52,44 @@ import sys
 import os
 import argparse
 import json
+import batchPngGenerator
+import singleScanPngGenerator
+
+# Shared modules live in the top-level `common` directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import renderManifest
+import bidsIndex
+import slurmArray
+import executors
+import niftiIO
+
+# Expected processing time (in seconds) of the structural (and synthseg overlay) PNGs of a scan, by renderer, used to size chunked array tasks
+SECONDS_PER_SCAN = {"nilearn": 60, "numpy": 10}
+
+##
+# Check whether a scan has to be submitted for rendering
+# @parameter scanPath A string representing the full path to a scan
+# @parameter outBase A string specifying the base directory of the PNGs
+# @parameter segPath A string representing the full path to the synthseg segmentation, or None
+# @parameter settings The renderer settings as returned by singleScanPngGenerator.pngSettings
+# @parameter force True to submit the scan even if it is up to date
+# @parameter useHash True to compare the scan contents when its size or modification time changed
+# @parameter adoptExisting True to keep the PNGs rendered before manifests existed
+# @return True if the scan is new or stale
+def needsRendering(scanPath, outBase, segPath, settings, force=False, useHash=False, adoptExisting=True):
+    if force:
+        # Drop the manifest so that the job does not consider the scan up to date, with the PNGs it recorded
+        # (unrecorded PNGs are kept)
+        scanID = scanPath.split("/")[-1].split(".nii")[0]
+        renderManifest.removeOutputs(os.path.join(outBase, scanID))
+        renderManifest.removeManifest(os.path.join(outBase, scanID))
+        return True
+    if singleScanPngGenerator.isScanUpToDate(scanPath, outBase, segPath, settings, useHash):
+        return False
+    if adoptExisting and singleScanPngGenerator.adoptExistingPngs(scanPath, outBase, segPath, settings, useHash):
+        return False
+
+    return True
 
 # Main function
 def main():
@@ -34,7 +102,39 @@ def main():
     # Add an optional argument to get the derivatives directory for synthseg overlay PNGs --> Optional!
     parser.add_argument('-d', '--der-dir', help='Full path to the synthseg derivatives directory ')
     # Add an optional argument to inidcate that the BIDS scans underwent ACPC alignment
-    parser.add_argument('-p', '--preprocessed', help="Flag whose presence indicates the BIDS scans were preprocessed using ACPC alignment", action='store_false')
+    parser.add_argument('-p', '--preprocessed', help="Flag whose presence indicates the BIDS scans were preprocessed using ACPC alignment", action='store_true')
+    # Add an optional argument to render all scans in one batch job instead of one job per scan
+    parser.add_argument('-b', '--batch', help="Render all scans in a single batch job with a pool of worker processes", action='store_true')
+    # Add an optional argument to set the number of worker processes of the batch job
+    parser.add_argument('-w', '--workers', help="Number of worker processes for the batch job (default : 16) or the local executor (default : number of CPUs available), or of worker jobs of the slurm-queue executor (default : 20)", type=int)
+    # Add an optional argument to select the renderer of the structural PNGs
+    parser.add_argument('-r', '--renderer', help="Renderer for the structural PNGs (default : nilearn)", choices=["nilearn", "numpy"], default="nilearn")
+    # Add an optional argument to read the scans lazily in their native data type
+    parser.add_argument('-l', '--lazy', help="Read the scans lazily in their native data type (memory mapped for uncompressed .nii) instead of loading them as float32", action='store_true')
+    # Add an optional argument to submit the scans that are up to date as well
+    parser.add_argument('--force', help="Submit every scan, even those that are up to date according to their render manifest", action='store_true')
+    # Add an optional argument to compare the contents of scans whose size or modification time changed
+    parser.add_argument('--hash', help="Record the contents (sha256) of the scans in their render manifests, and compare them for scans whose size or modification time changed before re-rendering them", action='store_true')
+    # Add an optional argument to get the location of the cached BIDS scan index
+    parser.add_argument('--scan-index', help="Full path to the cached BIDS scan index (default : .<BIDS directory name>_scan_index.sqlite next to the BIDS directory)")
+    # Add an optional argument to list the BIDS tree again instead of trusting the scan index
+    parser.add_argument('--refresh-index', help="List every directory of the BIDS tree again instead of trusting the cached listings of the scan index", action='store_true')
+    # Add an optional argument to re-render the scans rendered before render manifests existed
+    parser.add_argument('--no-adopt', help="Re-render the scans that already have their 9 PNGs but no manifest instead of writing a manifest for their PNGs (which are kept)", action='store_true')
+    # Add an optional argument to submit a single Slurm job array instead of one job per scan
+    parser.add_argument('--array', help="Submit a single Slurm job array over a manifest of the scans instead of one job per scan", action='store_true')
+    # Add an optional argument to limit the number of array tasks running at the same time
+    parser.add_argument('--throttle', help="Maximum number of array tasks running at the same time (default : 50)", type=int, default=slurmArray.DEFAULT_THROTTLE)
+    # Add an optional argument to set the number of scans processed by each array task
+    parser.add_argument('--chunk-size', help="Number of scans processed by each array task, or auto to fit them in --target-minutes (default : 1)", default="1")
+    # Add an optional argument to set the target duration of an array task
+    parser.add_argument('--target-minutes', help="Target duration of an array task for --chunk-size auto (default : 40)", type=float, default=slurmArray.DEFAULT_TARGET_MINUTES)
+    # Add an optional argument to select how the jobs are run
+    parser.add_argument('--executor', help="How the jobs are run : slurm (one job per scan, default), slurm-array (same as --array), slurm-queue (worker jobs pulling the scans from a queue on the shared filesystem), local (pool of worker processes on this machine) or dry-run (print the sbatch commands)", choices=executors.EXECUTORS)
+    # Add an optional argument to get the scratch directory where the uncompressed copies of the scans are cached. On Respublica, this could be : /scr1/users/<user>
+    parser.add_argument('-s', '--scratch-dir', help="Path to the scratch directory (same as runCrop.py / runAlignmentWithCrop.py) where uncompressed copies of the .nii.gz scans are cached and reused by the later stages")
+    # Add an optional argument to set the size limit of the cache
+    parser.add_argument('--cache-gb', help="Size limit of the cache of uncompressed scans in the scratch directory, in GB (default : 50)", type=float, default=niftiIO.DEFAULT_CACHE_GB)
  
     # Parse the arguments
     args = parser.parse_args()
@@ -42,56 +142,96 @@ def main():
     outBase = args.output_dir
     derivatives = args.der_dir
     isPreprocessed = args.preprocessed
+    batchMode = args.batch
+    numWorkers = args.workers
+    renderer = args.renderer
+    lazy = args.lazy
+    force = args.force
+    useHash = args.hash
+    adoptExisting = not args.no_adopt
+    scanIndex = args.scan_index
+    refreshIndex = args.refresh_index
+    arrayMode = args.array
+    throttle = args.throttle
+    chunkSize = args.chunk_size
+    targetMinutes = args.target_minutes
+    # `--array` is kept as a shorthand for `--executor slurm-array`
+    executorName = args.executor or ("slurm-array" if arrayMode else "slurm")
+    scrDir = args.scratch_dir
+    cacheGb = args.cache_gb
+    # The local executor already renders the scans with a pool of workers, `-b` only changes how they are submitted to Slurm
+    if batchMode and executorName == "local":
+        batchMode = False
+    if batchMode and executorName in ("slurm-array", "slurm-queue"):
+        parser.error("-b cannot be combined with --array / --executor slurm-array or --executor slurm-queue")
 
+    # Settings the jobs render with (the synthseg jobs render the overlays with the same settings)
+    settings = singleScanPngGenerator.pngSettings(renderer, isPreprocessed)
+    numUpToDate = 0
+
+    # Scans rendered by the batch job when `-b` is given
+    batchScans = []
     # If the output directory doesn't exist, create it
     if not os.path.exists(outBase):
         os.makedirs(outBase)
 
-    # --- For all of the subjects in the input directory ---
-    # Get a list of subject IDs 
-    subIDs = [sub for sub in os.listdir(inDir) if "sub-" in sub]
-    
-    for subID in subIDs:
-        # Full path to subject directory
-        subPath = os.path.join(inDir, subID)
-        # List of sessions
-        sesIDs = [ses for ses in os.listdir(subPath) if "ses-" in ses]
-        
-        # --- For every session belonging to a single subject ---
-        for sesID in sesIDs:
-           sesPath = os.path.join(subPath, sesID)
-           anatPath = os.path.join(sesPath, "anat")
-           
-           # Check if session has anat folder
-           if not os.path.exists(anatPath):
-               continue
-           # Get the list of niftis in the anat folder
-           # TODO: generalize for more than MPR labeled scans
-           scans = [scan for scan in os.listdir(anatPath) if (".nii" in scan) and ("MPR" in scan)]
-          
-           # --- For every anat scan in that session for the subject ---
-           for scan in scans:
-               scanPath = os.path.join(anatPath, scan)
-               scanID = scan.split(".nii")[0]
-               # Submit the job here
-               if derivatives is not None:
-                  scanDer = os.path.join(derivatives, scanID, scanID+"_synthseg.nii.gz")
-                  if os.path.exists(scanDer):
-                     cmd = 'sbatch jobSingleScanSynthsegPngGenerator.sh '
-                     cmd += scanPath + ' ' + outBase + ' ' + scanDer + ' ' + str(isPreprocessed)
-                     os.system(cmd)
-                     print("Submitted job for : ", scanID)
-                     print()
-                  else:
-                     print("!! Segmentation output does not exist for scan : ", scanID)
-                     print()
-                     
-               else:
-                  cmd = 'sbatch jobSingleScanPngGenerator.sh '
-                  cmd += scanPath + ' ' + outBase + ' ' + str(isPreprocessed)
-                  os.system(cmd)
-                  print("Submitted job for : ", scanID)
-                  print()
+    if derivatives is not None:
+        jobScript = 'jobSingleScanSynthsegPngGenerator.sh'
+        columns = ["scan_path", "out_dir", "seg_path", "preprocessed", "renderer", "lazy", "hash"]
+    else:
+        jobScript = 'jobSingleScanPngGenerator.sh'
+        columns = ["scan_path", "out_dir", "preprocessed", "renderer", "lazy", "hash"]
+    # Cache the uncompressed copies of the scans in the scratch directory (the jobs inherit the setting through their environment)
+    if scrDir is not None:
+        print("Caching uncompressed scans in", niftiIO.enableCache(scrDir, cacheGb))
+    executor = executors.createExecutor(executorName, columns, os.path.join(outBase, "png_array_manifest.tsv"), throttle,
+                                        slurmArray.resolveChunkSize(chunkSize, SECONDS_PER_SCAN[renderer], targetMinutes),
+                                        SECONDS_PER_SCAN[renderer], numWorkers, os.path.join(outBase, "png_queue"))
+
+    # --- For every anat scan in the input directory (sub-*/ses-*/anat) ---
+    for scanRec in bidsIndex.findScans(inDir, derivatives, scanIndex, refresh=refreshIndex):
+        scanPath = scanRec.scanPath
+        scanID = scanRec.scanID
+        # Submit the job here
+        if derivatives is not None:
+           scanDer = scanRec.segPath
+           if scanDer is not None:
+              if not needsRendering(scanPath, outBase, scanDer, settings, force, useHash, adoptExisting):
+                 numUpToDate += 1
+                 continue
+              if batchMode:
+                 batchScans.append((scanPath, scanDer))
+                 continue
+              executor.submit(executors.Job(scanID, jobScript, (scanPath, outBase, scanDer, isPreprocessed, renderer, lazy, useHash),
+                                            singleScanPngGenerator.renderScan,
+                                            (scanPath, outBase, scanDer, isPreprocessed, renderer, lazy, None, False, None, useHash)))
+           else:
+              print("!! Segmentation output does not exist for scan : ", scanID)
+              print()
+              
+        elif not needsRendering(scanPath, outBase, None, settings, force, useHash, adoptExisting):
+           numUpToDate += 1
+        elif batchMode:
+           batchScans.append((scanPath, None))
+        else:
+           executor.submit(executors.Job(scanID, jobScript, (scanPath, outBase, isPreprocessed, renderer, lazy, useHash),
+                                         singleScanPngGenerator.renderScan,
+                                         (scanPath, outBase, None, isPreprocessed, renderer, lazy, None, False, None, useHash)))
+
+    print(numUpToDate, "scans are up to date and were not submitted")
+
+    # --- Submit a single job rendering all of the scans ---
+    if batchMode and batchScans:
+        scanList = os.path.join(outBase, "png_scan_list.tsv")
+        batchPngGenerator.writeScanList(batchScans, scanList)
+        executor.submit(executors.Job("batch of " + str(len(batchScans)) + " scans", 'jobBatchPngGenerator.sh',
+                                      (scanList, outBase, isPreprocessed, renderer, lazy, useHash),
+                                      sbatchArgs='--cpus-per-task=' + str(numWorkers or 16)))
+
+    # --- Submit the job array, or run the local jobs ---
+    failures = executor.finish()
+    if failures:
+        sys.exit(1)
          
 
 if __name__ == "__main__":
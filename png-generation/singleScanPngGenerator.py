@@ -1,6 +1,6 @@
 
 """
-This script pseudorandomly identifies 3 slices from around the 25th, 50th, and 75th centiles of the image data in each dimension, 
+This script pseudorandomly identifies 3 slices from around the 35th, 50th, and 65th centiles of the image data in each dimension, 
 and saves them as PNG files in the output directory. If a path to the Synthseg outputs directory is provided, it additionally 
 creates PNGs with Synthseg outputs overlaid on those slices and saves them in the <outDir>_SS_Overlays directory.
 
@@ -8,6 +8,17 @@ creates PNGs with Synthseg outputs overlaid on those slices and saves them in th
 	`-f` (required): Full path to the .nii(.gz) scan
 	`-o` (required): Full path to the directory where the PNG files should be written to
 	`-d` (optional): Path to the directory containing sysnthseg outputs
+	`-r` (optional): Renderer for the structural PNGs, `nilearn` (plot_anat, default) or `numpy` (direct slice rasterizer, much faster)
+	`-l` (optional): Lazy reading : keep the scan in its native data type (memory mapped for uncompressed .nii) instead of float32
+	`-s` (optional): Seed of the slice selection (default : derived from the scan name, so reruns pick the same slices)
+	`--force` (optional): Render the scan even if it is up to date according to its render manifest (`<outDir>/<scanID>/.qc_manifest.json`)
+	`--hash` (optional): Record the sha256 of the scan in its render manifest, and compare it when the size or modification time changed
+	`--array-manifest` (optional): Render the scans of the current Slurm array task from this manifest (written by runPngGenerator.py --array)
+	                               instead of `-f`/`-o`, all in this process
+	`--prefetch` (optional): Number of scans of an array task read ahead while the current scan renders (default : 2, 0 to disable)
+	`--prefetch-memory` (optional): Memory budget of the scans read ahead, in MB (default : 4096)
+	`--queue` (optional): Render the scans pulled from this work queue (written by the slurm-queue executor of runPngGenerator.py) until it is empty,
+	                      instead of `-f`/`-o`
 
 	Output :
 	if `-d` is not provided:
@@ -24,137 +35,92 @@ import subprocess as sb
 import os
 import glob
 import numpy as np
-import random
 import pandas as pd
 import sys
 import argparse
 import json
 import nibabel
 from nilearn import plotting
-from nilearn.image import coord_transform
 import synthsegOverlay
 
-##
-# Select 3 pseudorandom slices from one dimension of the brain
-# @parameter brainMin The lower bound of the brain in that dimension
-# @parameter brainMax The upper bound of the brain in that dimension
-# @return brainSliceIndices A list of 3 pseudorandomly selected slice indices
-def selectSliceIndices(brainMin, brainMax):
-    randRange = int(round((brainMax - brainMin)*0.05))
-    # Get the slices for each dimension
-    slice1 = int((brainMax - brainMin)*0.35 + brainMin + random.randint(-randRange, randRange))
-    slice2 = int((brainMax - brainMin)*0.5 + brainMin + random.randint(-randRange, randRange))
-    slice3 = int((brainMax - brainMin)*0.65 + brainMin + random.randint(-randRange, randRange))
-    
-    return [slice1, slice2, slice3]
+# Shared modules live in the top-level `common` directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+import volumeIO
+import sliceSelection
+import renderManifest
+import sliceRasterizer
+import arrayTask
+import workQueue
+import volumePrefetch
 
+# Renderers available for the structural PNGs
+RENDERERS = ["nilearn", "numpy"]
 
 ##
-# Check that the contents of an image slice is at least 10% tissue
-# @parameter brainSlice The numpy array containing the image data for a single slice
-# @return True or False based on the number of nonzero pixels in the slice
-def checkSliceHasTissue(brainSlice):
-    # Make sure at least 10% of the brainSlice is actually brain
-    totalPixels = len(brainSlice)*len(brainSlice[0])
-    nonzeroPixels = np.count_nonzero(brainSlice)
-    
-    if (nonzeroPixels >= 0.1*totalPixels):
-        return True
+# Write the structural PNG of a single slice with the selected renderer
+# @parameter nibImg The nibabel image of the scan
+# @parameter img A numpy array of the image data
+# @parameter display The nilearn display mode ("x", "y" or "z")
+# @parameter sliceIdx The world coordinate of the cut
+# @parameter outFn Full path to the PNG file to write
+# @parameter renderer "nilearn" or "numpy"
+# @parameter anatWindow The (vmin, vmax) intensity range used by the numpy renderer
+# @return None
+def plotAnatSlice(nibImg, img, display, sliceIdx, outFn, renderer, anatWindow):
+    if renderer == "numpy":
+        sliceRasterizer.renderAnatSlice(img, nibImg.affine, display, sliceIdx, outFn, anatWindow)
     else:
-        return False
-
-
-##
-# Pick a set of
-# @parameter img A numpy array of a 3D brain image
-# @return A list of 3 lists containing the selected slice indices for each of the 3 dimensions of the iamge
-def selectNewSliceCoordinates(img):
-    # Goal: identify volume of brain that's non-zero
-    # Get the upper and lower bounds of brain in each dimension
-    dim0Lims = np.where(img.any(axis=(1, 2)))[0]
-    dim1Lims = np.where(img.any(axis=(0, 2)))[0]
-    dim2Lims = np.where(img.any(axis=(0, 1)))[0]
-
-    # Get the min and max of each dimension
-    dim0MinBrain = sorted(set(dim0Lims))[0]
-    dim0MaxBrain = sorted(set(dim0Lims))[-1]
-    
-    dim1MinBrain = sorted(set(dim1Lims))[0]
-    dim1MaxBrain = sorted(set(dim1Lims))[-1]
-    
-    dim2MinBrain = sorted(set(dim2Lims))[0]
-    dim2MaxBrain = sorted(set(dim2Lims))[-1]
-
-    # Dimension 0
-    dim0Slices = selectSliceIndices(dim0MinBrain, dim0MaxBrain)
-    k = 1
-    # If the image does not consist of at least 10% tissue, regenerate
-    while not all([checkSliceHasTissue(img[i, :, :]) for i in dim0Slices]):
-        print("Regenerating dim0 slices")
-        # If reselecting the slices does not produce slices with >10% 
-        #  tissue content after 5 reselections, reduce the space
-        #  available for the slices to be selected from
-        if k % 5 == 0:
-            dim0MinBrain += 1
-            dim0MaxBrain -= 1
-        k += 1
-        dim0Slices = selectSliceIndices(dim0MinBrain, dim0MaxBrain)
-    
-    # Dimension 1
-    dim1Slices = selectSliceIndices(dim1MinBrain, dim1MaxBrain)
-    k = 1
-    # If the image does not consist of at least 10% tissue, regenerate
-    while not all([checkSliceHasTissue(img[:, i, :]) for i in dim1Slices]):
-        print("Regenerating dim1 slices")
-        # If reselecting the slices does not produce slices with >10% 
-        #  tissue content after 5 reselections, reduce the space
-        #  available for the slices to be selected from
-        if k % 5 == 0:
-            dim1MinBrain += 1
-            dim1MaxBrain -= 1
-        k += 1
-        dim1Slices = selectSliceIndices(dim1MinBrain, dim1MaxBrain)
-    
-    # Dimension 2
-    dim2Slices = selectSliceIndices(dim2MinBrain, dim2MaxBrain)
-    k = 1
-    # If the image does not consist of at least 10% tissue, regenerate
-    while not all([checkSliceHasTissue(img[:, :, i]) for i in dim2Slices]):
-        print("Regenerating dim2 slices")
-        # If reselecting the slices does not produce slices with >10% 
-        #  tissue content after 5 reselections, reduce the space
-        #  available for the slices to be selected from
-        if k % 5 == 0:
-            dim2MinBrain += 1
-            dim2MaxBrain -= 1
-        k += 1
-        dim2Slices = selectSliceIndices(dim2MinBrain, dim2MaxBrain)
-    
-    return [dim0Slices, dim1Slices, dim2Slices]
+        plotting.plot_anat(nibImg, display_mode=display, cut_coords=[sliceIdx], draw_cross = False, output_file=outFn)
 
 ## 
 # Use the nibabel library to generate a set of PNGs from a brain scan
 # @parameter scanFn A string representing the full path to a scan
 # @parameter subject A string of the subject's identifier
 # @parameter outputDir A string specifying the directory to save the PNGs to
-# @return None
-def generatePngsSingleScanNibabel(scanPath, scanID, outBase, segPath, isPreprocessed):
+# @parameter seed Seed of the slice selection, derived from scanID if None
+# @parameter preloaded The scan and segmentation already read by a volumePrefetch.VolumePrefetcher, or None to read them here
+# @return A list with the full paths of the PNGs written (structural and overlay)
+def generatePngsSingleScanNibabel(scanPath, scanID, outBase, segPath, isPreprocessed, renderer="nilearn", lazy=False, seed=None, preloaded=None):
     # Load the masked brain image
-    nibImg = nibabel.load(scanPath)
-    img = nibImg.get_fdata()
+    if preloaded is not None:
+        nibImg, img = preloaded.nibImg, preloaded.img
+    else:
+        # With lazy, the native data type volume : only the planes needed for slice selection and the selected slices are read
+        nibImg, img = volumeIO.loadScan(scanPath, lazy)
     aff = nibImg.affine
+
+    # One pass over the volume : brain bounds, tissue profiles and intensity range
+    volumeStats = volumeIO.scanVolumeStats(img)
+
+    # The intensity window only depends on the volume, compute it once for all slices
+    anatWindow = None
+    if renderer == "numpy":
+        anatWindow = sliceRasterizer.getAnatWindowFromStats(volumeStats["vmin"], volumeStats["vmax"], volumeStats["background"])
+
+    # Load and remap the segmentation once for all of the overlay slices
+    overlayCtx = None
+    if segPath is not None:
+        if preloaded is not None:
+            overlayCtx = synthsegOverlay.OverlayContext(segPath, preloaded.segImg, preloaded.segData)
+        else:
+            overlayCtx = synthsegOverlay.OverlayContext(segPath)
     
     # Select the desired slices to get PNGs of
-    brainSlices = selectNewSliceCoordinates(img)
+    if seed is None:
+        seed = sliceSelection.scanSeed(scanID)
+    brainSlices = sliceSelection.selectPngSlices(volumeStats, np.random.default_rng(seed))
     print("brainSlices:", brainSlices)
+
+    # World coordinates of the selected slices
+    worldCoords = [sliceSelection.sliceWorldCoords(brainSlices[axis], axis, aff) for axis in range(3)]
     
     # Output directory
     outputDir = os.path.join(outBase, scanID)
+    outputs = []
 
     # Dim0 in pixel space corresponds to coronal view (dim1) in MNI space
-    for dim0Slice in brainSlices[0]:
+    for dim0Slice, newSlice in zip(brainSlices[0], worldCoords[0]):
         print("dim0Slice:", dim0Slice)
-        newSlice = coord_transform(dim0Slice, 0, 0, aff)
         print(newSlice)
         if isPreprocessed:
             sliceIdx = newSlice[0]
@@ -165,16 +131,16 @@ def generatePngsSingleScanNibabel(scanPath, scanID, outBase, segPath, isPreproce
         newFnBase = scanID+"_coronal_slice"+str(int(sliceIdx)).zfill(3)
         newFn = newFnBase+".png"
         print(os.path.join(outputDir, newFn))
-        plotting.plot_anat(nibImg, display_mode=display, cut_coords=[sliceIdx], draw_cross = False, output_file=os.path.join(outputDir, newFn))
+        plotAnatSlice(nibImg, img, display, sliceIdx, os.path.join(outputDir, newFn), renderer, anatWindow)
+        outputs.append(os.path.join(outputDir, newFn))
         
         #SS Overlay
-        if segPath is not None:
-        	synthsegOverlay.generateOverlay(segPath, scanID, nibImg, display, [sliceIdx], outBase, newFnBase)
+        if overlayCtx is not None:
+        	outputs.append(synthsegOverlay.generateOverlay(overlayCtx, scanID, nibImg, display, [sliceIdx], outBase, newFnBase))
  
     # Dim1 in pixel space corresponds to dim2 in MNI space
-    for dim1Slice in brainSlices[1]:
+    for dim1Slice, newSlice in zip(brainSlices[1], worldCoords[1]):
         print("dim1Slice:", dim1Slice)
-        newSlice = coord_transform(0, dim1Slice, 0, aff)
         print(newSlice)
         if isPreprocessed:
             sliceIdx = newSlice[1]
@@ -185,16 +151,16 @@ def generatePngsSingleScanNibabel(scanPath, scanID, outBase, segPath, isPreproce
         newFnBase = scanID+"_axial_slice"+str(int(sliceIdx)).zfill(3)
         newFn = newFnBase+".png"
         print(os.path.join(outputDir, newFn))
-        plotting.plot_anat(nibImg, display_mode=display, cut_coords=[sliceIdx], draw_cross = False, output_file=os.path.join(outputDir, newFn))
+        plotAnatSlice(nibImg, img, display, sliceIdx, os.path.join(outputDir, newFn), renderer, anatWindow)
+        outputs.append(os.path.join(outputDir, newFn))
         
         #SS Overlay
-        if segPath is not None:
-        	synthsegOverlay.generateOverlay(segPath, scanID, nibImg, display, [sliceIdx], outBase, newFnBase)
+        if overlayCtx is not None:
+        	outputs.append(synthsegOverlay.generateOverlay(overlayCtx, scanID, nibImg, display, [sliceIdx], outBase, newFnBase))
 
     # Dim2 in pixel space corresponds to dim0 in MNI space
-    for dim2Slice in brainSlices[2]:
+    for dim2Slice, newSlice in zip(brainSlices[2], worldCoords[2]):
         print("dim2Slice:", dim2Slice)
-        newSlice = coord_transform(0, 0, dim2Slice, aff)
         print(newSlice)
         if isPreprocessed:
             sliceIdx = newSlice[2]
@@ -205,46 +171,186 @@ def generatePngsSingleScanNibabel(scanPath, scanID, outBase, segPath, isPreproce
         newFnBase = scanID+"_sagittal_slice"+str(int(sliceIdx)).zfill(3)
         newFn = newFnBase+".png"
         print(os.path.join(outputDir, newFn))
-        plotting.plot_anat(nibImg, display_mode=display, cut_coords=[sliceIdx], draw_cross = False, output_file=os.path.join(outputDir, newFn))
+        plotAnatSlice(nibImg, img, display, sliceIdx, os.path.join(outputDir, newFn), renderer, anatWindow)
+        outputs.append(os.path.join(outputDir, newFn))
         
         #SS Overlay
-        if segPath is not None:
-        	synthsegOverlay.generateOverlay(segPath, scanID, nibImg, display, [sliceIdx], outBase, newFnBase)
+        if overlayCtx is not None:
+        	outputs.append(synthsegOverlay.generateOverlay(overlayCtx, scanID, nibImg, display, [sliceIdx], outBase, newFnBase))
   
 
     print("PNGs generated for", scanID)
 
+    return outputs
+
+##
+# Renderer settings recorded in the render manifest : a change in any of them makes the PNGs stale
+# @parameter renderer "nilearn" or "numpy"
+# @parameter isPreprocessed True if the scan underwent ACPC alignment
+# @parameter seed Seed of the slice selection, None for the default seed derived from the scan name
+# @return A dictionary of settings
+def pngSettings(renderer, isPreprocessed, seed=None):
+    return {"stage": "png", "renderer": renderer, "preprocessed": bool(isPreprocessed), "seed": seed}
+
+##
+# Check whether the PNGs of a scan are up to date according to its render manifest
+# @parameter scanPath A string representing the full path to a scan
+# @parameter outBase A string specifying the base directory of the PNGs
+# @parameter segPath A string representing the full path to the synthseg segmentation, or None
+# @parameter settings The renderer settings as returned by pngSettings
+# @parameter useHash True to compare the scan contents when its size or modification time changed
+# @return True if the scan does not need to be rendered again
+def isScanUpToDate(scanPath, outBase, segPath, settings, useHash=False):
+    scanID = scanPath.split("/")[-1].split(".nii")[0]
+    inputs = {"scan": scanPath, "seg": segPath}
+
+    return renderManifest.isUpToDate(os.path.join(outBase, scanID), inputs, settings, useHash)
+
+##
+# Write a render manifest for PNGs generated before manifests existed (9 structural PNGs and no manifest)
+# @parameter scanPath A string representing the full path to a scan
+# @parameter outBase A string specifying the base directory of the PNGs
+# @parameter segPath A string representing the full path to the synthseg segmentation, or None
+# @parameter settings The renderer settings as returned by pngSettings
+# @parameter useHash True to record the sha256 of the inputs
+# @return True if the existing PNGs were adopted
+def adoptExistingPngs(scanPath, outBase, segPath, settings, useHash=False):
+    scanID = scanPath.split("/")[-1].split(".nii")[0]
+    outDir = os.path.join(outBase, scanID)
+    if renderManifest.readManifest(outDir) is not None:
+        return False
+
+    existingPngs = glob.glob(outDir + "/*.png")
+    if len(existingPngs) < 9:
+        return False
+    if segPath is not None:
+        existingPngs += glob.glob(os.path.join(outBase + "_SS_Overlays", scanID) + "/*.png")
+
+    renderManifest.writeManifest(outDir, {"scan": scanPath, "seg": segPath}, settings, existingPngs, useHash)
+    return True
+
+##
+# Generate the PNGs for a single scan unless they are up to date according to its render manifest
+# @parameter scanPath A string representing the full path to a scan
+# @parameter outBase A string specifying the base directory to save the PNGs to
+# @parameter segPath A string representing the full path to the synthseg segmentation, or None
+# @parameter isPreprocessed True if the scan underwent ACPC alignment
+# @parameter renderer "nilearn" or "numpy"
+# @parameter lazy True to read the scan lazily in its native data type
+# @parameter seed Seed of the slice selection, derived from the scan name if None
+# @parameter force True to render the scan even if its PNGs are up to date
+# @parameter prefetcher A volumePrefetch.VolumePrefetcher reading this scan ahead, or None
+# @parameter useHash True to record the sha256 of the inputs (and compare it when their size or modification time changed)
+# @return None
+def renderScan(scanPath, outBase, segPath, isPreprocessed, renderer="nilearn", lazy=False, seed=None, force=False, prefetcher=None,
+               useHash=False):
+    scanID = scanPath.split("/")[-1].split(".nii")[0]
+    # Make the output directory if it doesn't exist
+    outDir = os.path.join(outBase, scanID)
+    if not os.path.exists(outDir):
+        os.makedirs(outDir)
+
+    settings = pngSettings(renderer, isPreprocessed, seed)
+    inputs = {"scan": scanPath, "seg": segPath}
+    if not force and renderManifest.isUpToDate(outDir, inputs, settings, useHash):
+        print("PNGs are up to date for", scanID)
+        if prefetcher is not None:
+            prefetcher.discard(scanPath)
+        return
+
+    # Remove the stale PNGs recorded in the manifest, so that a new slice selection does not leave the old slices next to the new
+    # ones. PNGs that no manifest records (rendered before manifests existed, possibly already graded) are never deleted
+    if renderManifest.readManifest(outDir) is not None:
+        renderManifest.removeOutputs(outDir)
+        renderManifest.removeManifest(outDir)
+
+    print("Generating Image Slices for", scanID)
+    preloaded = prefetcher.get(scanPath) if prefetcher is not None else None
+    outputs = generatePngsSingleScanNibabel(scanPath, scanID, outBase, segPath, isPreprocessed, renderer, lazy, seed, preloaded)
+    renderManifest.writeManifest(outDir, inputs, settings, outputs, useHash)
+
+##
+# Render the scan of one row of an array manifest (columns : scan_path, out_dir, [seg_path], preprocessed, renderer, lazy, hash)
+# @parameter row A dictionary {column : value}
+# @parameter prefetcher A volumePrefetch.VolumePrefetcher reading the scans of the rows ahead, or None
+# @return None
+def renderArrayRow(row, prefetcher=None):
+    try:
+        renderScan(row["scan_path"], row["out_dir"], arrayTask.parsePath(row.get("seg_path")), arrayTask.parseBool(row["preprocessed"]),
+                   row["renderer"], arrayTask.parseBool(row["lazy"]), prefetcher=prefetcher,
+                   useHash=arrayTask.parseBool(row.get("hash")))
+    finally:
+        # A scan that failed before it was taken must not hold the budget of the scans read ahead
+        if prefetcher is not None:
+            prefetcher.discard(row["scan_path"])
+
 ##
 # Main function
 def main():
     # --- Set up the argument parser ---
     parser = argparse.ArgumentParser()
-    # Add an argument to get the scan to generate PNGs from --> Required!
-    parser.add_argument('-f', '--scan-fn', help='Full path to the .nii(.gz) scan', required = True)
-    # Add an argument to get the directory where the QC PNGs will be written --> Required!
-    parser.add_argument('-o', '--out-dir', help='Full path to the directory where the PNG files should be written to', required = True)
+    # Add an argument to get the scan to generate PNGs from --> Required (unless --array-manifest or --queue is given)!
+    parser.add_argument('-f', '--scan-fn', help='Full path to the .nii(.gz) scan')
+    # Add an argument to get the directory where the QC PNGs will be written --> Required (unless --array-manifest or --queue is given)!
+    parser.add_argument('-o', '--out-dir', help='Full path to the directory where the PNG files should be written to')
     # Add an optional argument to get the derivatives directory for synthseg overlay PNGs --> Optional!
     parser.add_argument('-d', '--der-fn', help='Full path to the synthseg derivatives directory ')
     # Add an optional argument to inidcate that the BIDS scans underwent ACPC alignment
     parser.add_argument('-p', '--preprocessed', help="Flag whose presence indicates the BIDS scans were preprocessed using ACPC alignment", action='store_true')
+    # Add an optional argument to select the renderer of the structural PNGs
+    parser.add_argument('-r', '--renderer', help="Renderer for the structural PNGs (default : nilearn)", choices=RENDERERS, default="nilearn")
+    # Add an optional argument to read the scan lazily in its native data type
+    parser.add_argument('-l', '--lazy', help="Read the scan lazily in its native data type (memory mapped for uncompressed .nii) instead of loading it as float32", action='store_true')
+    # Add an optional argument to seed the slice selection
+    parser.add_argument('-s', '--seed', help="Seed of the slice selection (default : derived from the scan name)", type=int)
+    # Add an optional argument to render the scan even if its PNGs are up to date
+    parser.add_argument('--force', help="Render the scan even if its render manifest says the PNGs are up to date", action='store_true')
+    # Add an optional argument to record the content hash of the scan in its render manifest
+    parser.add_argument('--hash', help="Record the sha256 of the scan in its render manifest, and compare it when the size or modification time changed", action='store_true')
+    # Add an optional argument to render the scans of a Slurm array task
+    parser.add_argument('--array-manifest', help="Render the scans of the current Slurm array task from this manifest instead of -f/-o")
+    # Add an optional argument to render scans pulled from a work queue
+    parser.add_argument('--queue', help="Render the scans of this work queue (written by the slurm-queue executor) until it is empty, instead of -f/-o")
+    # Add an optional argument to set the number of scans of an array task read ahead
+    parser.add_argument('--prefetch', help="Number of scans of an array task read ahead while the current scan renders (default : 2, 0 to disable)", type=int, default=volumePrefetch.DEFAULT_PREFETCH)
+    # Add an optional argument to set the memory budget of the scans read ahead
+    parser.add_argument('--prefetch-memory', help="Memory budget of the scans read ahead, in MB (default : 4096)", type=int, default=volumePrefetch.DEFAULT_MEMORY_MB)
 
     args = parser.parse_args()
+
+    # --- Array task : render every scan of the task in this interpreter ---
+    if args.array_manifest is not None:
+        # The next scans of the task are read while the current one renders
+        prefetcher = volumePrefetch.prefetchTaskRows(arrayTask.readTaskRows(args.array_manifest), args.prefetch, args.prefetch_memory)
+        try:
+            failures = arrayTask.runTaskRows(args.array_manifest, lambda row: renderArrayRow(row, prefetcher))
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+        if failures:
+            sys.exit(1)
+        return
+
+    # --- Queue worker : render scans pulled from the queue until it is empty ---
+    if args.queue is not None:
+        failures = workQueue.runWorker(args.queue, renderArrayRow)
+        if failures:
+            sys.exit(1)
+        return
+
+    if args.scan_fn is None or args.out_dir is None:
+        parser.error("the following arguments are required: -f/--scan-fn, -o/--out-dir")
     scanPath = args.scan_fn
     outBase = args.out_dir
     segPath = args.der_fn
     isPreprocessed = args.preprocessed
+    renderer = args.renderer
+    lazy = args.lazy
+    seed = args.seed
+    force = args.force
+    useHash = args.hash
 	
-    scanID = scanPath.split("/")[-1].split(".nii")[0]
-    # Make the output directory if it doesn't exist
-    outDir = os.path.join(outBase, scanID)
-    if not os.path.exists(outDir):
-        os.makedirs(outDir)
-                   
-    # If there are already pngs for the scan
-    existingPngs = glob.glob(outDir + "/*.png")
-    if len(existingPngs) < 9: # TODO: generalize for more PNGS
-        print("Generating Image Slices for", scanID)
-        generatePngsSingleScanNibabel(scanPath, scanID, outBase, segPath, isPreprocessed)
+    renderScan(scanPath, outBase, segPath, isPreprocessed, renderer, lazy, seed, force, useHash=useHash)
 
 
 if __name__ == "__main__":
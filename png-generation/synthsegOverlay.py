@@ -1,7 +1,8 @@
 
 """
 
-This script contains functions that generate PNGs with synthseg overlays. It (specifically, the `generateOverlay` function) is used by singleScanPngGenerator.py.
+This script contains functions that generate PNGs with synthseg overlays. It (specifically, the `OverlayContext` class and the `generateOverlay` function) 
+is used by singleScanPngGenerator.py : the segmentation is loaded and remapped once per scan, then reused for every slice.
 
 """
 import matplotlib.colors as mcolors
@@ -9,40 +10,15 @@ import nibabel
 import numpy as np
 from nilearn import plotting
 import os
+import sys
 import glob
 
-def map_ss_labels(seg_img, synthseg_data):
-	
-	# Grouping Synthseg output labels to ensure uniform colors for display
-	value_mapping = {
-	0.0 : 0.0,
-	2.0 : 2.0, 41.0 : 2.0,
-	3.0 : 3.0, 42.0 : 3.0,
-	4.0 : 4.0, 5.0 : 4.0, 14.0 : 4.0, 15.0 : 4.0, 24.0 : 4.0, 43.0 : 4.0, 44.0 : 4.0, 
-	7.0 : 7.0, 46.0 : 7.0,
-	8.0 : 8.0, 47.0 : 8.0,
-	10.0 : 10.0, 11.0 : 10.0, 12.0 : 10.0, 13.0 : 10.0, 17.0 : 10.0, 18.0 : 10.0,
-	49.0 : 10.0, 50.0 : 10.0, 51.0 : 10.0, 52.0 : 10.0, 53.0 : 10.0, 54.0 : 10.0,
-	26.0 : 10.0, 28.0 : 10.0, 58.0 : 10.0, 60.0 : 10.0,
-	16.0 : 16.0,    
-	}
-	
-	# Custom function to handle mapping and default value
-	def map_and_default(value):
-		return value_mapping.get(value, default_value)
-	
-	# Define a default value if a key is not found in the mapping
-	default_value = round(np.max(synthseg_data)/100,0)
-	
-	# Apply mapping and default value using NumPy vectorized operation
-	mapped_data = np.vectorize(map_and_default)(synthseg_data)
-	
-	# Save the modified image
-	modified_seg_img = nibabel.Nifti1Image(mapped_data, seg_img.affine)
-	
-	return mapped_data, modified_seg_img
+# Shared modules live in the top-level `common` directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from synthsegLabels import map_ss_labels, count_labels
+import volumeIO
 
-def plotOverlay(mapped_data, modified_seg_img, anat_img, display_mode, coords, outFn):
+def get_overlay_cmap(mapped_data):
 
 	all_colors = [
 	(0.0, 1.0, 0.0),  # Green
@@ -57,9 +33,13 @@ def plotOverlay(mapped_data, modified_seg_img, anat_img, display_mode, coords, o
 	]
 	
 	# Define a custom colormap with unique colors for each label
-	num_labels = len(np.unique(mapped_data))
+	num_labels = count_labels(mapped_data)
 	colors = all_colors[:num_labels]
 	cmap = mcolors.ListedColormap(colors)
+	
+	return cmap
+
+def plotOverlay(modified_seg_img, cmap, anat_img, display_mode, coords, outFn):
 
 	# Plot the SynthSeg segmentation map with unique colors for each label
 	plotting.plot_roi(roi_img=modified_seg_img, bg_img=anat_img, cmap=cmap, draw_cross = False, dim = -0.7,\
@@ -67,7 +47,22 @@ def plotOverlay(mapped_data, modified_seg_img, anat_img, display_mode, coords, o
 	alpha = 0.4, output_file = outFn)
 	
 
-def generateOverlay(segPath, scanID, anat_img, display_mode, coords, outBase, newFnBase):
+##
+# Per-scan overlay state : the mapped segmentation image and its colormap
+# The segmentation is read from segPath, unless it was already read (seg_img and synthseg_data, e.g. by the prefetcher)
+class OverlayContext:
+	
+	def __init__(self, segPath, seg_img=None, synthseg_data=None):
+		
+		# Read the ss nifti
+		if seg_img is None or synthseg_data is None:
+			seg_img, synthseg_data = volumeIO.loadSegmentation(segPath)
+		
+		# Map labels to make it easier for custom color map
+		self.mapped_data, self.modified_seg_img = map_ss_labels(seg_img, synthseg_data)
+		self.cmap = get_overlay_cmap(self.mapped_data)
+
+def generateOverlay(overlayCtx, scanID, anat_img, display_mode, coords, outBase, newFnBase):
 	
 	# Change outBase to outBase_SS_Overlays
 	outBase = outBase + "_SS_Overlays"
@@ -77,16 +72,9 @@ def generateOverlay(segPath, scanID, anat_img, display_mode, coords, outBase, ne
 	# Make the output directory
 	if not os.path.exists(outPath):
 		os.makedirs(outPath)
-		
-	# Read the ss nifti
-	
-	seg_img = nibabel.load(segPath)
-	synthseg_data = seg_img.get_fdata()
-	
-	# Map labels to make it easier for custom color map
-	mapped_data, modified_seg_img = map_ss_labels(seg_img, synthseg_data)
 	
 	# Plot the overlay
-	plotOverlay(mapped_data, modified_seg_img, anat_img, display_mode, coords, outFn)
+	plotOverlay(overlayCtx.modified_seg_img, overlayCtx.cmap, anat_img, display_mode, coords, outFn)
 	
+	return outFn
 
@@ -16,12 +16,47 @@
 
 # -------------------------------------------
 
-INFN=$1   # Input scan path
-OUTFN=$2    # Output scan path
-
-
 # Load fsl
 module load fsl
 
-# Reorient the image
-${FSLDIR}/bin/fslreorient2std $INFN $OUTFN
+##
+# Reorient a scan
+processScan() {
+    INFN=$1   # Input scan path
+    OUTFN=$2    # Output scan path
+
+    # Reorient the image
+    ${FSLDIR}/bin/fslreorient2std "$INFN" "$OUTFN"
+}
+
+# In a job array (`--array` in the driver), the only argument is the array manifest : the task processes the CHUNK_SIZE rows
+# starting at row (SLURM_ARRAY_TASK_ID + ARRAY_OFFSET) * CHUNK_SIZE (after the header line). A scan that fails is logged
+# and appended to <manifest>_failures/task_<task>.tsv, and the task moves on to the next scan.
+if [ -n "$QUEUE_DIR" ]; then
+    # A worker of a work queue (`--executor slurm-queue` in the driver) : workQueue.py runs this script on every scan
+    # it pulls from QUEUE_DIR, until the queue is empty
+    python3 $QUEUE_WORKER $QUEUE_DIR
+elif [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+    MANIFEST=$1
+    TASK=$(( SLURM_ARRAY_TASK_ID + ${ARRAY_OFFSET:-0} ))
+    FIRST=$(( TASK * ${CHUNK_SIZE:-1} + 2 ))
+    LAST=$(( FIRST + ${CHUNK_SIZE:-1} - 1 ))
+    FAILDIR="${MANIFEST%.tsv}_failures"
+    NFAILED=0
+    # Rows are tab separated : paths containing spaces stay in their column
+    while IFS=$'\t' read -r -a ROW <&3; do
+        if ! processScan "${ROW[@]}"; then
+            echo "!! Failed : ${ROW[*]}"
+            mkdir -p "$FAILDIR"
+            if [ ! -f "$FAILDIR/task_$TASK.tsv" ]; then
+                head -n 1 "$MANIFEST" > "$FAILDIR/task_$TASK.tsv"
+            fi
+            printf '%s\n' "$(IFS=$'\t'; echo "${ROW[*]}")" >> "$FAILDIR/task_$TASK.tsv"
+            NFAILED=$(( NFAILED + 1 ))
+        fi
+    done 3< <(sed -n "${FIRST},${LAST}p" "$MANIFEST")
+    echo "$NFAILED scan(s) of this task failed"
+else
+    processScan "$@"
+fi
+
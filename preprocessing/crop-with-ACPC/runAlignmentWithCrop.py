@@ -7,6 +7,16 @@ and runs the job submission script for each scan to preprocess the scans with AC
     `-i` (required): Full path to the input BIDS directory
     `-o` (required): Full path to the output directory for preprocessed scans
     `-s` (required): Full path to the scratch directory for intermediate files
+    `--scan-index` (optional): Full path to the cached BIDS scan index (default : `.<BIDS directory name>_scan_index.sqlite` next to the BIDS directory)
+    `--refresh-index` (optional): List every directory of the BIDS tree again instead of trusting the cached listings of the scan index
+    `--array` (optional): Submit a single Slurm job array over a manifest of the scans (`<scratchDir>/PNG_preprocessing/acpc_array_manifest.tsv`) instead of one job per scan
+    `--throttle` (optional): Maximum number of array tasks running at the same time (default : 50)
+    `--chunk-size` (optional): Number of scans processed by each array task, or `auto` to fit them in `--target-minutes` (default : 1)
+    `--target-minutes` (optional): Target duration of an array task for `--chunk-size auto` (default : 40)
+    `--executor` (optional): How the jobs are run : `slurm` (one job per scan, default), `slurm-array` (same as `--array`), `slurm-queue` (worker
+                             jobs pulling the scans from a queue on the shared filesystem), `local` (pool of worker processes on this machine)
+                             or `dry-run` (print the sbatch commands)
+    `-w` (optional): Number of worker processes of the local executor (default : number of CPUs available) or of worker jobs of the `slurm-queue` executor (default : 20)
 
     Output:
     Submits jobs for preprocessing each scan:
@@ -21,6 +31,15 @@ import os
 import argparse
 import json
 
+# Shared modules live in the top-level `common` directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+import bidsIndex
+import slurmArray
+import executors
+
+# Expected processing time (in seconds) of the ACPC alignment and crop of a scan, used to size chunked array tasks
+SECONDS_PER_SCAN = 300
+
 # Main function
 def main():
     # --- Set up the argument parser ---
@@ -31,11 +50,36 @@ def main():
     parser.add_argument('-o', '--output-dir', help='Path to output directory for preprocessed scans', required = True)
     # Add an argument to get the scratch directory where intermediate files will be stored. On Respublica, this could be : /scr1/users/<user>
     parser.add_argument('-s', '--scratch-dir', help='Path to the scratch directory where intermediate files will be stored. On Respublica, this could be : /scr1/users/<user>', required = True)
+    # Add an optional argument to get the location of the cached BIDS scan index
+    parser.add_argument('--scan-index', help="Full path to the cached BIDS scan index (default : .<BIDS directory name>_scan_index.sqlite next to the BIDS directory)")
+    # Add an optional argument to list the BIDS tree again instead of trusting the scan index
+    parser.add_argument('--refresh-index', help="List every directory of the BIDS tree again instead of trusting the cached listings of the scan index", action='store_true')
+    # Add an optional argument to submit a single Slurm job array instead of one job per scan
+    parser.add_argument('--array', help="Submit a single Slurm job array over a manifest of the scans instead of one job per scan", action='store_true')
+    # Add an optional argument to limit the number of array tasks running at the same time
+    parser.add_argument('--throttle', help="Maximum number of array tasks running at the same time (default : 50)", type=int, default=slurmArray.DEFAULT_THROTTLE)
+    # Add an optional argument to set the number of scans processed by each array task
+    parser.add_argument('--chunk-size', help="Number of scans processed by each array task, or auto to fit them in --target-minutes (default : 1)", default="1")
+    # Add an optional argument to set the target duration of an array task
+    parser.add_argument('--target-minutes', help="Target duration of an array task for --chunk-size auto (default : 40)", type=float, default=slurmArray.DEFAULT_TARGET_MINUTES)
+    # Add an optional argument to select how the jobs are run
+    parser.add_argument('--executor', help="How the jobs are run : slurm (one job per scan, default), slurm-array (same as --array), slurm-queue (worker jobs pulling the scans from a queue on the shared filesystem), local (pool of worker processes on this machine) or dry-run (print the sbatch commands)", choices=executors.EXECUTORS)
+    # Add an optional argument to set the number of worker processes of the local executor
+    parser.add_argument('-w', '--workers', help="Number of worker processes of the local executor (default : number of CPUs available) or of worker jobs of the slurm-queue executor (default : 20)", type=int)
  
     # Parse the arguments
     args = parser.parse_args()
     inDir = args.input_dir
     outBase = args.output_dir
+    scanIndex = args.scan_index
+    refreshIndex = args.refresh_index
+    arrayMode = args.array
+    throttle = args.throttle
+    chunkSize = args.chunk_size
+    targetMinutes = args.target_minutes
+    numWorkers = args.workers
+    # `--array` is kept as a shorthand for `--executor slurm-array`
+    executorName = args.executor or ("slurm-array" if arrayMode else "slurm")
     scrDir = args.scratch_dir
 
     outDir = os.path.join(outBase, 'BIDS-preprocessed-withACPC')
@@ -58,49 +102,34 @@ def main():
     #os.system('module load fsl')
     fslDir = os.getenv('FSLDIR')
 
-    # --- For all of the subjects in the input directory ---
-    # Get a list of subject IDs 
-    subIDs = [sub for sub in os.listdir(inDir) if "sub-" in sub]
-
-    for subID in subIDs:
-        # Full path to subject directory
-        subPath = os.path.join(inDir, subID)
-        # List of sessions
-        sesIDs = [ses for ses in os.listdir(subPath) if "ses-" in ses]
-        
-        # --- For every session belonging to a single subject ---
-        for sesID in sesIDs:
-            sesPath = os.path.join(subPath, sesID)
-            anatPath = os.path.join(sesPath, "anat")
-           
-            # Check if session has anat folder
-            if not os.path.exists(anatPath):
-                continue
-            # Get the list of niftis in the anat folder
-            # TODO: generalize for more than MPR labeled scans. This would also change the --ref argument for ACPC alignment
-            scans = [scan for scan in os.listdir(anatPath) if (".nii" in scan) and ("MPR" in scan)]
-          
-            # --- For every anat scan in that session for the subject ---
-            for scan in scans:
-                scanPath = os.path.join(anatPath, scan)
-                scanID = scan.split(".nii")[0]
-
-                preproc_script_path = os.path.join(os.path.dirname(__file__), 'ACPCAlignment_with_crop.sh')
-                scanWorkingDir = os.path.join(workingDir, subID, sesID, 'anat', scanID)
-                newScanPath = os.path.join(outDir, subID, sesID, 'anat')
-                # Create the new scan path directories
-                if not os.path.exists(newScanPath):
-                    os.makedirs(newScanPath)
-                newScanPath = os.path.join(newScanPath, scan)
-                omat = os.path.join(workingDir, subID, sesID, 'anat', 'output_matrix.mat')
-
-                # Submit the job here
-                cmd = 'sbatch jobSingleScanPrepoc.sh '
-                cmd += scanWorkingDir + ' ' + scanPath + ' ' + newScanPath + ' ' + omat
-                os.system(cmd)
-                print("Submitted job for : ", scanID)
-                print()
-         
+    executor = executors.createExecutor(executorName, ["working_dir", "scan_path", "out_path", "omat"], os.path.join(workingDir, "acpc_array_manifest.tsv"), throttle,
+                                        slurmArray.resolveChunkSize(chunkSize, SECONDS_PER_SCAN, targetMinutes), SECONDS_PER_SCAN, numWorkers, os.path.join(workingDir, "acpc_queue"))
+
+    # --- For every anat scan in the input directory (sub-*/ses-*/anat) ---
+    for scanRec in bidsIndex.findScans(inDir, indexPath=scanIndex, refresh=refreshIndex):
+        subID = scanRec.subID
+        sesID = scanRec.sesID
+        scan = scanRec.scan
+        scanPath = scanRec.scanPath
+        scanID = scanRec.scanID
+
+        preproc_script_path = os.path.join(os.path.dirname(__file__), 'ACPCAlignment_with_crop.sh')
+        scanWorkingDir = os.path.join(workingDir, subID, sesID, 'anat', scanID)
+        newScanPath = os.path.join(outDir, subID, sesID, 'anat')
+        # Create the new scan path directories
+        if not os.path.exists(newScanPath):
+            os.makedirs(newScanPath)
+        newScanPath = os.path.join(newScanPath, scan)
+        omat = os.path.join(workingDir, subID, sesID, 'anat', 'output_matrix.mat')
+
+        # Submit the job here
+        executor.submit(executors.Job(scanID, 'jobSingleScanPrepoc.sh', (scanWorkingDir, scanPath, newScanPath, omat)))
+
+    # --- Submit the job array, or run the local jobs ---
+    failures = executor.finish()
+    if failures:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
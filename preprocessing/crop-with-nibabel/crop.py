@@ -1,12 +1,17 @@
 import os
+import sys
 import nibabel as nib
 import numpy as np
 from skimage.filters import threshold_otsu
 
+# Shared modules live in the top-level `common` directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common"))
+import niftiIO
+
 def crop_brain_mri(nifti_path, output_path):
-    # Load NIfTI image
-    img = nib.load(nifti_path)
-    img_data = img.get_fdata()
+    # Load NIfTI image (float32 is enough to threshold it, the cropped image is sliced from the stored voxels)
+    img = niftiIO.loadNifti(nifti_path)
+    img_data = img.get_fdata(dtype=np.float32)
 
     # Apply threshold to remove background (e.g., intensity = 0)
     # Automatic thresholding
@@ -18,20 +23,21 @@ def crop_brain_mri(nifti_path, output_path):
         print(f"No non-zero voxels found in {nifti_path}, consider adjusting the threshold.")
         return
     
-    # Get the indices where the mask is True (non-zero)
-    coords = np.array(np.nonzero(mask))
-
-    # Find the bounding box
-    min_coords = coords.min(axis=1)
-    max_coords = coords.max(axis=1)
+    # Find the bounding box from the projections of the mask on each axis (no list of voxel coordinates)
+    min_coords = []
+    max_coords = []
+    for axis in range(3):
+        nonzero = np.flatnonzero(np.any(mask, axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        min_coords.append(nonzero[0])
+        max_coords.append(nonzero[-1])
 
-    # Crop the image to the bounding box
-    cropped_img_data = img_data[min_coords[0]:max_coords[0]+1,
-                                min_coords[1]:max_coords[1]+1,
-                                min_coords[2]:max_coords[2]+1]
-
-    # Create a new NIfTI image from the cropped data
-    cropped_img = nib.Nifti1Image(cropped_img_data, img.affine)
+    # Crop the stored (unscaled) voxels to the bounding box, so that the output keeps the data type and scaling of the
+    # input instead of being requantized on save. Slicing the image only gives the affine of the new origin
+    bbox = tuple(slice(min_coords[axis], max_coords[axis] + 1) for axis in range(3))
+    cropped_raw = np.asanyarray(img.dataobj.get_unscaled())[bbox]
+    cropped_img = img.__class__(cropped_raw, img.slicer[bbox].affine, img.header)
+    # A scaling set in the header is written as is (the raw voxels are not rescaled)
+    cropped_img.header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
 
     # Save the cropped image
     nib.save(cropped_img, output_path)
@@ -39,7 +45,17 @@ def crop_brain_mri(nifti_path, output_path):
 
 
 if __name__ == "__main__":
-    import sys
+    # In a Slurm array task, crop every scan of the task (columns : scan_path, out_path) in this process
+    if sys.argv[1] == "--array-manifest":
+        import arrayTask
+        failures = arrayTask.runTaskRows(sys.argv[2], lambda row: crop_brain_mri(row["scan_path"], row["out_path"]))
+        sys.exit(1 if failures else 0)
+    # In a queue worker job, crop the scans pulled from the queue until it is empty
+    if sys.argv[1] == "--queue":
+        import workQueue
+        failures = workQueue.runWorker(sys.argv[2], lambda row: crop_brain_mri(row["scan_path"], row["out_path"]))
+        sys.exit(1 if failures else 0)
+
     # Get input and output directories from command-line arguments
     input_scan = sys.argv[1]
     output_scan = sys.argv[2]
@@ -21,7 +21,16 @@ INFN=$1   # Input scan path
 OUTFN=$2    # Output scan path
 
 
-python crop.py $INFN $OUTFN
+# A worker of a work queue (`--executor slurm-queue` in the driver) processes scans pulled from QUEUE_DIR until the queue is empty
+# In a job array (`--array` in the driver), the only argument is the array manifest : the CHUNK_SIZE scans of this task
+# (from row (SLURM_ARRAY_TASK_ID + ARRAY_OFFSET) * CHUNK_SIZE) are processed one after the other by the same python process
+if [ -n "$QUEUE_DIR" ]; then
+    python crop.py --queue $QUEUE_DIR
+elif [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+    python crop.py --array-manifest $1
+else
+    python crop.py $INFN $OUTFN
+fi
 
 # Done!
 